@@ -1,7 +1,9 @@
 # coding: utf-8
 
 import sys
+import os
 import functools
+import threading
 import wx
 import globalPluginHandler
 import gui
@@ -10,6 +12,7 @@ import ui
 import tones
 import queueHandler
 import winUser
+from logHandler import log
 from scriptHandler import script
 from .helpers import import_bundled
 
@@ -27,8 +30,11 @@ with import_bundled():
 
     # Normal imports
     import chess
+    import chess.engine
 
 from . import concurrency
+from . import chess_engine
+from .settings import get_setting
 from .time_control import NULL_TIME_CONTROL
 from .chessboard import ChessboardDialog
 from .game_elements import GameInfo, ChessVariant
@@ -40,7 +46,12 @@ from .virtual_chessboard import (
     UserEngineChessboard,
     PuzzleChessboard,
 )
+from .virtual_chessboard.user_engine import STOCKFISH_EXECUTABLE_PATH, FAIRY_STOCKFISH_EXECUTABLE_PATH
+from .virtual_chessboard.pgn_index import PGN_INDEX
+from . import puzzle_database
+from .puzzle_database import PUZZLE_PROGRESS
 from .graphical_interface.new_game_dialog import NewGameOptionsDialog
+from .graphical_interface.pgn_game_list import PGNGameListDialog
 from .internet_chess import LichessAPIClient
 
 
@@ -62,6 +73,16 @@ class ChessboardMenu(wx.Menu):
             _("&Replay PGN File..."),
             _("Load an replay a portable game notation (.pgn) file"),
         )
+        analyse_pgn_file_item = self.Append(
+            wx.ID_ANY,
+            _("&Analyse PGN File..."),
+            _("Annotate the games in a portable game notation (.pgn) file with engine evaluations"),
+        )
+        import_puzzles_item = self.Append(
+            wx.ID_ANY,
+            _("&Import Lichess Puzzles..."),
+            _("Build or update the puzzle database from the Lichess puzzle database (.csv, .csv.bz2, .csv.gz or .csv.xz)"),
+        )
         # Insert this menu in NVDA's menu
         self.itemHandle = gui.mainFrame.sysTrayIcon.menu.Insert(
             3,
@@ -74,6 +95,8 @@ class ChessboardMenu(wx.Menu):
         self.Bind(wx.EVT_MENU, self.onNewGame, new_game_item)
         self.Bind(wx.EVT_MENU, self.onRandomPuzzle, random_puzzle_item)
         self.Bind(wx.EVT_MENU, self.onReplayPGN, replay_pgn_file_item)
+        self.Bind(wx.EVT_MENU, self.onAnalysePGN, analyse_pgn_file_item)
+        self.Bind(wx.EVT_MENU, self.onImportPuzzles, import_puzzles_item)
 
     def onNewGame(self, event):
         dialog = NewGameOptionsDialog(gui.mainFrame, callback=self.create_new_game)
@@ -115,30 +138,49 @@ class ChessboardMenu(wx.Menu):
         filepath = dialog.GetPath().strip()
         if not filepath:
             return
-        games = tuple(PGNGameInfo.game_info_from_pgn_filename(filepath))
-        if not games:
+        # Scanning a large file the first time it is opened takes a while
+        future = concurrency.THREADED_EXECUTOR.submit(
+            PGN_INDEX.get_game_source,
+            filepath,
+            progress_callback=lambda count: wx.CallAfter(
+                ui.message, _("Indexed {count} games").format(count=count)
+            ),
+        )
+        future.add_done_callback(
+            lambda f: wx.CallAfter(self.on_pgn_games_listed, filepath, f)
+        )
+
+    def on_pgn_games_listed(self, filepath, future):
+        try:
+            game_source = future.result()
+        except Exception:
+            log.exception(f"Failed to read the games in {filepath}")
+            gui.messageBox(
+                _("Failed to read the games in this file."),
+                _("Error"),
+                style=wx.ICON_ERROR,
+            )
+            return
+        if not len(game_source):
             queueHandler.queueFunction(
                 queueHandler.eventQueue, ui.message, "The file contains no games"
             )
-        elif len(games) == 1:
-            self.open_pgn_game(games[0])
+        elif len(game_source) == 1:
+            self.open_pgn_game(PGNGameInfo.from_headers(filepath, *game_source.get_game(0)))
         else:
-            choiceDg = wx.SingleChoiceDialog(
-                gui.mainFrame,
-                _("The file contains the following games"),
-                _("Select Game"),
-                choices=[g.description for g in games],
-            )
+            gameListDialog = PGNGameListDialog(gui.mainFrame, game_source)
             gui.runScriptModalDialog(
-                choiceDg,
-                functools.partial(self.on_pgn_game_chosen, filepath, choiceDg, games),
+                gameListDialog,
+                functools.partial(self.on_pgn_game_chosen, filepath, gameListDialog),
             )
 
-    def on_pgn_game_chosen(self, filepath, dialog, games, res):
+    def on_pgn_game_chosen(self, filepath, dialog, res):
         if res != wx.ID_OK:
             return
-        selected_game_info = games[dialog.GetSelection()]
-        self.open_pgn_game(selected_game_info)
+        selected_game = dialog.GetSelectedGame()
+        if selected_game is None:
+            return
+        self.open_pgn_game(PGNGameInfo.from_headers(filepath, *selected_game))
 
     def open_pgn_game(self, game_Info):
         pgn_game = PGNGame.from_game_info(game_Info)
@@ -154,6 +196,155 @@ class ChessboardMenu(wx.Menu):
             chess_new_game_info
         )
 
+    def onAnalysePGN(self, event):
+        openFileDialog = wx.FileDialog(
+            parent=gui.mainFrame,
+            message="Open PGN File",
+            defaultDir=wx.GetUserHome(),
+            wildcard="Portable Game Notation *.pgn | *.pgn",
+            style=wx.FD_OPEN,
+        )
+        gui.runScriptModalDialog(
+            openFileDialog, functools.partial(self.analyse_pgn_file, openFileDialog)
+        )
+
+    def analyse_pgn_file(self, dialog, res):
+        if res != wx.ID_OK:
+            return
+        filepath = dialog.GetPath().strip()
+        if not filepath:
+            return
+        output_filename = os.path.splitext(filepath)[0] + ".analysed.pgn"
+        progress_dialog = wx.ProgressDialog(
+            _("Analysing Games"),
+            _("Starting the chess engine..."),
+            maximum=100,
+            parent=gui.mainFrame,
+            style=wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME,
+        )
+        future = concurrency.asyncio_coroutine_to_concurrent_future(
+            chess_engine.analyse_pgn_file
+        )(
+            filepath,
+            output_filename,
+            STOCKFISH_EXECUTABLE_PATH,
+            workers=chess_engine.get_worker_count(get_setting("game_analysis_workers")),
+            limit=chess.engine.Limit(depth=get_setting("game_analysis_depth")),
+            variant_executable=FAIRY_STOCKFISH_EXECUTABLE_PATH,
+            progress_callback=lambda *args: wx.CallAfter(
+                self.on_analysis_progress, progress_dialog, future, *args
+            ),
+        )
+        future.add_done_callback(
+            lambda f: wx.CallAfter(
+                self.on_analysis_done, progress_dialog, output_filename, f
+            )
+        )
+
+    def on_analysis_progress(self, progress_dialog, future, game_number, done, total):
+        if future.done():
+            return
+        keep_going, __ = progress_dialog.Update(
+            done * 100 // total,
+            _("Game {game_number}: analysed {done} of {total} positions").format(
+                game_number=game_number, done=done, total=total
+            ),
+        )
+        if not keep_going:
+            future.cancel()
+
+    def on_analysis_done(self, progress_dialog, output_filename, future):
+        progress_dialog.Destroy()
+        if future.cancelled():
+            ui.message(_("Analysis cancelled"))
+            return
+        try:
+            stats = future.result()
+        except Exception:
+            log.exception("Failed to analyse the PGN file")
+            gui.messageBox(
+                _("Failed to analyse the games in this file."),
+                _("Error"),
+                style=wx.ICON_ERROR,
+            )
+            return
+        message = _("Analysed {count} games. Saved to {filename}").format(
+            count=stats.games, filename=output_filename
+        )
+        if stats.games == 1:
+            message = f"{message}. {stats.first_game_summary}"
+        ui.message(message)
+
+    def onImportPuzzles(self, event):
+        openFileDialog = wx.FileDialog(
+            parent=gui.mainFrame,
+            message="Open Lichess Puzzle Database",
+            defaultDir=wx.GetUserHome(),
+            wildcard="Lichess puzzle database *.csv.bz2;*.csv.gz;*.csv.xz;*.csv | *.csv.bz2;*.csv.gz;*.csv.xz;*.csv",
+            style=wx.FD_OPEN,
+        )
+        gui.runScriptModalDialog(
+            openFileDialog, functools.partial(self.import_puzzles, openFileDialog)
+        )
+
+    def import_puzzles(self, dialog, res):
+        if res != wx.ID_OK:
+            return
+        filepath = dialog.GetPath().strip()
+        if not filepath:
+            return
+        progress_dialog = wx.ProgressDialog(
+            _("Importing Puzzles"),
+            _("Reading the puzzle database..."),
+            parent=gui.mainFrame,
+            style=wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME,
+        )
+        cancel_event = threading.Event()
+        future = concurrency.THREADED_EXECUTOR.submit(
+            puzzle_database.import_puzzles,
+            filepath,
+            progress_callback=lambda *args: wx.CallAfter(
+                self.on_import_progress, progress_dialog, cancel_event, *args
+            ),
+            cancel_event=cancel_event,
+        )
+        future.add_done_callback(
+            lambda f: wx.CallAfter(self.on_import_done, progress_dialog, cancel_event, f)
+        )
+
+    def on_import_progress(self, progress_dialog, cancel_event, rows, rows_per_second):
+        if cancel_event.is_set():
+            return
+        keep_going, __ = progress_dialog.Pulse(
+            _("Imported {rows} puzzles, {rate} per second").format(
+                rows=rows, rate=round(rows_per_second)
+            )
+        )
+        if not keep_going:
+            cancel_event.set()
+
+    def on_import_done(self, progress_dialog, cancel_event, future):
+        progress_dialog.Destroy()
+        try:
+            stats = future.result()
+        except Exception:
+            log.exception("Failed to import the puzzle database")
+            gui.messageBox(
+                _("Failed to import the puzzles in this file."),
+                _("Error"),
+                style=wx.ICON_ERROR,
+            )
+            return
+        if cancel_event.is_set():
+            ui.message(_("Import cancelled"))
+            return
+        message = _("Imported {rows} puzzles, {rate} per second").format(
+            rows=stats.rows, rate=round(stats.rows_per_second)
+        )
+        if puzzle_database.PUZZLE_DATABASE_FILE != puzzle_database.USER_PUZZLE_DATABASE_FILE:
+            message = f"{message}. " + _("Restart NVDA to use the new puzzles")
+        ui.message(message)
+
 
 class GlobalPlugin(globalPluginHandler.GlobalPlugin):
     def __init__(self, *args, **kwargs):
@@ -162,10 +353,25 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
         # The following is the GUI part
         if not globalVars.appArgs.secure:
             self.chessboard_menu = ChessboardMenu(self)
+            # One engine for standard chess, and one for the variants
+            chess_engine.warm_up_engines(
+                (STOCKFISH_EXECUTABLE_PATH, FAIRY_STOCKFISH_EXECUTABLE_PATH)
+            )
+            if puzzle_database.PUZZLE_DATABASE_FILE == puzzle_database.BUNDLED_PUZZLE_DATABASE_FILE:
+                concurrency.THREADED_EXECUTOR.submit(
+                    puzzle_database.prepare_bundled_database
+                ).add_done_callback(self.on_bundled_database_prepared)
+
+    def on_bundled_database_prepared(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error("Failed to prepare the bundled puzzle database", exc_info=future.exception())
 
     def terminate(self):
         gui.mainFrame.sysTrayIcon.menu.DestroyItem(self.chessboard_menu.itemHandle)
         try:
+            chess_engine.terminate()
+            PUZZLE_PROGRESS.close()
+            PGN_INDEX.close()
             concurrency.terminate()
             for cdlg in self._active_board_dialogs:
                 cdlg.Destroy()
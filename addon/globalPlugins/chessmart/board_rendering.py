@@ -0,0 +1,484 @@
+# coding: utf-8
+
+"""Rasterizers that turn the SVG image of the chessboard into RGB pixel data."""
+
+import os
+import re
+import threading
+import subprocess
+import dataclasses
+import typing as t
+from collections import OrderedDict
+import wx
+from io import BytesIO
+from logHandler import log
+from .helpers import import_bundled, BIN_DIRECTORY
+
+
+with import_bundled():
+    from wx_svg import SVGimage
+    import chess
+    import chess.svg
+    import chess.polyglot
+
+
+RSVG_CONVERT_EXECUTABLE = os.path.join(
+    BIN_DIRECTORY, "rsvg_convert", "rsvg_convert.exe"
+)
+DEFAULT_BOARD_RENDERER = "nanosvg"
+FALLBACK_BOARD_RENDERER = "rsvg_convert"
+# Geometry used by `chess.svg.board` when coordinates are shown
+SQUARE_SIZE = chess.svg.SQUARE_SIZE
+BOARD_MARGIN = 15
+TILE_SVG_TEMPLATE = (
+    '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+    'width="{size}" height="{size}" viewBox="0 0 {size} {size}">'
+    '<rect x="0" y="0" width="{size}" height="{size}" stroke="none" fill="{fill}"{opacity} />'
+    "{piece}{highlight}</svg>"
+)
+# NanoSVG ignores <use> elements, so the pieces they refer to are inlined
+USE_ELEMENT_PATTERN = re.compile(rb"<use\b([^>]*?)/?>(?:</use>)?")
+USE_HREF_PATTERN = re.compile(rb'\bhref="#([^"]+)"')
+USE_TRANSFORM_PATTERN = re.compile(rb'\btransform="([^"]*)"')
+PIECE_FRAGMENTS = {
+    f"{chess.COLOR_NAMES[piece.color]}-{chess.PIECE_NAMES[piece.piece_type]}".encode(
+        "ascii"
+    ): re.sub(r' id="[^"]*"', "", chess.svg.PIECES[piece.symbol()], count=1).encode("utf-8")
+    for piece in (
+        chess.Piece(piece_type, color)
+        for piece_type in chess.PIECE_TYPES
+        for color in chess.COLORS
+    )
+}
+HIGHLIGHT_SVG_TEMPLATE = (
+    '<circle cx="{center}" cy="{center}" r="{radius}" stroke-width="{stroke_width}" '
+    'stroke="{color}" fill="none" />'
+)
+
+
+class BoardRenderingError(Exception):
+    """Raised when the board image could not be rasterized."""
+
+
+def rgba_to_rgb(rgba_data: bytes) -> bytes:
+    """Drop the alpha channel from a buffer of RGBA pixels."""
+    rgb_data = bytearray(len(rgba_data) // 4 * 3)
+    for channel in range(3):
+        rgb_data[channel::3] = rgba_data[channel::4]
+    return bytes(rgb_data)
+
+
+class BoardRenderer:
+    """Base class of board rasterizers."""
+
+    name = None
+
+    def render(self, svg_bytes: bytes, width: int, height: int) -> bytes:
+        """Return the RGB data of the given SVG image scaled to width x height."""
+        raise NotImplementedError
+
+
+class RsvgConvertRenderer(BoardRenderer):
+    """Spawns the bundled `rsvg_convert` executable for every image."""
+
+    name = "rsvg_convert"
+
+    def render(self, svg_bytes, width, height):
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        try:
+            sp_result = subprocess.run(
+                [
+                    RSVG_CONVERT_EXECUTABLE,
+                    "-f",
+                    "png",
+                    "-w",
+                    str(width),
+                    "-h",
+                    str(height),
+                ],
+                input=svg_bytes,
+                capture_output=True,
+                startupinfo=startupinfo,
+            )
+        except OSError as e:
+            raise BoardRenderingError(f"Failed to run {RSVG_CONVERT_EXECUTABLE}") from e
+        if sp_result.returncode != 0:
+            raise BoardRenderingError(
+                f"Failed to convert svg to png.\n{sp_result.stderr}"
+            )
+        image = wx.Image(BytesIO(sp_result.stdout))
+        if not image.IsOk():
+            raise BoardRenderingError("Failed to decode the png produced by rsvg_convert")
+        return image.GetData()
+
+
+def inline_piece_uses(svg_bytes: bytes) -> bytes:
+    """Replace every `<use>` of a piece definition with a copy of the piece."""
+
+    def replace_use(match):
+        attributes = match.group(1)
+        href = USE_HREF_PATTERN.search(attributes)
+        fragment = PIECE_FRAGMENTS.get(href.group(1)) if href else None
+        if fragment is None:
+            raise BoardRenderingError(f"Cannot inline {match.group(0)!r}")
+        transform = USE_TRANSFORM_PATTERN.search(attributes)
+        if transform is None:
+            return fragment
+        return b'<g transform="' + transform.group(1) + b'">' + fragment + b"</g>"
+
+    return USE_ELEMENT_PATTERN.sub(replace_use, svg_bytes)
+
+
+class NanoSVGRenderer(BoardRenderer):
+    """Rasterizes the image in-process using the bundled NanoSVG wrapper."""
+
+    name = "nanosvg"
+
+    def render(self, svg_bytes, width, height):
+        try:
+            svg_image = SVGimage.CreateFromBytes(inline_piece_uses(svg_bytes))
+            if not (svg_image.width and svg_image.height):
+                raise BoardRenderingError("NanoSVG could not parse the board image")
+            scale = min(width / svg_image.width, height / svg_image.height)
+            rgba_data = svg_image.Rasterize(0, 0, scale, width, height, width * 4)
+        except BoardRenderingError:
+            raise
+        except Exception as e:
+            raise BoardRenderingError("NanoSVG failed to rasterize the board image") from e
+        return rgba_to_rgb(rgba_data)
+
+
+BOARD_RENDERERS = {
+    renderer_cls.name: renderer_cls
+    for renderer_cls in (NanoSVGRenderer, RsvgConvertRenderer)
+}
+
+
+def get_board_renderer(name: str) -> BoardRenderer:
+    renderer_cls = BOARD_RENDERERS.get(name)
+    if renderer_cls is None:
+        log.warning(f"Unknown board renderer {name}, using {DEFAULT_BOARD_RENDERER}")
+        renderer_cls = BOARD_RENDERERS[DEFAULT_BOARD_RENDERER]
+    return renderer_cls()
+
+
+@dataclasses.dataclass
+class RenderTimings:
+    """Running statistics of the time from a board image request to the painted board."""
+
+    count: int = 0
+    total: float = 0.0
+    longest: float = 0.0
+
+    def add(self, elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        self.longest = max(self.longest, elapsed)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __str__(self):
+        return f"{self.count} frames, mean {self.mean * 1000:.1f}ms, max {self.longest * 1000:.1f}ms"
+
+
+class BoardImageCache:
+    """A thread-safe LRU cache of rendered board images (RGB data), bounded by total bytes.
+    Holds whole boards rendered from SVG, and the tiles and frames of `BoardCompositor`.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(board, *, size, flipped, lastmove=None, arrows=(), **chess_svg_kwargs):
+        """Any other `chess.svg.board` options are part of the key as they are."""
+        return (
+            chess.polyglot.zobrist_hash(board) if board is not None else None,
+            size,
+            flipped,
+            lastmove.uci() if lastmove else None,
+            tuple((arrow.tail, arrow.head, arrow.color) for arrow in arrows),
+            tuple(
+                (name, BoardImageCache._make_hashable(value))
+                for (name, value) in sorted(chess_svg_kwargs.items())
+            ),
+        )
+
+    @staticmethod
+    def _make_hashable(value):
+        if isinstance(value, dict):
+            return tuple(
+                sorted(
+                    ((key, BoardImageCache._make_hashable(item)) for (key, item) in value.items()),
+                    key=repr,
+                )
+            )
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            pass
+        try:
+            return tuple(BoardImageCache._make_hashable(item) for item in value)
+        except TypeError:
+            return repr(value)
+
+    def get(self, key):
+        with self._lock:
+            image_data = self._entries.get(key)
+            if image_data is None:
+                self.misses += 1
+                return
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return image_data
+
+    def put(self, key, image_data: bytes):
+        entry_size = len(image_data)
+        if entry_size > self.max_bytes:
+            return
+        with self._lock:
+            old_data = self._entries.pop(key, None)
+            if old_data is not None:
+                self.total_bytes -= len(old_data)
+            self._entries[key] = image_data
+            self.total_bytes += entry_size
+            while self.total_bytes > self.max_bytes:
+                __, evicted_data = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted_data)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return (
+            f"{len(self)} images, {self.total_bytes / 1024 / 1024:.1f}MB, "
+            f"hit rate {self.hit_rate:.0%} ({self.hits} hits, {self.misses} misses, "
+            f"{self.evictions} evictions)"
+        )
+
+
+@dataclasses.dataclass
+class RenderedTiles:
+    """Tile and frame pixels rasterized off the GUI thread, waiting to become bitmaps."""
+
+    tiles: dict = dataclasses.field(default_factory=dict)
+    frames: dict = dataclasses.field(default_factory=dict)
+
+    def __bool__(self):
+        return bool(self.tiles or self.frames)
+
+
+class BoardCompositor:
+    """Paints the board square by square from an atlas of pre-rasterized tiles.
+    A tile is a square with its color, last move tint, piece, and highlight circle.
+    Tiles and the board frame are rasterized once per board size with `rasterize`,
+    a callable taking (svg_bytes, width, height), and only squares whose tile changed
+    since the last paint are blitted into the target bitmap.
+    With an `image_cache`, the tile and frame pixels are shared with the other boards.
+    `render_tiles` only reads the compositor and may run on any thread.
+    Everything else must be called from the GUI thread.
+    """
+
+    def __init__(self, size: int, colors: dict, rasterize, image_cache: t.Optional[BoardImageCache] = None):
+        self.size = size
+        self.colors = colors
+        self.rasterize = rasterize
+        self.image_cache = image_cache
+        self.scale = size / (8 * SQUARE_SIZE + 2 * BOARD_MARGIN)
+        self._tile_atlas = {}
+        # The board without pieces, with its margin, by orientation
+        self._frames = {}
+        self._square_states = None
+        self._flipped = None
+
+    @staticmethod
+    def can_compose(arrows=(), lastmove=None, flipped=False, **chess_svg_kwargs):
+        """Only same-square arrows (highlight circles) fit in a single tile."""
+        return not chess_svg_kwargs and all(
+            arrow.tail == arrow.head for arrow in arrows
+        )
+
+    def invalidate(self):
+        """Forget what has been painted, so the next paint redraws everything."""
+        self._square_states = None
+
+    def square_rect(self, square: chess.Square, flipped: bool) -> wx.Rect:
+        file_index = chess.square_file(square)
+        rank_index = chess.square_rank(square)
+        column = file_index if not flipped else 7 - file_index
+        row = 7 - rank_index if not flipped else rank_index
+        left, top = (
+            round((BOARD_MARGIN + i * SQUARE_SIZE) * self.scale) for i in (column, row)
+        )
+        right, bottom = (
+            round((BOARD_MARGIN + (i + 1) * SQUARE_SIZE) * self.scale)
+            for i in (column, row)
+        )
+        return wx.Rect(left, top, right - left, bottom - top)
+
+    def get_square_states(self, board, arrows, lastmove):
+        highlights = {arrow.tail: arrow.color for arrow in arrows}
+        lastmove_squares = (
+            (lastmove.from_square, lastmove.to_square) if lastmove else ()
+        )
+        states = []
+        for square, bb in enumerate(chess.BB_SQUARES):
+            piece = board.piece_at(square) if board is not None else None
+            states.append(
+                (
+                    bool(chess.BB_LIGHT_SQUARES & bb),
+                    square in lastmove_squares,
+                    piece.symbol() if piece else None,
+                    highlights.get(square),
+                )
+            )
+        return states
+
+    def get_tile(self, square_state, width, height):
+        key = (square_state, width, height)
+        tile = self._tile_atlas.get(key)
+        if tile is None:
+            # Normally rasterized ahead by `render_tiles`
+            tile_data = self._render_tile(square_state, width, height)
+            tile = self._tile_atlas[key] = wx.Bitmap.FromBuffer(width, height, tile_data)
+        return tile
+
+    def get_frame(self, flipped):
+        frame = self._frames.get(flipped)
+        if frame is None:
+            frame = self._frames[flipped] = wx.Bitmap.FromBuffer(
+                self.size, self.size, self._render_frame(flipped)
+            )
+        return frame
+
+    def render_tiles(self, board, *, arrows=(), lastmove=None, flipped=False) -> RenderedTiles:
+        """Rasterize the tiles, and the frame, a compose of this board needs and the atlas lacks.
+        Only reads the compositor, so it may run on a worker thread; pass the result
+        to `add_tiles` on the GUI thread.
+        """
+        rendered = RenderedTiles()
+        for square, state in enumerate(self.get_square_states(board, arrows, lastmove)):
+            rect = self.square_rect(square, flipped)
+            key = (state, rect.width, rect.height)
+            if key in self._tile_atlas or key in rendered.tiles:
+                continue
+            rendered.tiles[key] = self._render_tile(state, rect.width, rect.height)
+        if flipped not in self._frames:
+            rendered.frames[flipped] = self._render_frame(flipped)
+        return rendered
+
+    def add_tiles(self, rendered: RenderedTiles):
+        """Turn the pixels rasterized by `render_tiles` into bitmaps."""
+        for ((state, width, height), tile_data) in rendered.tiles.items():
+            if (state, width, height) not in self._tile_atlas:
+                self._tile_atlas[(state, width, height)] = wx.Bitmap.FromBuffer(
+                    width, height, tile_data
+                )
+        for (flipped, frame_data) in rendered.frames.items():
+            if flipped not in self._frames:
+                self._frames[flipped] = wx.Bitmap.FromBuffer(self.size, self.size, frame_data)
+
+    def _get_tile_svg(self, square_state):
+        is_light, is_lastmove, piece_symbol, highlight_color = square_state
+        color_key = ["square", "light" if is_light else "dark"]
+        if is_lastmove:
+            color_key.append("lastmove")
+        fill, fill_opacity = chess.svg._color(self.colors, " ".join(color_key))
+        highlight = ""
+        if highlight_color is not None:
+            highlight = HIGHLIGHT_SVG_TEMPLATE.format(
+                center=SQUARE_SIZE / 2,
+                radius=SQUARE_SIZE * 0.9 / 2,
+                stroke_width=SQUARE_SIZE * 0.1,
+                color=highlight_color,
+            )
+        return TILE_SVG_TEMPLATE.format(
+            size=SQUARE_SIZE,
+            fill=fill,
+            opacity=f' opacity="{fill_opacity}"' if fill_opacity < 1.0 else "",
+            piece=chess.svg.PIECES[piece_symbol] if piece_symbol else "",
+            highlight=highlight,
+        ).encode("utf-8")
+
+    def _rasterize_cached(self, key, get_svg, width, height):
+        if self.image_cache is not None:
+            image_data = self.image_cache.get(key)
+            if image_data is not None:
+                return image_data
+        image_data = self.rasterize(get_svg(), width, height)
+        if self.image_cache is not None:
+            self.image_cache.put(key, image_data)
+        return image_data
+
+    def _render_tile(self, square_state, width, height):
+        return self._rasterize_cached(
+            ("tile", square_state, width, height),
+            lambda: self._get_tile_svg(square_state),
+            width,
+            height,
+        )
+
+    def _render_frame(self, flipped):
+        return self._rasterize_cached(
+            ("frame", flipped, self.size),
+            lambda: chess.svg.board(
+                None, colors=self.colors, flipped=flipped, size=self.size
+            ).encode("utf-8"),
+            self.size,
+            self.size,
+        )
+
+    def compose(self, bitmap, board, *, arrows=(), lastmove=None, flipped=False):
+        """Blit the changed squares into `bitmap`.
+        Returns the rectangles that need to be refreshed on screen.
+        Raises `BoardRenderingError` if a missing tile could not be rasterized.
+        """
+        states = self.get_square_states(board, arrows, lastmove)
+        memory_dc = wx.MemoryDC(bitmap)
+        try:
+            if self._square_states is None or flipped != self._flipped:
+                memory_dc.DrawBitmap(self.get_frame(flipped), 0, 0)
+                previous_states = [None] * 64
+                dirty_rects = [wx.Rect(0, 0, self.size, self.size)]
+            else:
+                previous_states = self._square_states
+                dirty_rects = []
+            for square, state in enumerate(states):
+                if state == previous_states[square]:
+                    continue
+                rect = self.square_rect(square, flipped)
+                memory_dc.DrawBitmap(
+                    self.get_tile(state, rect.width, rect.height), rect.x, rect.y
+                )
+                if previous_states[square] is not None:
+                    dirty_rects.append(rect)
+        except BoardRenderingError:
+            # The bitmap is half painted, so repaint everything next time
+            self.invalidate()
+            raise
+        finally:
+            memory_dc.SelectObject(wx.NullBitmap)
+        self._square_states = states
+        self._flipped = flipped
+        return dirty_rects
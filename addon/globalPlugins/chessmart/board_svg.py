@@ -0,0 +1,300 @@
+# coding: utf-8
+
+"""
+A precompiled, string based equivalent of `chess.svg.board`.
+Element fragments are serialized once with ElementTree and then concatenated
+per call, so the output is byte-identical to `chess.svg.board(...).encode("utf-8")`
+for the options used by the add-on.
+"""
+
+import math
+import xml.etree.ElementTree as ET
+from .helpers import import_bundled
+
+
+with import_bundled():
+    import chess
+    import chess.svg
+
+
+SQUARE_SIZE = chess.svg.SQUARE_SIZE
+COORDINATES_MARGIN = 15
+SUPPORTED_OPTIONS = frozenset({"lastmove", "arrows", "flipped", "size"})
+
+
+def _serialize(element: ET.Element) -> bytes:
+    return ET.tostring(element)
+
+
+class BoardSVGTemplate:
+    """Renders board images for a fixed color map, with coordinates shown."""
+
+    def __init__(self, colors: dict):
+        self.colors = colors
+        self._piece_defs = {
+            symbol: _serialize(ET.fromstring(piece_svg))
+            for (symbol, piece_svg) in chess.svg.PIECES.items()
+        }
+        self._headers = {}
+        self._coordinates = {}
+        self._square_rects = {}
+        self._piece_uses = {}
+        self._arrows = {}
+
+    @staticmethod
+    def supports(**chess_svg_kwargs):
+        return SUPPORTED_OPTIONS.issuperset(chess_svg_kwargs)
+
+    def render(self, board=None, *, lastmove=None, arrows=(), flipped=False, size=None) -> bytes:
+        orientation = chess.WHITE ^ flipped
+        parts = [self._get_header(size)]
+        parts.extend(self._get_defs(board))
+        parts.append(self._get_coordinates(orientation))
+        lastmove_squares = (
+            (lastmove.from_square, lastmove.to_square) if lastmove else ()
+        )
+        for square in chess.SQUARES:
+            parts.append(
+                self._get_square_rect(square, orientation, square in lastmove_squares)
+            )
+        if board is not None:
+            for square in chess.SQUARES:
+                piece = board.piece_at(square)
+                if piece:
+                    parts.append(self._get_piece_use(square, orientation, piece))
+        for arrow in arrows:
+            parts.append(self._get_arrow(arrow, orientation))
+        parts.append(b"</svg>")
+        return b"".join(parts)
+
+    def _get_header(self, size):
+        header = self._headers.get(size)
+        if header is None:
+            svg = chess.svg._svg(8 * SQUARE_SIZE + 2 * COORDINATES_MARGIN, size)
+            ET.SubElement(svg, "sentinel")
+            header = self._headers[size] = _serialize(svg).split(b"<sentinel />")[0]
+        return header
+
+    def _get_defs(self, board):
+        piece_defs = []
+        if board:
+            for piece_color in chess.COLORS:
+                for piece_type in chess.PIECE_TYPES:
+                    if board.pieces_mask(piece_type, piece_color):
+                        piece_defs.append(
+                            self._piece_defs[chess.Piece(piece_type, piece_color).symbol()]
+                        )
+        if not piece_defs:
+            return (b"<defs />",)
+        return (b"<defs>", *piece_defs, b"</defs>")
+
+    def _get_coordinates(self, orientation):
+        coordinates = self._coordinates.get(orientation)
+        if coordinates is not None:
+            return coordinates
+        margin = COORDINATES_MARGIN
+        margin_color, margin_opacity = chess.svg._color(self.colors, "margin")
+        elements = [
+            ET.Element(
+                "rect",
+                chess.svg._attrs(
+                    {
+                        "x": 0,
+                        "y": 0,
+                        "width": 2 * margin + 8 * SQUARE_SIZE,
+                        "height": 2 * margin + 8 * SQUARE_SIZE,
+                        "fill": margin_color,
+                        "opacity": margin_opacity if margin_opacity < 1.0 else None,
+                    }
+                ),
+            )
+        ]
+        coord_color, coord_opacity = chess.svg._color(self.colors, "coord")
+        coord_style = dict(color=coord_color, opacity=coord_opacity)
+        for file_index, file_name in enumerate(chess.FILE_NAMES):
+            x = (file_index if orientation else 7 - file_index) * SQUARE_SIZE + margin
+            elements.append(
+                chess.svg._coord(file_name, x, 0, SQUARE_SIZE, margin, True, margin, **coord_style)
+            )
+            elements.append(
+                chess.svg._coord(
+                    file_name, x, margin + 8 * SQUARE_SIZE, SQUARE_SIZE, margin, True, margin, **coord_style
+                )
+            )
+        for rank_index, rank_name in enumerate(chess.RANK_NAMES):
+            y = (7 - rank_index if orientation else rank_index) * SQUARE_SIZE + margin
+            elements.append(
+                chess.svg._coord(rank_name, 0, y, margin, SQUARE_SIZE, False, margin, **coord_style)
+            )
+            elements.append(
+                chess.svg._coord(
+                    rank_name, margin + 8 * SQUARE_SIZE, y, margin, SQUARE_SIZE, False, margin, **coord_style
+                )
+            )
+        coordinates = self._coordinates[orientation] = b"".join(
+            _serialize(e) for e in elements
+        )
+        return coordinates
+
+    @staticmethod
+    def _square_origin(square, orientation):
+        file_index = chess.square_file(square)
+        rank_index = chess.square_rank(square)
+        x = (file_index if orientation else 7 - file_index) * SQUARE_SIZE + COORDINATES_MARGIN
+        y = (7 - rank_index if orientation else rank_index) * SQUARE_SIZE + COORDINATES_MARGIN
+        return x, y
+
+    def _get_square_rect(self, square, orientation, is_lastmove):
+        key = (square, orientation, is_lastmove)
+        rect = self._square_rects.get(key)
+        if rect is not None:
+            return rect
+        x, y = self._square_origin(square, orientation)
+        cls = ["square", "light" if chess.BB_LIGHT_SQUARES & chess.BB_SQUARES[square] else "dark"]
+        if is_lastmove:
+            cls.append("lastmove")
+        fill_color, fill_opacity = chess.svg._color(self.colors, " ".join(cls))
+        cls.append(chess.SQUARE_NAMES[square])
+        rect = self._square_rects[key] = _serialize(
+            ET.Element(
+                "rect",
+                chess.svg._attrs(
+                    {
+                        "x": x,
+                        "y": y,
+                        "width": SQUARE_SIZE,
+                        "height": SQUARE_SIZE,
+                        "class": " ".join(cls),
+                        "stroke": "none",
+                        "fill": fill_color,
+                        "opacity": fill_opacity if fill_opacity < 1.0 else None,
+                    }
+                ),
+            )
+        )
+        return rect
+
+    def _get_piece_use(self, square, orientation, piece):
+        key = (square, orientation, piece)
+        use = self._piece_uses.get(key)
+        if use is not None:
+            return use
+        x, y = self._square_origin(square, orientation)
+        href = f"#{chess.COLOR_NAMES[piece.color]}-{chess.PIECE_NAMES[piece.piece_type]}"
+        use = self._piece_uses[key] = _serialize(
+            ET.Element(
+                "use",
+                {
+                    "href": href,
+                    "xlink:href": href,
+                    "transform": f"translate({x:d}, {y:d})",
+                },
+            )
+        )
+        return use
+
+    def _get_arrow(self, arrow, orientation):
+        try:
+            tail, head, color = arrow.tail, arrow.head, arrow.color
+        except AttributeError:
+            tail, head = arrow
+            color = "green"
+        key = (tail, head, color, orientation)
+        arrow_svg = self._arrows.get(key)
+        if arrow_svg is None:
+            arrow_svg = self._arrows[key] = b"".join(
+                _serialize(e) for e in self._make_arrow_elements(tail, head, color, orientation)
+            )
+        return arrow_svg
+
+    def _make_arrow_elements(self, tail, head, color, orientation):
+        margin = COORDINATES_MARGIN
+        try:
+            color, opacity = chess.svg._color(self.colors, " ".join(["arrow", color]))
+        except KeyError:
+            opacity = 1.0
+
+        tail_file = chess.square_file(tail)
+        tail_rank = chess.square_rank(tail)
+        head_file = chess.square_file(head)
+        head_rank = chess.square_rank(head)
+
+        xtail = margin + (tail_file + 0.5 if orientation else 7.5 - tail_file) * SQUARE_SIZE
+        ytail = margin + (7.5 - tail_rank if orientation else tail_rank + 0.5) * SQUARE_SIZE
+        xhead = margin + (head_file + 0.5 if orientation else 7.5 - head_file) * SQUARE_SIZE
+        yhead = margin + (7.5 - head_rank if orientation else head_rank + 0.5) * SQUARE_SIZE
+
+        if (head_file, head_rank) == (tail_file, tail_rank):
+            yield ET.Element(
+                "circle",
+                chess.svg._attrs(
+                    {
+                        "cx": xhead,
+                        "cy": yhead,
+                        "r": SQUARE_SIZE * 0.9 / 2,
+                        "stroke-width": SQUARE_SIZE * 0.1,
+                        "stroke": color,
+                        "opacity": opacity if opacity < 1.0 else None,
+                        "fill": "none",
+                        "class": "circle",
+                    }
+                ),
+            )
+            return
+
+        marker_size = 0.75 * SQUARE_SIZE
+        marker_margin = 0.1 * SQUARE_SIZE
+
+        dx, dy = xhead - xtail, yhead - ytail
+        hypot = math.hypot(dx, dy)
+
+        shaft_x = xhead - dx * (marker_size + marker_margin) / hypot
+        shaft_y = yhead - dy * (marker_size + marker_margin) / hypot
+
+        xtip = xhead - dx * marker_margin / hypot
+        ytip = yhead - dy * marker_margin / hypot
+
+        yield ET.Element(
+            "line",
+            chess.svg._attrs(
+                {
+                    "x1": xtail,
+                    "y1": ytail,
+                    "x2": shaft_x,
+                    "y2": shaft_y,
+                    "stroke": color,
+                    "opacity": opacity if opacity < 1.0 else None,
+                    "stroke-width": SQUARE_SIZE * 0.2,
+                    "stroke-linecap": "butt",
+                    "class": "arrow",
+                }
+            ),
+        )
+        marker = [
+            (xtip, ytip),
+            (
+                shaft_x + dy * 0.5 * marker_size / hypot,
+                shaft_y - dx * 0.5 * marker_size / hypot,
+            ),
+            (
+                shaft_x - dy * 0.5 * marker_size / hypot,
+                shaft_y + dx * 0.5 * marker_size / hypot,
+            ),
+        ]
+        yield ET.Element(
+            "polygon",
+            chess.svg._attrs(
+                {
+                    "points": " ".join(f"{x},{y}" for x, y in marker),
+                    "fill": color,
+                    "opacity": opacity if opacity < 1.0 else None,
+                    "class": "arrow",
+                }
+            ),
+        )
+
+    def render_any(self, board=None, **chess_svg_kwargs) -> bytes:
+        """Use the template when possible, otherwise fall back to `chess.svg.board`."""
+        if self.supports(**chess_svg_kwargs):
+            return self.render(board, **chess_svg_kwargs)
+        return chess.svg.board(board, colors=self.colors, **chess_svg_kwargs).encode("utf-8")
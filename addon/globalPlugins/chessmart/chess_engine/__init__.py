@@ -0,0 +1,55 @@
+# coding: utf-8
+
+from logHandler import log
+from ..helpers import import_bundled
+from ..settings import get_setting
+from ..concurrency import ASYNCIO_EVENT_LOOP
+from .pool import UCIEnginePool, spawn_uci_engine, ENGINE_COMMAND_TIMEOUT
+from .book import OpeningBook
+from .tablebase import EndgameTablebase
+from .time_management import EngineTimeManager, TimeBudget, MIN_MOVE_TIME
+from .analysis_cache import AnalysisCache, CachedAnalysis, ANALYSIS_DATABASE_FILE
+from .game_analysis import (
+    GameAnalysis,
+    FileAnalysisStats,
+    MoveClassification,
+    analyse_game,
+    analyse_pgn_file,
+    get_worker_count,
+)
+
+
+with import_bundled():
+    import asyncio
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+ENGINE_POOL = UCIEnginePool(
+    max_idle=get_setting("engine_pool_size"),
+    idle_timeout=get_setting("engine_idle_timeout"),
+)
+OPENING_BOOK = OpeningBook()
+ENDGAME_TABLEBASE = EndgameTablebase()
+ANALYSIS_CACHE = AnalysisCache(
+    ANALYSIS_DATABASE_FILE,
+    max_entries=get_setting("analysis_cache_max_entries"),
+)
+
+
+def warm_up_engines(executables):
+    """Start the engines in the background, so that the first game does not wait for them."""
+    asyncio.run_coroutine_threadsafe(ENGINE_POOL.warm_up(executables), ASYNCIO_EVENT_LOOP)
+
+
+def terminate(timeout=5.0):
+    """Close the pooled engine processes, waiting at most `timeout` seconds."""
+    OPENING_BOOK.close()
+    ENDGAME_TABLEBASE.close()
+    ANALYSIS_CACHE.close()
+    if not ASYNCIO_EVENT_LOOP.is_running():
+        return
+    future = asyncio.run_coroutine_threadsafe(ENGINE_POOL.shutdown(), ASYNCIO_EVENT_LOOP)
+    try:
+        future.result(timeout)
+    except FutureTimeoutError:
+        log.exception("Timed out while closing engine processes")
@@ -0,0 +1,284 @@
+# coding: utf-8
+
+"""
+A persistent store of engine analysis, shared by engine play and analysis.
+Results are keyed by the Zobrist hash of the position and the identity of the
+engine (name, options, and variant), and kept in a SQLite database in NVDA's
+configuration directory, so that they survive add-on updates.
+"""
+
+import os
+import time
+import json
+import threading
+import dataclasses
+import typing as t
+import globalVars
+from logHandler import log
+from ..helpers import import_bundled, LIB_DIRECTORY
+from ..sqlite_database import TrackedAPSWDatabase
+
+
+with import_bundled():
+    import chess
+    import chess.polyglot
+    import chess.engine
+
+
+with import_bundled(os.path.join(LIB_DIRECTORY, "sqlite")):
+    import apsw
+    from peewee import *
+
+
+ANALYSIS_DATABASE_FILE = os.path.join(
+    globalVars.appArgs.configPath, ".chessmart.analysis.sqlite"
+)
+ANALYSIS_WRITE_BATCH_SIZE = 32
+database = TrackedAPSWDatabase(None)
+
+
+class AnalysisEntry(Model):
+    position_hash = IntegerField()
+    engine_key = CharField()
+    depth = IntegerField()
+    score_cp = IntegerField(null=True)
+    score_mate = IntegerField(null=True)
+    pv = TextField()
+    wdl = CharField(null=True)
+    last_used = FloatField(index=True)
+
+    class Meta:
+        database = database
+        table_name = "analysis"
+        primary_key = CompositeKey("position_hash", "engine_key")
+
+
+@dataclasses.dataclass
+class CachedAnalysis:
+    """Engine analysis of a position, from the point of view of the side to move."""
+
+    depth: int
+    score: chess.engine.Score
+    pv: t.Tuple[chess.Move]
+    wdl: t.Optional[chess.engine.Wdl] = None
+
+    @classmethod
+    def from_engine_info(cls, info: dict):
+        if not info.get("pv") or "score" not in info or "depth" not in info:
+            return
+        wdl = info.get("wdl")
+        return cls(
+            depth=info["depth"],
+            score=info["score"].relative,
+            pv=tuple(info["pv"]),
+            wdl=wdl.relative if wdl is not None else None,
+        )
+
+    @classmethod
+    def from_entry(cls, entry: AnalysisEntry):
+        if entry.score_mate is not None:
+            score = chess.engine.Mate(entry.score_mate)
+        else:
+            score = chess.engine.Cp(entry.score_cp)
+        wdl = None
+        if entry.wdl:
+            wdl = chess.engine.Wdl(*(int(v) for v in entry.wdl.split()))
+        return cls(
+            depth=entry.depth,
+            score=score,
+            pv=tuple(chess.Move.from_uci(m) for m in entry.pv.split()),
+            wdl=wdl,
+        )
+
+    def to_row(self, position_hash, engine_key, last_used):
+        return {
+            "position_hash": position_hash,
+            "engine_key": engine_key,
+            "depth": self.depth,
+            "score_cp": self.score.score(),
+            "score_mate": self.score.mate(),
+            "pv": " ".join(move.uci() for move in self.pv),
+            "wdl": " ".join(str(v) for v in self.wdl) if self.wdl else None,
+            "last_used": last_used,
+        }
+
+
+class AnalysisCache:
+    """
+    Reads and writes block, so they should be done off the GUI thread and
+    the event loop. New results are buffered and written in batches, only
+    replacing stored results of the same or lower depth. When the store grows
+    past `max_entries`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, database_file: str, max_entries: int, batch_size=ANALYSIS_WRITE_BATCH_SIZE):
+        self.database_file = database_file
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._pending = {}
+        self._touched = {}
+        self._is_open = False
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def make_engine_key(engine_name: str, uci_options: dict, variant="chess"):
+        return f"{engine_name}|{variant}|{json.dumps(uci_options, sort_keys=True)}"
+
+    @staticmethod
+    def position_hash(board: chess.Board):
+        # SQLite integers are signed 64-bit
+        zobrist_hash = chess.polyglot.zobrist_hash(board)
+        return zobrist_hash - (1 << 64) if zobrist_hash >= (1 << 63) else zobrist_hash
+
+    def open(self):
+        with self._lock:
+            if self._is_open:
+                return
+            database.init(
+                self.database_file,
+                pragmas={"journal_mode": "wal", "synchronous": "normal"},
+                timeout=5,
+            )
+            database.create_tables([AnalysisEntry], safe=True)
+            self._is_open = True
+
+    def get(self, board: chess.Board, engine_key: str, min_depth=0):
+        """Return the stored analysis of at least `min_depth`, or None."""
+        key = (self.position_hash(board), engine_key)
+        with self._lock:
+            analysis = self._pending.get(key)
+            if analysis is None:
+                try:
+                    self.open()
+                    entry = (
+                        AnalysisEntry.select()
+                        .where(
+                            (AnalysisEntry.position_hash == key[0])
+                            & (AnalysisEntry.engine_key == engine_key)
+                        )
+                        .first()
+                    )
+                except apsw.Error:
+                    log.exception("Failed to read the engine analysis cache")
+                    entry = None
+                analysis = CachedAnalysis.from_entry(entry) if entry else None
+            # Guard against hash collisions
+            if (
+                analysis is None
+                or analysis.depth < min_depth
+                or not board.is_legal(analysis.pv[0])
+            ):
+                self.misses += 1
+                return
+            self.hits += 1
+            self._touched[key] = time.time()
+            return analysis
+
+    def put(self, board: chess.Board, engine_key: str, info: dict):
+        """Buffer the engine info of a finished search for writing."""
+        analysis = CachedAnalysis.from_engine_info(info)
+        if analysis is None:
+            return
+        key = (self.position_hash(board), engine_key)
+        with self._lock:
+            pending_analysis = self._pending.get(key)
+            if pending_analysis is None or pending_analysis.depth <= analysis.depth:
+                self._pending[key] = analysis
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def put_in_background(self, board: chess.Board, engine_key: str, info: dict):
+        """`put`, meant to be submitted to `THREADED_EXECUTOR` without waiting for the result."""
+        try:
+            self.put(board, engine_key, info)
+        except apsw.Error:
+            log.exception("Failed to write the engine analysis cache")
+
+    def flush_in_background(self):
+        try:
+            self.flush()
+        except apsw.Error:
+            log.exception("Failed to write the engine analysis cache")
+
+    def flush(self):
+        """Write the buffered results and recency updates, then enforce the size cap."""
+        with self._lock:
+            if not (self._pending or self._touched):
+                return
+            self.open()
+            now = time.time()
+            rows = [
+                analysis.to_row(position_hash, engine_key, now)
+                for ((position_hash, engine_key), analysis) in self._pending.items()
+            ]
+            with database.atomic():
+                if rows:
+                    (
+                        AnalysisEntry.insert_many(rows)
+                        .on_conflict(
+                            conflict_target=[AnalysisEntry.position_hash, AnalysisEntry.engine_key],
+                            preserve=[
+                                AnalysisEntry.depth,
+                                AnalysisEntry.score_cp,
+                                AnalysisEntry.score_mate,
+                                AnalysisEntry.pv,
+                                AnalysisEntry.wdl,
+                                AnalysisEntry.last_used,
+                            ],
+                            where=(EXCLUDED.depth >= AnalysisEntry.depth),
+                        )
+                        .execute()
+                    )
+                for ((position_hash, engine_key), last_used) in self._touched.items():
+                    (
+                        AnalysisEntry.update(last_used=last_used)
+                        .where(
+                            (AnalysisEntry.position_hash == position_hash)
+                            & (AnalysisEntry.engine_key == engine_key)
+                        )
+                        .execute()
+                    )
+                self._evict_least_recently_used()
+            self.writes += len(rows)
+            self._pending.clear()
+            self._touched.clear()
+
+    def _evict_least_recently_used(self):
+        excess = AnalysisEntry.select().count() - self.max_entries
+        if excess <= 0:
+            return
+        oldest = (
+            AnalysisEntry.select(SQL("rowid"))
+            .order_by(AnalysisEntry.last_used.asc())
+            .limit(excess)
+        )
+        self.evictions += (
+            AnalysisEntry.delete()
+            .where(SQL("rowid").in_(oldest))
+            .execute()
+        )
+
+    def close(self):
+        with self._lock:
+            try:
+                self.flush()
+            except apsw.Error:
+                log.exception("Failed to write the engine analysis cache")
+            if self._is_open:
+                database.close_all()
+                self._is_open = False
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return (
+            f"hit rate {self.hit_rate:.0%} ({self.hits} hits, {self.misses} misses), "
+            f"{self.writes} writes, {self.evictions} evictions"
+        )
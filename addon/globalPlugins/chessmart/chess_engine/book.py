@@ -0,0 +1,78 @@
+# coding: utf-8
+
+"""
+An opening book stage that is consulted before the engine.
+The Polyglot book is memory mapped once per process and shared by all boards.
+"""
+
+import threading
+from logHandler import log
+from ..helpers import import_bundled
+from ..settings import get_setting
+
+
+with import_bundled():
+    import chess
+    import chess.polyglot
+
+
+class OpeningBook:
+    """
+    Picks book moves with `MemoryMappedReader.weighted_choice`.
+    Only the `variety` most played moves of a position are candidates, and
+    the book is left once the game is `max_depth` plies deep.
+    """
+
+    def __init__(self):
+        self._reader = None
+        self._reader_path = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_reader(self):
+        """Open the configured book, or return the already open reader."""
+        path = get_setting("opening_book_path")
+        with self._lock:
+            if path == self._reader_path:
+                return self._reader
+            self._close_reader()
+            self._reader_path = path
+            if path:
+                try:
+                    self._reader = chess.polyglot.open_reader(path)
+                except OSError:
+                    log.exception(f"Could not open the opening book {path}")
+            return self._reader
+
+    def probe(self, board: chess.Board):
+        """Return a book move for the given position, or None to ask the engine."""
+        if board.uci_variant != "chess" or board.chess960:
+            return
+        if board.ply() >= get_setting("opening_book_max_depth"):
+            return
+        reader = self.get_reader()
+        if reader is None:
+            return
+        entries = sorted(reader.find_all(board), key=lambda e: e.weight, reverse=True)
+        if not entries:
+            self.misses += 1
+            return
+        self.hits += 1
+        variety = get_setting("opening_book_variety")
+        return reader.weighted_choice(
+            board, exclude_moves={entry.move for entry in entries[variety:]}
+        ).move
+
+    def close(self):
+        with self._lock:
+            self._close_reader()
+            self._reader_path = None
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def __str__(self):
+        return f"{self.hits} book moves, {self.misses} positions out of book"
@@ -0,0 +1,338 @@
+# coding: utf-8
+
+"""
+Whole-game analysis of PGN games.
+The positions of a game are analysed in parallel by several engine processes
+taken from the engine pool, then every move is classified by the drop in the
+expected score of the player who made it, and the game is annotated with
+`[%eval]` comments and NAGs.
+All the coroutines in this module must run on `concurrency.ASYNCIO_EVENT_LOOP`.
+"""
+
+import os
+import enum
+import functools
+import contextlib
+import dataclasses
+import typing as t
+from logHandler import log
+from ..helpers import import_bundled
+from ..concurrency import THREADED_EXECUTOR
+
+
+with import_bundled():
+    import asyncio
+    import chess
+    import chess.engine
+    import chess.pgn
+
+
+# Drops in expected score, as used by Lichess
+INACCURACY_THRESHOLD = 0.05
+MISTAKE_THRESHOLD = 0.10
+BLUNDER_THRESHOLD = 0.15
+# Each worker is a separate process, so one search thread per worker
+# scales better than several threads sharing a hash table
+ANALYSIS_ENGINE_OPTIONS = {"Threads": 1}
+
+
+def get_worker_count(configured_workers=0):
+    """Zero means one worker per core, leaving a core for NVDA."""
+    if configured_workers:
+        return configured_workers
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+class MoveClassification(enum.IntEnum):
+    GOOD = 0
+    INACCURACY = 1
+    MISTAKE = 2
+    BLUNDER = 3
+
+    @classmethod
+    def from_expected_score_loss(cls, loss):
+        if loss >= BLUNDER_THRESHOLD:
+            return cls.BLUNDER
+        elif loss >= MISTAKE_THRESHOLD:
+            return cls.MISTAKE
+        elif loss >= INACCURACY_THRESHOLD:
+            return cls.INACCURACY
+        return cls.GOOD
+
+    @property
+    def nag(self):
+        return {
+            MoveClassification.INACCURACY: chess.pgn.NAG_DUBIOUS_MOVE,
+            MoveClassification.MISTAKE: chess.pgn.NAG_MISTAKE,
+            MoveClassification.BLUNDER: chess.pgn.NAG_BLUNDER,
+        }.get(self)
+
+
+@dataclasses.dataclass
+class PositionEvaluation:
+    score: chess.engine.PovScore
+    depth: t.Optional[int] = None
+
+    def expected_score(self, color: chess.Color):
+        return self.score.pov(color).wdl(model="lichess").expectation()
+
+
+@dataclasses.dataclass
+class AnalysedMove:
+    ply: int
+    move: chess.Move
+    color: chess.Color
+    evaluation: PositionEvaluation
+    expected_score_loss: float
+    classification: MoveClassification
+
+
+@dataclasses.dataclass
+class GameAnalysis:
+    game: chess.pgn.Game
+    moves: t.List[AnalysedMove]
+
+    def count(self, color: chess.Color, classification: MoveClassification):
+        return sum(
+            1
+            for analysed_move in self.moves
+            if analysed_move.color == color
+            and analysed_move.classification == classification
+        )
+
+    def annotate(self):
+        """Add the evaluation and NAG of every move to the mainline of the game."""
+        for node, analysed_move in zip(self.game.mainline(), self.moves):
+            evaluation = analysed_move.evaluation
+            node.set_eval(evaluation.score, evaluation.depth)
+            nag = analysed_move.classification.nag
+            if nag is not None:
+                node.nags.add(nag)
+        return self.game
+
+    @property
+    def summary(self):
+        return ". ".join(
+            f"{chess.COLOR_NAMES[color].title()}: "
+            + ", ".join(
+                f"{self.count(color, classification)} {label}"
+                for (classification, label) in (
+                    (MoveClassification.INACCURACY, "inaccuracies"),
+                    (MoveClassification.MISTAKE, "mistakes"),
+                    (MoveClassification.BLUNDER, "blunders"),
+                )
+            )
+            for color in chess.COLORS
+        )
+
+
+@dataclasses.dataclass
+class FileAnalysisStats:
+    """What is kept of the analysis of a PGN file, whose annotated games are written out as they are done."""
+
+    games: int = 0
+    # Variant games, when no engine for variants was given
+    skipped_games: int = 0
+    # Read out when the file holds a single game
+    first_game_summary: t.Optional[str] = None
+
+
+def evaluate_terminal_position(board: chess.Board):
+    if board.is_checkmate():
+        return PositionEvaluation(chess.engine.PovScore(chess.engine.MateGiven, not board.turn))
+    elif board.is_game_over(claim_draw=False):
+        return PositionEvaluation(chess.engine.PovScore(chess.engine.Cp(0), board.turn))
+
+
+@contextlib.asynccontextmanager
+async def hold_analysis_engines(executable, workers):
+    """Take `workers` engines from the pool for the duration of the block."""
+    from . import ENGINE_POOL
+
+    engines = []
+    try:
+        for i in range(workers):
+            engines.append(await ENGINE_POOL.acquire(executable, ANALYSIS_ENGINE_OPTIONS))
+        yield engines
+    finally:
+        for engine in engines:
+            await ENGINE_POOL.release(engine)
+
+
+async def analyse_positions(
+    boards, executable, *, workers, limit, progress_callback=None, engines=None
+):
+    """
+    Analyse every board with `workers` engine processes working off a shared queue.
+    Returns a list of `PositionEvaluation` in the order of `boards`.
+    `progress_callback(done, total)` is called on the event loop after every position.
+    Engines held with `hold_analysis_engines` can be passed as `engines`, otherwise
+    they are taken from the pool and returned to it once the positions are done.
+    Cancelling the task stops the searches and returns the engines to the pool.
+    """
+    from . import ANALYSIS_CACHE
+
+    loop = asyncio.get_event_loop()
+    evaluations = [None] * len(boards)
+    queue = asyncio.Queue()
+    for index, board in enumerate(boards):
+        evaluation = evaluate_terminal_position(board)
+        if evaluation is not None:
+            evaluations[index] = evaluation
+        else:
+            queue.put_nowait((index, board))
+    done = len(boards) - queue.qsize()
+
+    async def _worker(engine):
+        nonlocal done
+        engine_key = ANALYSIS_CACHE.make_engine_key(
+            engine.id.get("name"), ANALYSIS_ENGINE_OPTIONS, boards[0].uci_variant
+        )
+        while not queue.empty():
+            index, board = queue.get_nowait()
+            cached_analysis = await loop.run_in_executor(
+                THREADED_EXECUTOR,
+                functools.partial(
+                    ANALYSIS_CACHE.get, board, engine_key, min_depth=limit.depth or 0
+                ),
+            )
+            if cached_analysis is not None:
+                evaluations[index] = PositionEvaluation(
+                    chess.engine.PovScore(cached_analysis.score, board.turn),
+                    cached_analysis.depth,
+                )
+            else:
+                info = await engine.analyse(board, limit)
+                evaluations[index] = PositionEvaluation(info["score"], info.get("depth"))
+                loop.run_in_executor(
+                    THREADED_EXECUTOR, ANALYSIS_CACHE.put_in_background, board, engine_key, info
+                )
+            done += 1
+            if progress_callback is not None:
+                progress_callback(done, len(boards))
+
+    if queue.empty():
+        return evaluations
+    if engines is not None:
+        await asyncio.gather(*(_worker(engine) for engine in engines[: queue.qsize()]))
+    else:
+        async with hold_analysis_engines(executable, min(workers, queue.qsize())) as engines:
+            await asyncio.gather(*(_worker(engine) for engine in engines))
+    return evaluations
+
+
+async def analyse_game(
+    game: chess.pgn.Game, executable, *, workers, limit, progress_callback=None, engines=None
+):
+    """Analyse and classify every mainline move of `game` (a `chess.pgn.Game`)."""
+    board = game.board()
+    boards = [board.copy(stack=False)]
+    moves = []
+    for move in game.mainline_moves():
+        board.push(move)
+        boards.append(board.copy(stack=False))
+        moves.append(move)
+    evaluations = await analyse_positions(
+        boards,
+        executable,
+        workers=workers,
+        limit=limit,
+        progress_callback=progress_callback,
+        engines=engines,
+    )
+    analysed_moves = []
+    for ply, move in enumerate(moves):
+        color = boards[ply].turn
+        loss = max(
+            0.0,
+            evaluations[ply].expected_score(color)
+            - evaluations[ply + 1].expected_score(color),
+        )
+        analysed_moves.append(
+            AnalysedMove(
+                ply=ply,
+                move=move,
+                color=color,
+                evaluation=evaluations[ply + 1],
+                expected_score_loss=loss,
+                classification=MoveClassification.from_expected_score_loss(loss),
+            )
+        )
+    return GameAnalysis(game=game, moves=analysed_moves)
+
+
+def export_game(game: chess.pgn.Game, output_file):
+    """Write the game, followed by the blank line separating it from the next one."""
+    game.accept(chess.pgn.FileExporter(output_file))
+
+
+async def analyse_pgn_file(
+    filename,
+    output_filename,
+    executable,
+    *,
+    workers,
+    limit,
+    variant_executable=None,
+    progress_callback=None,
+):
+    """
+    Analyse every game in `filename`, and write the annotated games to `output_filename`.
+    Games are appended to a temporary file as soon as they are done, which replaces
+    `output_filename` once the whole file is analysed, so that a cancelled or failed
+    analysis leaves no partial output behind.
+    Variant games are analysed with `variant_executable`, and skipped without it.
+    `progress_callback(game_number, done, total)` reports the positions of the current game.
+    Games are not kept once written out. Returns a `FileAnalysisStats`.
+    """
+    loop = asyncio.get_event_loop()
+    stats = FileAnalysisStats()
+    partial_filename = output_filename + ".analysing"
+    try:
+        async with contextlib.AsyncExitStack() as held_engines_stack:
+            # The workers are held for the whole file, rather than returned to the pool,
+            # which only keeps a few idle engines, and spawned again for every game
+            held_engines = {}
+            with open(filename, "r", encoding="utf-8", errors="replace") as pgn_file, open(
+                partial_filename, "w", encoding="utf-8"
+            ) as output_file:
+                while True:
+                    game = await loop.run_in_executor(
+                        THREADED_EXECUTOR, chess.pgn.read_game, pgn_file
+                    )
+                    if game is None:
+                        break
+                    game_number = stats.games + stats.skipped_games + 1
+                    uci_variant = game.board().uci_variant
+                    game_executable = executable if uci_variant == "chess" else variant_executable
+                    if game_executable is None:
+                        log.warning(f"Skipping game {game_number}, no engine can analyse {uci_variant}")
+                        stats.skipped_games += 1
+                        continue
+                    if game_executable not in held_engines:
+                        held_engines[game_executable] = await held_engines_stack.enter_async_context(
+                            hold_analysis_engines(game_executable, workers)
+                        )
+                    game_progress_callback = None
+                    if progress_callback is not None:
+                        game_progress_callback = functools.partial(progress_callback, game_number)
+                    analysis = await analyse_game(
+                        game,
+                        game_executable,
+                        workers=workers,
+                        limit=limit,
+                        progress_callback=game_progress_callback,
+                        engines=held_engines[game_executable],
+                    )
+                    await loop.run_in_executor(
+                        THREADED_EXECUTOR, export_game, analysis.annotate(), output_file
+                    )
+                    if stats.first_game_summary is None:
+                        stats.first_game_summary = analysis.summary
+                    stats.games += 1
+        os.replace(partial_filename, output_filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(partial_filename)
+        raise
+    return stats
@@ -0,0 +1,191 @@
+# coding: utf-8
+
+"""
+A pool of warm UCI engine processes shared by all boards.
+Engines run on the add-on's asyncio event loop, so all the methods of the pool
+are coroutines that must be awaited on `concurrency.ASYNCIO_EVENT_LOOP`.
+"""
+
+import time
+import subprocess
+import dataclasses
+from collections import defaultdict
+from logHandler import log
+from ..helpers import import_bundled
+
+
+with import_bundled():
+    import asyncio
+    import chess
+    import chess.engine
+
+
+ENGINE_COMMAND_TIMEOUT = 10.0
+IDLE_CHECK_INTERVAL = 30.0
+ENGINE_FAILURE_EXCEPTIONS = (chess.engine.EngineError, asyncio.TimeoutError, OSError)
+
+
+async def spawn_uci_engine(executable):
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    return await chess.engine.popen_uci(
+        executable,
+        creationflags=subprocess.CREATE_NO_WINDOW
+        | subprocess.CREATE_NEW_PROCESS_GROUP,
+        startupinfo=startupinfo,
+        close_fds=True,
+    )
+
+
+@dataclasses.dataclass
+class PooledEngine:
+    transport: asyncio.SubprocessTransport
+    executable: str
+    configured_options: tuple = ()
+
+
+class UCIEnginePool:
+    """
+    Keeps up to `max_idle` warm processes per engine executable.
+    Processes are started on demand, or ahead of the first game by `warm_up`,
+    and kept warm once their game ends. One warmed up process per executable
+    stays idle until the pool is shut down.
+    Engines (`chess.engine.UciProtocol` instances) are handed out with their
+    options reset to the defaults plus the requested options, and taken back
+    when a game ends. Callers should pass a new `game` object to `play` so that
+    the engine receives `ucinewgame`. Idle engines are health checked with `ping`
+    before reuse and closed after `idle_timeout` seconds.
+    """
+
+    def __init__(self, max_idle: int, idle_timeout: float):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle_engines = defaultdict(list)
+        self._engines = {}
+        self._kept_warm = set()
+        self._idle_check_handle = None
+        self._closed = False
+
+    async def warm_up(self, executables):
+        """Start an idle engine for each executable that has none."""
+        if self.max_idle < 1:
+            return
+        for executable in executables:
+            self._kept_warm.add(executable)
+            if self._idle_engines[executable]:
+                continue
+            try:
+                transport, engine = await spawn_uci_engine(executable)
+            except ENGINE_FAILURE_EXCEPTIONS:
+                log.exception(f"Failed to warm up {executable}")
+                continue
+            self._engines[engine] = PooledEngine(transport=transport, executable=executable)
+            await self.release(engine)
+
+    async def acquire(self, executable: str, uci_options: dict):
+        idle_engines = self._idle_engines[executable]
+        while idle_engines:
+            engine, __ = idle_engines.pop()
+            if await self._is_healthy(engine):
+                log.debug(f"Reusing a warm engine process for {executable}")
+                await self._configure(engine, uci_options)
+                return engine
+            await self._close_engine(engine)
+        transport, engine = await spawn_uci_engine(executable)
+        self._engines[engine] = PooledEngine(transport=transport, executable=executable)
+        await self._configure(engine, uci_options)
+        return engine
+
+    async def release(self, engine):
+        # Pinging stops any running command, such as a ponder search,
+        # so that idle engines do not keep burning CPU
+        pooled_engine = self._engines.get(engine)
+        if (
+            self._closed
+            or pooled_engine is None
+            or len(self._idle_engines[pooled_engine.executable]) >= self.max_idle
+            or not await self._is_healthy(engine)
+        ):
+            await self._close_engine(engine)
+            return
+        self._idle_engines[pooled_engine.executable].append((engine, time.monotonic()))
+        self._schedule_idle_check()
+
+    async def close_idle_engines(self, older_than=0.0):
+        now = time.monotonic()
+        expired = []
+        for executable, idle_engines in self._idle_engines.items():
+            kept = idle_engines[: self._get_kept_warm_count(executable)]
+            expirable = idle_engines[len(kept):]
+            expired.extend(
+                engine
+                for (engine, released_at) in expirable
+                if now - released_at >= older_than
+            )
+            idle_engines[:] = kept + [
+                (engine, released_at)
+                for (engine, released_at) in expirable
+                if now - released_at < older_than
+            ]
+        for engine in expired:
+            await self._close_engine(engine)
+
+    async def shutdown(self):
+        self._closed = True
+        if self._idle_check_handle is not None:
+            self._idle_check_handle.cancel()
+            self._idle_check_handle = None
+        for idle_engines in self._idle_engines.values():
+            idle_engines.clear()
+        # Quit the engines still held by boards and analysis workers too,
+        # so that no process outlives NVDA
+        await asyncio.gather(*(self._close_engine(engine) for engine in list(self._engines)))
+
+    async def _configure(self, engine, uci_options):
+        pooled_engine = self._engines[engine]
+        options = {
+            name: engine.options[name].default
+            for name in pooled_engine.configured_options
+            if name not in uci_options and name in engine.options
+        }
+        options.update(uci_options)
+        await asyncio.wait_for(engine.configure(options), ENGINE_COMMAND_TIMEOUT)
+        pooled_engine.configured_options = tuple(uci_options)
+
+    async def _is_healthy(self, engine):
+        if engine.returncode.done():
+            return False
+        try:
+            await asyncio.wait_for(engine.ping(), ENGINE_COMMAND_TIMEOUT)
+        except ENGINE_FAILURE_EXCEPTIONS:
+            log.exception("Engine process failed the health check")
+            return False
+        return True
+
+    async def _close_engine(self, engine):
+        pooled_engine = self._engines.pop(engine, None)
+        try:
+            await asyncio.wait_for(engine.quit(), ENGINE_COMMAND_TIMEOUT)
+        except ENGINE_FAILURE_EXCEPTIONS:
+            if pooled_engine is not None:
+                pooled_engine.transport.close()
+
+    def _schedule_idle_check(self):
+        if self._closed or self._idle_check_handle is not None:
+            return
+        self._idle_check_handle = asyncio.get_event_loop().call_later(
+            IDLE_CHECK_INTERVAL,
+            lambda: asyncio.ensure_future(self._on_idle_check()),
+        )
+
+    async def _on_idle_check(self):
+        self._idle_check_handle = None
+        await self.close_idle_engines(older_than=self.idle_timeout)
+        if any(
+            len(idle_engines) > self._get_kept_warm_count(executable)
+            for executable, idle_engines in self._idle_engines.items()
+        ):
+            self._schedule_idle_check()
+
+    def _get_kept_warm_count(self, executable):
+        return 1 if executable in self._kept_warm else 0
@@ -0,0 +1,171 @@
+# coding: utf-8
+
+"""
+An endgame tablebase stage that is consulted before the engine.
+Syzygy tables are preferred, with Gaviota tables as a fallback. The tables
+are opened once per process and shared by all boards.
+"""
+
+import threading
+from collections import OrderedDict
+from logHandler import log
+from ..helpers import import_bundled
+from ..settings import get_setting
+
+
+with import_bundled():
+    import chess
+    import chess.polyglot
+    import chess.syzygy
+    import chess.gaviota
+
+
+class EndgameTablebase:
+    """
+    Picks the DTZ-optimal move (or DTM-optimal when only Gaviota tables are
+    available) for positions with at most `tablebase_max_pieces` pieces.
+    Probe results are kept in an LRU cache keyed by the Zobrist hash of the
+    probed position, since every move choice probes all the child positions.
+    Probing blocks, so it should be done off the GUI thread and the event loop.
+    """
+
+    def __init__(self):
+        self._syzygy = None
+        self._gaviota = None
+        self._paths = None
+        self._probe_cache = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def open_tables(self):
+        """Open the configured tables, unless they are already open."""
+        paths = (get_setting("syzygy_path"), get_setting("gaviota_path"))
+        with self._lock:
+            if paths == self._paths:
+                return
+            self._close_tables()
+            self._paths = paths
+            syzygy_path, gaviota_path = paths
+            if syzygy_path:
+                try:
+                    self._syzygy = chess.syzygy.open_tablebase(syzygy_path)
+                except OSError:
+                    log.exception(f"Could not open syzygy tables at {syzygy_path}")
+            if gaviota_path:
+                try:
+                    self._gaviota = chess.gaviota.PythonTablebase()
+                    self._gaviota.add_directory(gaviota_path)
+                except OSError:
+                    self._gaviota = None
+                    log.exception(f"Could not open gaviota tables at {gaviota_path}")
+
+    def is_candidate(self, board: chess.Board):
+        return (
+            board.uci_variant == "chess"
+            and not board.chess960
+            and not board.castling_rights
+            and chess.popcount(board.occupied) <= get_setting("tablebase_max_pieces")
+        )
+
+    def probe_move(self, board: chess.Board):
+        """Return the best move according to the tables, or None to ask the engine."""
+        if not self.is_candidate(board):
+            return
+        with self._lock:
+            self.open_tables()
+            if self._syzygy is not None:
+                move = self._choose_move(board, self._probe_syzygy, self._dtz_move_key)
+                if move is not None:
+                    return move
+            if self._gaviota is not None:
+                return self._choose_move(board, self._probe_gaviota, self._dtm_move_key)
+
+    def _choose_move(self, board, probe_func, move_key):
+        scored_moves = []
+        for move in board.legal_moves:
+            is_zeroing = board.is_zeroing(move)
+            board.push(move)
+            try:
+                if board.is_checkmate():
+                    return move
+                result = probe_func(board)
+            finally:
+                board.pop()
+            if result is None:
+                return
+            scored_moves.append((move_key(result, is_zeroing), move))
+        if scored_moves:
+            return min(scored_moves, key=lambda scored_move: scored_move[0])[1]
+
+    @staticmethod
+    def _dtz_move_key(result, is_zeroing):
+        # The result is from the opponent's point of view,
+        # so the lower the WDL value the better the move
+        wdl, dtz = result
+        if wdl < 0:
+            return (wdl, not is_zeroing, abs(dtz))
+        return (wdl, 0, -abs(dtz))
+
+    @staticmethod
+    def _dtm_move_key(result, is_zeroing):
+        dtm = result
+        if dtm < 0:
+            return (-1, abs(dtm))
+        elif dtm == 0:
+            return (0, 0)
+        return (1, -dtm)
+
+    def _probe_syzygy(self, board):
+        return self._cached_probe(
+            ("syzygy", chess.polyglot.zobrist_hash(board)),
+            lambda: (self._syzygy.probe_wdl(board), self._syzygy.probe_dtz(board)),
+        )
+
+    def _probe_gaviota(self, board):
+        return self._cached_probe(
+            ("gaviota", chess.polyglot.zobrist_hash(board)),
+            lambda: self._gaviota.probe_dtm(board),
+        )
+
+    def _cached_probe(self, key, probe):
+        try:
+            result = self._probe_cache[key]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._probe_cache.move_to_end(key)
+            return result
+        try:
+            result = probe()
+        except KeyError:
+            result = None
+        self._probe_cache[key] = result
+        while len(self._probe_cache) > get_setting("tablebase_cache_size"):
+            self._probe_cache.popitem(last=False)
+        return result
+
+    def clear_cache(self):
+        with self._lock:
+            self._probe_cache.clear()
+
+    def close(self):
+        with self._lock:
+            self._close_tables()
+            self._paths = None
+
+    def _close_tables(self):
+        for tables in (self._syzygy, self._gaviota):
+            if tables is not None:
+                tables.close()
+        self._syzygy = self._gaviota = None
+        self._probe_cache.clear()
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (
+            f"{len(self._probe_cache)} cached probes, hit rate {hit_rate:.0%} "
+            f"({self.hits} hits, {self.misses} misses)"
+        )
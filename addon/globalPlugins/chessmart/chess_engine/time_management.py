@@ -0,0 +1,104 @@
+# coding: utf-8
+
+"""Per move time budgets for the engine, derived from the game clocks."""
+
+import dataclasses
+from ..helpers import import_bundled
+from ..time_control import ChessTimeControl, NullChessTimeControl
+
+
+with import_bundled():
+    import chess
+
+
+# Moves the game is expected to last from the current move,
+# never planning for fewer than MIN_MOVES_TO_GO moves
+EXPECTED_GAME_LENGTH = 50
+MIN_MOVES_TO_GO = 15
+# Share of the increment spent on the current move
+INCREMENT_USAGE = 0.8
+# Legal move count of a typical middle game position, and the range
+# of the adjustment made for simpler or more complex positions
+TYPICAL_LEGAL_MOVE_COUNT = 30
+MIN_COMPLEXITY_FACTOR = 0.6
+MAX_COMPLEXITY_FACTOR = 1.5
+# The hard deadline is a multiple of the soft budget, but never more
+# than a share of the remaining time
+HARD_DEADLINE_FACTOR = 3.0
+MAX_REMAINING_TIME_SHARE = 0.2
+MIN_MOVE_TIME = 0.05
+# On top of the reserved time, the hard deadline leaves the engine this long
+# past its soft budget, so that it only fires on a search that hangs
+HARD_DEADLINE_MARGIN = 0.1
+# Weight of a new measurement in the moving average of the IPC latency
+LATENCY_SMOOTHING = 0.2
+
+
+@dataclasses.dataclass
+class TimeBudget:
+    """
+    `soft` is the search time given to the engine, in seconds.
+    `hard` is the deadline after which the search is stopped and the best move so far is played.
+    """
+
+    soft: float
+    hard: float
+
+
+class EngineTimeManager:
+    """
+    Splits the remaining clock time of the engine into per move budgets.
+    The budget of a move is the remaining time spread over the moves expected
+    to be left in the game, plus most of the increment, scaled by how complex
+    the position is. The `move_overhead` of the engine and the measured IPC
+    latency are reserved so that the reply reaches the board before the flag falls.
+    """
+
+    def __init__(self, default_move_time: float, move_overhead: float):
+        self.default_move_time = default_move_time
+        self.move_overhead = move_overhead
+        self.ipc_latency = 0.0
+
+    def record_ipc_latency(self, wall_time: float, engine_time: float):
+        """Update the latency estimate from the wall time of a search and the time reported by the engine."""
+        latency = wall_time - engine_time
+        if latency < 0:
+            return
+        self.ipc_latency += LATENCY_SMOOTHING * (latency - self.ipc_latency)
+
+    @property
+    def reserved_time(self):
+        return self.move_overhead + self.ipc_latency
+
+    @staticmethod
+    def get_complexity_factor(board: chess.Board):
+        legal_move_count = board.legal_moves.count()
+        if legal_move_count <= 1:
+            return 0.0
+        factor = legal_move_count / TYPICAL_LEGAL_MOVE_COUNT
+        if board.is_check():
+            factor *= 0.5
+        return min(MAX_COMPLEXITY_FACTOR, max(MIN_COMPLEXITY_FACTOR, factor))
+
+    def allocate(self, board: chess.Board, time_control: ChessTimeControl) -> TimeBudget:
+        if isinstance(time_control, NullChessTimeControl):
+            return self._make_budget(
+                self.default_move_time,
+                self.default_move_time * HARD_DEADLINE_FACTOR,
+            )
+        clock = time_control.chess_clocks[board.turn]
+        remaining = max(0.0, clock.remaining - self.reserved_time)
+        moves_to_go = max(MIN_MOVES_TO_GO, EXPECTED_GAME_LENGTH - board.fullmove_number)
+        base_time = remaining / moves_to_go + clock.increment * INCREMENT_USAGE
+        hard_limit = max(MIN_MOVE_TIME, remaining * MAX_REMAINING_TIME_SHARE)
+        soft = min(hard_limit, base_time * self.get_complexity_factor(board))
+        hard = min(hard_limit, max(soft, base_time) * HARD_DEADLINE_FACTOR)
+        return self._make_budget(soft, hard)
+
+    def _make_budget(self, soft, hard):
+        """The engine replies about `reserved_time` after its search time is up,
+        so the soft budget is cut to leave that, and a margin, before the hard deadline.
+        """
+        slack = self.reserved_time + HARD_DEADLINE_MARGIN
+        soft = max(MIN_MOVE_TIME, min(soft, hard - slack))
+        return TimeBudget(soft=soft, hard=max(hard, soft + slack))
@@ -2,16 +2,18 @@
 
 import os
 import math
-import subprocess
+import time
+import threading
+import functools
 import wx
 import wx.adv
 import tones
 import queueHandler
 import eventHandler
 import gui
-from io import BytesIO
+from logHandler import log
 from .game_elements import GameInfo
-from .helpers import import_bundled, BIN_DIRECTORY, GameSound
+from .helpers import import_bundled, GameSound
 from .signals import (
     chessboard_opened_signal,
     chessboard_closed_signal,
@@ -19,6 +21,16 @@ from .signals import (
 )
 from .time_control import ChessTimeControl
 from .concurrency import call_threaded
+from .settings import get_setting
+from .board_svg import BoardSVGTemplate
+from .board_rendering import (
+    BoardRenderingError,
+    RenderTimings,
+    BoardCompositor,
+    BoardImageCache,
+    get_board_renderer,
+    FALLBACK_BOARD_RENDERER,
+)
 
 
 with import_bundled():
@@ -28,9 +40,7 @@ with import_bundled():
 
 
 TIME_CHECK_INTERVAL = 1000
-RSVG_CONVERT_EXECUTABLE = os.path.join(
-    BIN_DIRECTORY, "rsvg_convert", "rsvg_convert.exe"
-)
+BOARD_IMAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
 BOARD_COLOR_MAP = {
     "square light": "#ff7187fe",
     "square dark": "#cd3721ff",
@@ -39,6 +49,96 @@ BOARD_COLOR_MAP = {
     "margin": "",
     "coord": "",
 }
+# Shared by all boards, since the same positions come up in replays and puzzle retries
+BOARD_IMAGE_CACHE = BoardImageCache(max_bytes=BOARD_IMAGE_CACHE_MAX_BYTES)
+BOARD_SVG_TEMPLATE = BoardSVGTemplate(BOARD_COLOR_MAP)
+
+
+class BoardRenderScheduler:
+    """Coalesces board image requests so that the latest one wins.
+    At most one render is in flight and one is pending; a new request replaces
+    the pending one. Every request is tagged with a generation number, so a frame
+    older than the one on screen is never painted.
+    A request may carry its own `render_func` and `paint_func`, for frames that are
+    produced differently, so that they are coalesced with the others.
+    """
+
+    def __init__(self, render_func, paint_func):
+        self.render_func = render_func
+        self.paint_func = paint_func
+        self.generation = 0
+        self.painted_generation = 0
+        self.requested_count = 0
+        self.coalesced_count = 0
+        self.rendered_count = 0
+        self._lock = threading.Lock()
+        self._in_flight = False
+        self._pending = None
+
+    def submit(self, *render_args, request_time=None, render_func=None, paint_func=None):
+        with self._lock:
+            self.generation += 1
+            self.requested_count += 1
+            job = (
+                self.generation,
+                request_time,
+                render_func or self.render_func,
+                paint_func or self.paint_func,
+                render_args,
+            )
+            if self._in_flight:
+                if self._pending is not None:
+                    self.coalesced_count += 1
+                self._pending = job
+                return
+            self._in_flight = True
+        self._start(job)
+
+    def supersede(self):
+        """Claim a new generation for a frame painted outside the scheduler.
+        Drops the pending request, if any, since it is now outdated.
+        Returns the claimed generation.
+        """
+        with self._lock:
+            self.generation += 1
+            self.requested_count += 1
+            if self._pending is not None:
+                self.coalesced_count += 1
+                self._pending = None
+            return self.generation
+
+    def is_stale(self, generation):
+        return generation < self.painted_generation
+
+    def mark_painted(self, generation):
+        self.painted_generation = max(self.painted_generation, generation)
+
+    def _start(self, job):
+        generation, request_time, render_func, paint_func, render_args = job
+        future = render_func(*render_args)
+        if future is None:
+            with self._lock:
+                self._in_flight = False
+                self._pending = None
+            return
+        future.add_done_callback(
+            functools.partial(self._on_render_done, generation, request_time, paint_func)
+        )
+
+    def _on_render_done(self, generation, request_time, paint_func, future):
+        with self._lock:
+            self.rendered_count += 1
+            next_job, self._pending = self._pending, None
+            self._in_flight = next_job is not None
+        if next_job is not None:
+            self._start(next_job)
+        paint_func(future, generation, request_time)
+
+    def __str__(self):
+        return (
+            f"{self.requested_count} requested, {self.coalesced_count} coalesced, "
+            f"{self.rendered_count} rendered"
+        )
 
 
 class ChessboardDialog(wx.Frame):
@@ -58,6 +158,16 @@ class ChessboardDialog(wx.Frame):
         self.SetSize(size)
         self.CenterOnScreen()
         self.bitmap_buffer = wx.EmptyBitmap(*size)
+        self.board_renderer = get_board_renderer(get_setting("board_renderer"))
+        # Guards switching to the fallback renderer, which happens on a render thread
+        self._board_renderer_lock = threading.Lock()
+        self.render_timings = RenderTimings()
+        self.board_compositor = BoardCompositor(
+            self.width, BOARD_COLOR_MAP, self.rasterize, image_cache=BOARD_IMAGE_CACHE
+        )
+        self.render_scheduler = BoardRenderScheduler(
+            self._render_board_image, self.set_background_image
+        )
         self.Bind(wx.EVT_PAINT, self.onPaint, self)
         self.Bind(wx.EVT_CLOSE, self.onClose, self)
         # Setup the board
@@ -94,11 +204,9 @@ class ChessboardDialog(wx.Frame):
     def get_board_svg(self, board=None, **chess_svg_kwargs):
         if "flipped" not in chess_svg_kwargs:
             chess_svg_kwargs["flipped"] = self.chessboard.is_board_visually_flipped
-        return chess.svg.board(
-            board or self.chessboard.board,
-            colors=BOARD_COLOR_MAP,
-            **chess_svg_kwargs
-        ).encode("utf-8")
+        return BOARD_SVG_TEMPLATE.render_any(
+            board or self.chessboard.board, **chess_svg_kwargs
+        )
 
     def onPaint(self, event):
         dc = wx.BufferedPaintDC(self)
@@ -142,37 +250,121 @@ class ChessboardDialog(wx.Frame):
         wx.adv.Sound(sound.filename).Play(wx.adv.SOUND_ASYNC)
 
     def set_board_image(self, **chess_svg_kwargs):
+        request_time = time.perf_counter()
+        chess_svg_kwargs.setdefault(
+            "flipped", self.chessboard.is_board_visually_flipped
+        )
+        if BoardCompositor.can_compose(**chess_svg_kwargs):
+            # Composed frames are coalesced with the rendered ones, latest wins
+            self.render_scheduler.submit(
+                self.chessboard.board.copy(stack=False),
+                chess_svg_kwargs,
+                request_time=request_time,
+                render_func=self._render_board_tiles,
+                paint_func=self.set_composed_image,
+            )
+            return
+        chess_svg_kwargs.setdefault("board", self.chessboard.board)
+        cache_key = BOARD_IMAGE_CACHE.make_key(size=self.width, **chess_svg_kwargs)
+        cached_image_data = BOARD_IMAGE_CACHE.get(cache_key)
+        if cached_image_data is not None:
+            generation = self.render_scheduler.supersede()
+            self._set_bitmap_data(cached_image_data, generation, request_time)
+            return
         board_svg_bytes = self.get_board_svg(**chess_svg_kwargs)
-        self._get_png_from_svg(board_svg_bytes).add_done_callback(self.set_background_png)
+        self.render_scheduler.submit(
+            board_svg_bytes, cache_key, request_time=request_time
+        )
 
     @call_threaded
-    def _get_png_from_svg(self, board_svg_bytes):
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        return subprocess.run(
-            [
-                RSVG_CONVERT_EXECUTABLE,
-                "-f",
-                "png",
-                "-w",
-                str(self.width),
-                "-h",
-                str(self.height),
-            ],
-            input=board_svg_bytes,
-            capture_output=True,
-            startupinfo=startupinfo,
+    def _render_board_tiles(self, board, chess_svg_kwargs):
+        rendered_tiles = self.board_compositor.render_tiles(board, **chess_svg_kwargs)
+        return rendered_tiles, board, chess_svg_kwargs
+
+    def set_composed_image(self, future, generation, request_time):
+        try:
+            rendered_tiles, board, chess_svg_kwargs = future.result()
+        except Exception:
+            # Runs as a future callback, so nothing above would handle the error
+            log.exception("Failed to render the board tiles")
+            return
+        wx.CallAfter(
+            self._compose_board_image, rendered_tiles, board, chess_svg_kwargs, generation, request_time
         )
 
-    def set_background_png(self, future):
-        sp_result = future.result()
-        if sp_result.returncode != 0:
-            log.exception("Failed to convert svg to png.\n{sp_result.stderr}")
+    def _compose_board_image(self, rendered_tiles, board, chess_svg_kwargs, generation, request_time):
+        if self.render_scheduler.is_stale(generation):
             return
-        board_image = wx.Image(BytesIO(sp_result.stdout))
-        wx.CallAfter(self._set_bitmap_data, board_image.GetData())
+        try:
+            self.board_compositor.add_tiles(rendered_tiles)
+            dirty_rects = self.board_compositor.compose(
+                self.bitmap_buffer, board, **chess_svg_kwargs
+            )
+        except BoardRenderingError:
+            log.exception("Failed to compose the board image")
+            return
+        self.render_scheduler.mark_painted(generation)
+        for rect in dirty_rects:
+            self.RefreshRect(rect, eraseBackground=False)
+        self.Update()
+        self.render_timings.add(time.perf_counter() - request_time)
+        self._log_render_stats()
 
-    def _set_bitmap_data(self, data):
+    def rasterize(self, svg_bytes, width, height):
+        """Render with the configured renderer, switching to the fallback one for good if it fails.
+        Safe to call from any thread.
+        """
+        renderer = self.board_renderer
+        try:
+            return renderer.render(svg_bytes, width, height)
+        except BoardRenderingError:
+            if renderer.name == FALLBACK_BOARD_RENDERER:
+                raise
+            with self._board_renderer_lock:
+                if self.board_renderer is renderer:
+                    log.exception(
+                        f"Board renderer {renderer.name} failed. "
+                        f"Falling back to {FALLBACK_BOARD_RENDERER}"
+                    )
+                    self.board_renderer = get_board_renderer(FALLBACK_BOARD_RENDERER)
+                renderer = self.board_renderer
+            return renderer.render(svg_bytes, width, height)
+
+    def set_board_renderer(self, name):
+        """Switch to another renderer. Frames being rendered on other threads finish with the old one."""
+        with self._board_renderer_lock:
+            self.board_renderer = get_board_renderer(name)
+
+    @call_threaded
+    def _render_board_image(self, board_svg_bytes, cache_key):
+        image_data = self.rasterize(board_svg_bytes, self.width, self.height)
+        BOARD_IMAGE_CACHE.put(cache_key, image_data)
+        return image_data
+
+    def set_background_image(self, future, generation, request_time):
+        try:
+            board_image_data = future.result()
+        except Exception:
+            # Runs as a future callback, so nothing above would handle the error
+            log.exception("Failed to render the board image")
+            return
+        wx.CallAfter(self._set_bitmap_data, board_image_data, generation, request_time)
+
+    def _set_bitmap_data(self, data, generation, request_time=None):
+        if self.render_scheduler.is_stale(generation):
+            return
+        self.render_scheduler.mark_painted(generation)
         self.bitmap_buffer.CopyFromBuffer(data)
+        self.board_compositor.invalidate()
         self.Refresh(eraseBackground=False)
         self.Update()
+        if request_time is not None:
+            self.render_timings.add(time.perf_counter() - request_time)
+            self._log_render_stats()
+
+    def _log_render_stats(self):
+        log.debug(
+            f"Board painted using {self.board_renderer.name}: {self.render_timings}. "
+            f"Render requests: {self.render_scheduler}. "
+            f"Image cache: {BOARD_IMAGE_CACHE}"
+        )
@@ -1,5 +1,6 @@
 # coding: utf-8
 
+import sys
 import threading
 import typing as t
 from functools import wraps
@@ -13,7 +14,10 @@ with import_bundled():
 
 
 THREADED_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="chessmart")
-ASYNCIO_EVENT_LOOP = asyncio.new_event_loop()
+# Subprocesses, such as chess engines, need a proactor event loop on Windows
+ASYNCIO_EVENT_LOOP = (
+    asyncio.ProactorEventLoop() if sys.platform == "win32" else asyncio.new_event_loop()
+)
 ASYNCIO_LOOP_THREAD = None
 
 
@@ -0,0 +1,381 @@
+# coding: utf-8
+
+"""
+Benchmarks and consistency checks for development.
+Run them from NVDA's Python console, with the add-on loaded from a source
+checkout, e.g. `from globalPlugins.chessmart import diagnostics`.
+This module is left out of the add-on bundle, see `excludedFiles` in `buildVars.py`.
+"""
+
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+import wx
+from logHandler import log
+from .helpers import import_bundled
+from .board_rendering import (
+    BOARD_RENDERERS,
+    BOARD_MARGIN,
+    SQUARE_SIZE,
+    BoardRenderer,
+    BoardRenderingError,
+    RenderTimings,
+)
+from .chessboard import BOARD_IMAGE_CACHE, BOARD_SVG_TEMPLATE
+from .chess_engine import ENDGAME_TABLEBASE
+from .puzzle_database import (
+    PuzzleSet,
+    PuzzleInfo,
+    Puzzle,
+    PackedPuzzle,
+    Theme,
+    PuzzleTheme,
+    PuzzleThemeMask,
+    any_theme,
+    all_themes,
+    fn,
+    decode_moves,
+    decode_board,
+    database,
+    MAX_SQLITE_INTEGER,
+    PUZZLE_PAGE_SIZE,
+    PlayerRating,
+)
+
+
+with import_bundled():
+    import chess
+    import chess.svg
+
+
+FRAME_POLL_INTERVAL = 10
+FRAME_TIMEOUT = 10.0
+ARROW_COLORS = ("green", "red", "yellow", "blue")
+
+
+def count_square_colors(rgb_data: bytes, size: int, square: chess.Square):
+    """Count the distinct colors inside a square of an unflipped board image of size x size."""
+    scale = size / (8 * SQUARE_SIZE + 2 * BOARD_MARGIN)
+    # Stay clear of the anti-aliased square edges
+    inset = SQUARE_SIZE // 10
+    left = round((BOARD_MARGIN + chess.square_file(square) * SQUARE_SIZE + inset) * scale)
+    top = round((BOARD_MARGIN + (7 - chess.square_rank(square)) * SQUARE_SIZE + inset) * scale)
+    extent = round((SQUARE_SIZE - 2 * inset) * scale)
+    colors = set()
+    for y in range(top, top + extent):
+        row_start = (y * size + left) * 3
+        row = rgb_data[row_start : row_start + extent * 3]
+        colors.update(row[i : i + 3] for i in range(0, len(row), 3))
+    return len(colors)
+
+
+def check_board_renderer(renderer: BoardRenderer, size=390):
+    """Render the starting position, and check that the pieces were drawn.
+    Raises `BoardRenderingError` if the square of the white king is as plain as an empty square.
+    """
+    svg_bytes = chess.svg.board(chess.Board(), size=size).encode("utf-8")
+    rgb_data = renderer.render(svg_bytes, size, size)
+    empty_square_colors = count_square_colors(rgb_data, size, chess.E4)
+    king_square_colors = count_square_colors(rgb_data, size, chess.E1)
+    if king_square_colors <= empty_square_colors:
+        raise BoardRenderingError(
+            f"Renderer {renderer.name} did not draw the pieces: "
+            f"{king_square_colors} colors on e1, {empty_square_colors} on e4"
+        )
+    log.info(f"Renderer {renderer.name} drew the pieces: {king_square_colors} colors on e1")
+
+
+def benchmark_board_renderers(dialog, frames=20, done_callback=None):
+    """
+    Time every renderer from the board image request to the painted board, in
+    `dialog`, a `ChessboardDialog` with a game open. Frames carry an arrow, so
+    they are rendered whole rather than composed, and the shared image cache is
+    cleared before each of them. Frames are requested one at a time on the GUI
+    thread; renderers that fail `check_board_renderer` are skipped.
+    Once done, the configured renderer is restored, and a dict mapping renderer
+    names to `RenderTimings` is logged and passed to `done_callback`.
+    """
+    configured_renderer = dialog.board_renderer.name
+    renderer_names = []
+    for name, renderer_cls in BOARD_RENDERERS.items():
+        try:
+            check_board_renderer(renderer_cls())
+        except Exception:
+            log.exception(f"Renderer {name} failed")
+            continue
+        renderer_names.append(name)
+    results = {}
+    arrows = [chess.svg.Arrow(chess.E2, chess.E4)]
+
+    def start_renderer(remaining_names):
+        if not remaining_names:
+            dialog.set_board_renderer(configured_renderer)
+            log.info(f"Board renderers: {results}")
+            if done_callback is not None:
+                done_callback(results)
+            return
+        dialog.set_board_renderer(remaining_names[0])
+        dialog.render_timings = RenderTimings()
+        request_frame(remaining_names)
+
+    def request_frame(remaining_names):
+        BOARD_IMAGE_CACHE.clear()
+        dialog.set_board_image(arrows=arrows)
+        wait_for_frame(remaining_names, dialog.render_timings.count + 1, time.perf_counter())
+
+    def wait_for_frame(remaining_names, painted_count, requested_at):
+        name = remaining_names[0]
+        timings = dialog.render_timings
+        if timings.count < painted_count:
+            if time.perf_counter() - requested_at < FRAME_TIMEOUT:
+                wx.CallLater(
+                    FRAME_POLL_INTERVAL, wait_for_frame, remaining_names, painted_count, requested_at
+                )
+                return
+            log.error(f"Renderer {name} did not paint a frame in {FRAME_TIMEOUT} seconds")
+        elif timings.count < frames:
+            request_frame(remaining_names)
+            return
+        results[name] = timings
+        log.info(f"Board renderer {name}: {timings}")
+        start_renderer(remaining_names[1:])
+
+    start_renderer(renderer_names)
+
+
+def benchmark_board_svg(board, iterations=200, template=BOARD_SVG_TEMPLATE, **chess_svg_kwargs):
+    """Compare the per call time of the template with `chess.svg.board`.
+    Returns a tuple of (template seconds per call, chess.svg seconds per call).
+    """
+    start = time.perf_counter()
+    for i in range(iterations):
+        template.render(board, **chess_svg_kwargs)
+    template_time = (time.perf_counter() - start) / iterations
+    start = time.perf_counter()
+    for i in range(iterations):
+        chess.svg.board(board, colors=template.colors, **chess_svg_kwargs).encode("utf-8")
+    etree_time = (time.perf_counter() - start) / iterations
+    return template_time, etree_time
+
+
+def random_board_svg_options(rng: random.Random):
+    """A position reached by random moves, with the kind of options the add-on passes."""
+    board = chess.Board()
+    for i in range(rng.randrange(80)):
+        legal_moves = list(board.legal_moves)
+        if not legal_moves:
+            break
+        board.push(rng.choice(legal_moves))
+    chess_svg_kwargs = {"flipped": rng.random() < 0.5}
+    if board.move_stack and rng.random() < 0.7:
+        chess_svg_kwargs["lastmove"] = board.peek()
+    if rng.random() < 0.5:
+        chess_svg_kwargs["arrows"] = [
+            # Same-square arrows are the highlight circles
+            chess.svg.Arrow(
+                tail, rng.choice((tail, rng.choice(chess.SQUARES))), color=rng.choice(ARROW_COLORS)
+            )
+            for tail in rng.sample(chess.SQUARES, rng.randint(1, 3))
+        ]
+    if rng.random() < 0.5:
+        chess_svg_kwargs["size"] = rng.choice((390, 900))
+    return board, chess_svg_kwargs
+
+
+def check_board_svg_template(positions=500, seed=None, template=BOARD_SVG_TEMPLATE):
+    """
+    Check that `template.render_any` gives the same bytes as
+    `chess.svg.board(...).encode("utf-8")` for random positions, last moves,
+    arrows, and both orientations. Returns the (FEN, options) that differ.
+    """
+    rng = random.Random(seed)
+    mismatches = []
+    for i in range(positions):
+        board, chess_svg_kwargs = random_board_svg_options(rng)
+        expected = chess.svg.board(board, colors=template.colors, **chess_svg_kwargs).encode("utf-8")
+        if template.render_any(board, **chess_svg_kwargs) != expected:
+            mismatches.append((board.fen(), chess_svg_kwargs))
+    if mismatches:
+        log.error(f"The board SVG template differs from chess.svg on {len(mismatches)} of {positions} positions")
+    else:
+        log.info(f"The board SVG template matches chess.svg on {positions} positions")
+    return mismatches
+
+
+def benchmark_tablebase_probes(boards, iterations=5, tablebase=ENDGAME_TABLEBASE):
+    """Time choosing a move for every board, with a cold and a warm probe cache.
+    Returns a tuple of (cold seconds per move, cached seconds per move).
+    """
+    tablebase.clear_cache()
+    start = time.perf_counter()
+    for board in boards:
+        tablebase.probe_move(board.copy())
+    cold_time = (time.perf_counter() - start) / len(boards)
+    start = time.perf_counter()
+    for i in range(iterations):
+        for board in boards:
+            tablebase.probe_move(board.copy())
+    cached_time = (time.perf_counter() - start) / (len(boards) * iterations)
+    return cold_time, cached_time
+
+
+def benchmark_puzzle_set_loading(classifiers, counts=(10, 50, 100, 500)):
+    """Time loading puzzle sets of increasing size, with per puzzle theme queries and with the batched loader.
+    Returns a dict mapping puzzle counts to tuples of (per puzzle queries seconds, batched seconds).
+    """
+    Theme.get_all_by_id()
+    puzzle_set = PuzzleSet(classifiers=tuple(classifiers))
+    results = {}
+    for count in counts:
+        start = time.perf_counter()
+        [PuzzleInfo.from_database_puzzle(puzzle) for puzzle in puzzle_set.get_puzzle_query().limit(count)]
+        per_puzzle_time = time.perf_counter() - start
+        start = time.perf_counter()
+        PuzzleInfo.from_database_puzzles(puzzle_set.get_puzzle_query().limit(count))
+        batched_time = time.perf_counter() - start
+        results[count] = (per_puzzle_time, batched_time)
+    return results
+
+
+def benchmark_theme_filters(classifiers=("fork", "pin"), repeat=3):
+    """Time finding all the puzzles with any and with all of the classifiers,
+    joining puzzle_theme and theme, and scanning the theme bitsets.
+    Returns a dict mapping "any" and "all" to tuples of (join seconds, bitset seconds, puzzle count).
+    Best run against the full puzzle database.
+    """
+    classifiers = tuple(classifiers)
+    theme_ids = (
+        PuzzleTheme.select(PuzzleTheme.puzzle)
+        .join(Theme)
+        .where(Theme.slug.in_(classifiers))
+    )
+    join_queries = {
+        "any": theme_ids.distinct(),
+        "all": theme_ids.group_by(PuzzleTheme.puzzle).having(fn.COUNT(Theme.id) == len(classifiers)),
+    }
+    theme_filters = {
+        "any": any_theme(*classifiers),
+        "all": all_themes(*classifiers),
+    }
+    results = {}
+    for (name, join_query) in join_queries.items():
+        mask_query = PuzzleThemeMask.select(PuzzleThemeMask.puzzle_id).where(theme_filters[name].to_expression())
+        timings = []
+        for query in (join_query, mask_query):
+            start = time.perf_counter()
+            for i in range(repeat):
+                count = len(list(query.tuples()))
+            timings.append((time.perf_counter() - start) / repeat)
+        results[name] = (*timings, count)
+    return results
+
+
+def benchmark_puzzle_decoding(count=1000, repeat=3):
+    """Compare decoding puzzle moves and starting boards from the text columns and from the packed columns.
+    Returns a tuple of (text puzzles per second, packed puzzles per second).
+    """
+    rows = list(
+        Puzzle.select(Puzzle.fen, Puzzle.moves, PackedPuzzle.moves, PackedPuzzle.board)
+        .join(PackedPuzzle, on=(PackedPuzzle.puzzle_id == Puzzle.id))
+        .limit(count)
+        .tuples()
+    )
+    start = time.perf_counter()
+    for i in range(repeat):
+        for (fen, moves, __, __) in rows:
+            [chess.Move.from_uci(move) for move in moves.split()]
+            chess.Board(fen)
+    text_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(repeat):
+        for (__, __, packed_moves, packed_board) in rows:
+            decode_moves(packed_moves)
+            decode_board(packed_board)
+    packed_time = time.perf_counter() - start
+    decoded = len(rows) * repeat
+    return decoded / text_time, decoded / packed_time
+
+
+def benchmark_concurrent_puzzle_loads(classifiers=("mate",), thread_counts=(1, 2, 4), pages_per_thread=100):
+    """Load pages of puzzles from several threads at once, each using its own connection.
+    Returns a dict mapping thread counts to pages loaded per second.
+    """
+    puzzle_set = PuzzleSet(classifiers=tuple(classifiers))
+
+    def load_pages():
+        for i in range(pages_per_thread):
+            rating = random.randint(600, 2800)
+            puzzle_set.get_page((rating - 1, MAX_SQLITE_INTEGER, MAX_SQLITE_INTEGER), None, PUZZLE_PAGE_SIZE)
+
+    results = {}
+    for thread_count in thread_counts:
+        with ThreadPoolExecutor(thread_count) as executor:
+            # Open the connections before timing
+            list(executor.map(lambda i: Theme.get_all_by_id() and database.connect(reuse_if_open=True), range(thread_count)))
+            start = time.perf_counter()
+            for future in [executor.submit(load_pages) for i in range(thread_count)]:
+                future.result()
+            results[thread_count] = thread_count * pages_per_thread / (time.perf_counter() - start)
+    return results
+
+
+def check_puzzle_set_coverage(classifiers, page_size=PUZZLE_PAGE_SIZE):
+    """Page through a whole lap of the puzzle set from the player's rating, and check
+    that every matching puzzle is served exactly once, including those below the window.
+    Returns a tuple of (number of puzzles served, problems found).
+    """
+    puzzle_set = PuzzleSet(classifiers=tuple(classifiers))
+    served_ids = []
+    after = None
+    while True:
+        page = puzzle_set.fetch_page(after, page_size)
+        if not page:
+            break
+        served_ids.extend(puzzle.puzzle_id for puzzle in page)
+        after = page[-1].keyset
+    if PuzzleThemeMask.is_available():
+        expected_ids = {puzzle_id for (puzzle_id,) in puzzle_set.get_theme_mask_query().tuples()}
+    else:
+        expected_ids = {puzzle.id for puzzle in puzzle_set.get_puzzle_query()}
+    problems = []
+    if len(served_ids) != len(set(served_ids)):
+        problems.append(f"{len(served_ids) - len(set(served_ids))} puzzles were served twice")
+    if expected_ids - set(served_ids):
+        problems.append(f"{len(expected_ids - set(served_ids))} puzzles were never served")
+    if set(served_ids) - expected_ids:
+        problems.append(f"{len(set(served_ids) - expected_ids)} puzzles do not belong to the set")
+    for problem in problems:
+        log.error(f"Puzzle set {puzzle_set.get_identifier()}: {problem}")
+    return len(served_ids), problems
+
+
+def explain_query_plan(query):
+    sql, params = query.sql()
+    return [row[-1] for row in database.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def check_query_plans(classifiers=("mate",)):
+    """Check that puzzle selection is served by the covering indexes created by `create_indexes`.
+    Returns a tuple of (theme set plan, rating window plan, problems found).
+    """
+    min_rating, max_rating = PlayerRating().target_window
+    theme_set_plan = explain_query_plan(
+        PuzzleSet(classifiers=tuple(classifiers))
+        .get_puzzle_query((min_rating - 1, MAX_SQLITE_INTEGER, MAX_SQLITE_INTEGER), max_rating)
+        .limit(PUZZLE_PAGE_SIZE)
+    )
+    rating_window_plan = explain_query_plan(
+        Puzzle.select(Puzzle.id).where(Puzzle.rating.between(min_rating, max_rating))
+    )
+    problems = []
+    if not any("INDEX puzzle_rating_popularity_id" in step for step in theme_set_plan):
+        problems.append("Theme set pages do not use the keyset index")
+    if not any("COVERING INDEX puzzletheme_" in step for step in theme_set_plan):
+        problems.append("Theme set pages do not look up themes with a covering index")
+    if any("TEMP B-TREE" in step for step in theme_set_plan):
+        problems.append("Theme set pages are sorted in a temporary b-tree")
+    if not any("COVERING INDEX puzzle_rating_popularity_id" in step for step in rating_window_plan):
+        problems.append("The rating window is not selected with the covering keyset index")
+    for problem in problems:
+        log.error(problem)
+    return theme_set_plan, rating_window_plan, problems
@@ -0,0 +1,94 @@
+# coding: utf-8
+
+import wx
+import ui
+from .components import SimpleDialog
+
+
+# Wait for a pause in typing before filtering
+FILTER_DELAY = 300
+GAME_LIST_COLUMNS = (
+    ("White", _("White"), 180),
+    ("Black", _("Black"), 180),
+    ("Event", _("Event"), 220),
+    ("Date", _("Date"), 100),
+    ("Result", _("Result"), 70),
+)
+
+
+class VirtualGameList(wx.ListCtrl):
+    """A virtual list control showing the games of a `PGNGameSource`."""
+
+    def __init__(self, parent, game_source, **kwargs):
+        super().__init__(
+            parent,
+            style=wx.LC_REPORT | wx.LC_VIRTUAL | wx.LC_SINGLE_SEL,
+            **kwargs
+        )
+        self.game_source = game_source
+        for (index, (__, label, width)) in enumerate(GAME_LIST_COLUMNS):
+            self.InsertColumn(index, label, width=width)
+        self.RefreshGames()
+
+    def RefreshGames(self):
+        self.SetItemCount(len(self.game_source))
+        if len(self.game_source):
+            self.Select(0)
+            self.Focus(0)
+        self.Refresh()
+
+    def OnGetItemText(self, item, column):
+        __, headers = self.game_source.get_game(item)
+        return headers.get(GAME_LIST_COLUMNS[column][0], "?")
+
+    def GetSelectedGame(self):
+        """Return the (byte offset, headers) of the selected game, or None."""
+        selected = self.GetFirstSelected()
+        if selected == -1:
+            return
+        return self.game_source.get_game(selected)
+
+
+class PGNGameListDialog(SimpleDialog):
+    """Lets the user choose a game from a PGN file, filtering the games by typing."""
+
+    def __init__(self, parent, game_source, **kwargs):
+        self.game_source = game_source
+        self._filter_timer = None
+        super().__init__(parent, title=_("Select Game"), **kwargs)
+
+    def addControls(self, parent):
+        wx.StaticText(parent, -1, _("&Filter by player, event, date or result"))
+        self.filterTextCtrl = wx.TextCtrl(parent, -1)
+        self.filterTextCtrl.SetSizerProps(expand=True)
+        self.gameCountLabel = wx.StaticText(parent, -1, self.get_game_count_label())
+        self.gameList = VirtualGameList(parent, self.game_source, size=(760, 400))
+        self.gameList.SetSizerProps(expand=True, proportion=1)
+        self.Bind(wx.EVT_TEXT, self.onFilterTextChanged, self.filterTextCtrl)
+        self.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.onGameActivated, self.gameList)
+        self.gameList.SetFocus()
+
+    def get_game_count_label(self):
+        return _("{count} games").format(count=len(self.game_source))
+
+    def onFilterTextChanged(self, event):
+        if self._filter_timer is not None:
+            self._filter_timer.Stop()
+        self._filter_timer = wx.CallLater(FILTER_DELAY, self.apply_filter)
+
+    def apply_filter(self):
+        self._filter_timer = None
+        # The dialog may have been closed while waiting
+        if not self:
+            return
+        self.game_source.set_filter(self.filterTextCtrl.GetValue())
+        self.gameList.RefreshGames()
+        game_count_label = self.get_game_count_label()
+        self.gameCountLabel.SetLabel(game_count_label)
+        ui.message(game_count_label)
+
+    def onGameActivated(self, event):
+        self.EndModal(wx.ID_OK)
+
+    def GetSelectedGame(self):
+        return self.gameList.GetSelectedGame()
@@ -2,18 +2,44 @@
 
 
 import typing as t
-import os
 import random
 import dataclasses
-import json
-import globalVars
-from .models import Puzzle, Theme, PuzzleTheme
+from collections import defaultdict
+from .models import (
+    Puzzle,
+    Theme,
+    PuzzleTheme,
+    PuzzleSample,
+    PuzzleThemeMask,
+    PackedPuzzle,
+    Tuple,
+    SQL,
+    chunked,
+    fn,
+    database,
+    PUZZLE_DATABASE_FILE,
+    USER_PUZZLE_DATABASE_FILE,
+    BUNDLED_PUZZLE_DATABASE_FILE,
+    create_indexes,
+    indexed_by,
+    create_sampling_table,
+    create_theme_mask_table,
+    create_packed_puzzle_table,
+)
+from .packing import decode_moves, decode_board
+from .theme_filter import ThemeFilter, any_theme, all_themes, has_theme
+from .importer import import_puzzles, prepare_bundled_database, open_puzzle_csv, ImportStats
+from .progress import PUZZLE_PROGRESS, PuzzleAttempt
+from .rating import PLAYER_RATING, PlayerRating, TARGET_RATING_WINDOW
+from .cursor import PuzzleCursor, Keyset, PUZZLE_PAGE_SIZE
 from ..helpers import import_bundled
 
 
 with import_bundled():
     import chess
-    from cached_property import cached_property
+
+
+MAX_SQLITE_INTEGER = 2 ** 63 - 1
 
 
 @dataclasses.dataclass
@@ -24,13 +50,30 @@ class PuzzleInfo:
     auto_performed_move: chess.Move
     solution_moves: t.Tuple[chess.Move]
     themes: t.Tuple[Theme]
+    popularity: int = 0
+    # The starting position, when decoded from the packed columns
+    board: t.Optional[chess.Board] = None
 
     @classmethod
-    def from_database_puzzle(cls, puzzle: Puzzle):
-        auto_performed_move, *solution_moves =(chess.Move.from_uci(m.strip()) for m in puzzle.moves.split())
+    def from_database_puzzle(cls, puzzle: Puzzle, theme_ids=None, packed_puzzle=None):
+        """`packed_puzzle` is the (moves, board) blobs of the puzzle, if available."""
+        board = None
+        if packed_puzzle is not None:
+            packed_moves, packed_board = packed_puzzle
+            auto_performed_move, *solution_moves = decode_moves(packed_moves)
+            board = decode_board(packed_board)
+        else:
+            auto_performed_move, *solution_moves =(chess.Move.from_uci(m.strip()) for m in puzzle.moves.split())
+        if theme_ids is None:
+            theme_ids = (
+                PuzzleTheme.select(PuzzleTheme.theme)
+                .where(PuzzleTheme.puzzle == puzzle.id)
+                .tuples()
+            )
+            theme_ids = [theme_id for (theme_id,) in theme_ids]
+        all_themes = Theme.get_all_by_id()
         themes = tuple(
-            t.theme
-            for t in puzzle.themes.join(Theme).order_by(Theme.slug)
+            sorted((all_themes[theme_id] for theme_id in theme_ids), key=lambda theme: theme.slug)
         )
         return cls(
             puzzle_id=puzzle.id,
@@ -38,103 +81,269 @@ class PuzzleInfo:
             fen=puzzle.fen,
             auto_performed_move=auto_performed_move,
             solution_moves=solution_moves,
-            themes=themes
+            themes=themes,
+            popularity=puzzle.popularity,
+            board=board,
         )
 
+    @classmethod
+    def from_database_puzzles(cls, puzzles):
+        """Load the themes, and the packed columns, of all the puzzles with one query each
+        instead of one query per puzzle.
+        """
+        puzzles = list(puzzles)
+        theme_ids = defaultdict(list)
+        packed_puzzles = {}
+        use_packed_puzzles = PackedPuzzle.is_available()
+        # Stay below SQLite's limit on the number of query parameters
+        for puzzle_ids in chunked([puzzle.id for puzzle in puzzles], 900):
+            puzzle_themes = (
+                PuzzleTheme.select(PuzzleTheme.puzzle, PuzzleTheme.theme)
+                .where(PuzzleTheme.puzzle.in_(puzzle_ids))
+                .tuples()
+            )
+            for (puzzle_id, theme_id) in puzzle_themes:
+                theme_ids[puzzle_id].append(theme_id)
+            if use_packed_puzzles:
+                packed_puzzles.update(
+                    (puzzle_id, (bytes(moves), bytes(board)))
+                    for (puzzle_id, moves, board) in
+                    PackedPuzzle.select().where(PackedPuzzle.puzzle_id.in_(puzzle_ids)).tuples()
+                )
+        return [
+            cls.from_database_puzzle(puzzle, theme_ids[puzzle.id], packed_puzzles.get(puzzle.id))
+            for puzzle in puzzles
+        ]
+
+    def get_board(self):
+        """A new board set up at the starting position of the puzzle."""
+        if self.board is not None:
+            return self.board.copy()
+        return chess.Board(self.fen)
+
+    @property
+    def keyset(self):
+        return (self.rating, self.popularity, self.puzzle_id)
+
     def get_theme_info(self):
         for theme in self.themes:
             yield theme.label, theme.description
 
 
+def get_puzzles_by_id(puzzle_ids):
+    """Load the puzzles with the given ids, keeping their order."""
+    puzzles = {
+        puzzle.id: puzzle
+        for puzzle in Puzzle.select().where(Puzzle.id.in_(puzzle_ids))
+    }
+    return PuzzleInfo.from_database_puzzles(puzzles[puzzle_id] for puzzle_id in puzzle_ids)
+
+
 @dataclasses.dataclass
 class PuzzleSet:
-    classifiers: t.Tuple[str] 
-    current_item_index: int
+    """
+    Puzzles having any of the `classifiers` theme slugs, or matching
+    `theme_filter` when one is given, in keyset order.
+    A pass through the set, a lap, starts at the player's target rating window,
+    goes up to the hardest puzzle, then wraps around to the easiest puzzles
+    below `lap_start`, the rating the lap started from.
+    """
+
+    classifiers: t.Tuple[str]
+    keyset: t.Optional[Keyset] = None
+    theme_filter: t.Optional[ThemeFilter] = None
+    lap_start: t.Optional[int] = None
 
-    def __getitem__(self, index):
-        return self.puzzles[index]
+    def __post_init__(self):
+        self.cursor = PuzzleCursor(self.fetch_page, keyset=self.keyset)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        try:
-            item = self[self.current_item_index]
-            self.current_item_index += 1
-            return item
-        except IndexError:
-            raise StopIteration
-
-    @cached_property
-    def puzzles(self):
-        return [
-            PuzzleInfo.from_database_puzzle(puzzle)
-            for puzzle in (Puzzle
-                .select()
-                .join(PuzzleTheme)
-                .join(Theme)
-                .where(Theme.slug.in_(self.classifiers))
-                .order_by(Puzzle.rating.asc())
-                .limit(100)
+        puzzle = next(self.cursor)
+        self.keyset = self.cursor.keyset
+        return puzzle
+
+    def get_puzzle_query(self, after: t.Optional[Keyset] = None, max_rating=None):
+        """Puzzles having any of the classifiers, in keyset order, after the given keyset.
+        The (rating, popularity, id) index drives the query, and each puzzle is checked
+        against the classifiers with a probe into the puzzle_theme indexes, so a page
+        reads only as many puzzles as it needs, without sorting.
+        """
+        theme_ids = [
+            theme_id for (theme_id, theme) in Theme.get_all_by_id().items()
+            if theme.slug in self.classifiers
+        ]
+        query = (Puzzle
+            .select()
+            .where(fn.EXISTS(
+                PuzzleTheme
+                .select(SQL("1"))
+                .where((PuzzleTheme.puzzle == Puzzle.id) & PuzzleTheme.theme.in_(theme_ids))
+            ))
+            .order_by(Puzzle.rating.asc(), Puzzle.popularity.asc(), Puzzle.id.asc())
+        )
+        if Puzzle.has_keyset_index():
+            # Without it, SQLite may scan the puzzles of the theme and sort them all
+            query = query.from_(indexed_by(Puzzle, Puzzle.KEYSET_INDEX))
+        if after is not None:
+            query = query.where(
+                Tuple(Puzzle.rating, Puzzle.popularity, Puzzle.id) > Tuple(*after)
             )
+        if max_rating is not None:
+            query = query.where(Puzzle.rating <= max_rating)
+        return query
+
+    def get_theme_filter(self):
+        if self.theme_filter is not None:
+            return self.theme_filter
+        return any_theme(*self.classifiers)
+
+    def get_theme_mask_query(self, after: t.Optional[Keyset] = None, max_rating=None):
+        """The ids of the matching puzzles, in keyset order, after the given keyset.
+        Scans the theme bitsets, which are stored in keyset order, without any joins.
+        """
+        query = (PuzzleThemeMask
+            .select(PuzzleThemeMask.puzzle_id)
+            .where(self.get_theme_filter().to_expression())
+            .order_by(PuzzleThemeMask.rating.asc(), PuzzleThemeMask.popularity.asc(), PuzzleThemeMask.puzzle_id.asc())
+        )
+        if after is not None:
+            query = query.where(
+                Tuple(PuzzleThemeMask.rating, PuzzleThemeMask.popularity, PuzzleThemeMask.puzzle_id) > Tuple(*after)
+            )
+        if max_rating is not None:
+            query = query.where(PuzzleThemeMask.rating <= max_rating)
+        return query
+
+    def get_page(self, after, max_rating, page_size):
+        if not PuzzleThemeMask.is_available():
+            if self.theme_filter is not None:
+                raise ValueError("Theme filters need the theme mask table")
+            return PuzzleInfo.from_database_puzzles(
+                self.get_puzzle_query(after, max_rating).limit(page_size)
+            )
+        puzzle_ids = [
+            puzzle_id for (puzzle_id,) in
+            self.get_theme_mask_query(after, max_rating).limit(page_size).tuples()
         ]
+        return get_puzzles_by_id(puzzle_ids)
+
+    def fetch_page(self, after, page_size):
+        if self.lap_start is None:
+            min_rating, __ = PLAYER_RATING.get().target_window
+            self.lap_start = after[0] if after is not None else min_rating
+        # Sorts after every puzzle rated below the lap start, and before the others,
+        # whatever their popularity, which can be negative
+        lap_start = (self.lap_start - 1, MAX_SQLITE_INTEGER, MAX_SQLITE_INTEGER)
+        if after is None or tuple(after) > lap_start:
+            page = self.get_page(max(tuple(after or lap_start), lap_start), None, page_size)
+            if page:
+                return page
+            # Wrap around to the easier puzzles
+            after = None
+        return self.get_page(after, self.lap_start - 1, page_size)
 
     def get_identifier(self):
+        if self.theme_filter is not None:
+            return str(self.theme_filter)
         return ".".join(sorted(set(c for c in self.classifiers)))
 
-    def get_history_filename(self):
-        return os.path.join(
-            globalVars.appArgs.configPath,
-            ".chessmart.puzzle.history",
-            self.get_identifier() + ".json"
-        )
-
     def save_history(self):
-        history_filename = self.get_history_filename()
-        if not os.path.isdir(os.path.dirname(history_filename)):
-            os.mkdir(os.path.dirname(history_filename))
-        data = {
-            "classifiers": self.classifiers,
-            "current_item_index": self.current_item_index
-        }
-        with open(history_filename, "w") as file:
-            json.dump(data, file)
+        PUZZLE_PROGRESS.save_set_position(self)
 
     def load_history(self):
-        history_file = self.get_history_filename()
-        if not os.path.isfile(history_file):
-            raise FileNotFoundError("Could not find the history file")
-        with open(history_file, "r") as file:
-            parsed = json.load(file)
-        return PuzzleSet(
-            classifiers=parsed["classifiers"],
-            current_item_index=parsed["current_item_index"]
+        position = PUZZLE_PROGRESS.get_set_position(self.get_identifier())
+        if position is None:
+            raise FileNotFoundError("No saved position for this puzzle set")
+        classifiers, keyset, lap_start = position
+        return dataclasses.replace(
+            self, classifiers=tuple(classifiers), keyset=keyset, lap_start=lap_start
         )
 
+    def keyset_from_item_index(self, item_index):
+        """Convert the position saved by older versions, an index in the set, to a keyset."""
+        if not item_index:
+            return
+        last_puzzle = self.get_puzzle_query().offset(item_index - 1).first()
+        if last_puzzle is not None:
+            return (last_puzzle.rating, last_puzzle.popularity, last_puzzle.id)
+
 
 @dataclasses.dataclass(init=False)
 class RandomPuzzleSet(PuzzleSet):
+    """
+    `num_puzzles` distinct puzzles drawn uniformly at random from the player's
+    target rating window, optionally limited to the theme with the `classifier` slug.
+    """
 
-    def __init__(self, num_puzzles=3):
+    def __init__(self, num_puzzles=3, classifier=None):
         self.num_puzzles = num_puzzles
-        self.classifiers = ()
-        self.current_item_index = 0
-
-    @cached_property
-    def puzzles(self):
-        choice_range = range(
-            Puzzle.raw("SELECT MIN(puzzle.id) FROM puzzle;").get().id,
-            Puzzle.raw("SELECT MAX(puzzle.id) FROM puzzle;").get().id,
-        )
-        chosen_ids = random.sample(choice_range, self.num_puzzles)
-        return [
-            PuzzleInfo.from_database_puzzle(puzzle)
-            for puzzle in Puzzle.select().where(Puzzle.id.in_(chosen_ids))
+        self.classifier = classifier
+        self.classifiers = (classifier,) if classifier else ()
+        self.keyset = None
+        self._puzzle_ids = None
+        self.cursor = PuzzleCursor(self.fetch_page)
+
+    def fetch_page(self, after, page_size):
+        if self._puzzle_ids is None:
+            self._puzzle_ids = self.sample_puzzle_ids()
+        page_ids, self._puzzle_ids = self._puzzle_ids[:page_size], self._puzzle_ids[page_size:]
+        if not page_ids:
+            return []
+        return get_puzzles_by_id(page_ids)
+
+    def get_theme_id(self):
+        if not self.classifier:
+            return PuzzleSample.ALL_PUZZLES
+        return Theme.get(Theme.slug == self.classifier).id
+
+    def sample_puzzle_ids(self):
+        """
+        Pick the ordinals from the sampling table, widening the rating
+        window until it holds enough puzzles, then look up each of them.
+        """
+        if not PuzzleSample.is_available():
+            return self.sample_puzzle_ids_without_sampling_table()
+        theme_id = self.get_theme_id()
+        min_rating, max_rating = PLAYER_RATING.get().target_window
+        widening = 4 * TARGET_RATING_WINDOW
+        for rating_band in (
+            (min_rating, max_rating),
+            (min_rating - widening, max_rating + widening),
+            (None, None),
+        ):
+            ordinals = PuzzleSample.get_ordinal_range(theme_id, *rating_band)
+            if len(ordinals) >= self.num_puzzles:
+                break
+        chosen_ordinals = random.sample(ordinals, min(self.num_puzzles, len(ordinals)))
+        return PuzzleSample.get_puzzle_ids(theme_id, chosen_ordinals)
+
+    def sample_puzzle_ids_without_sampling_table(self):
+        # Databases built before the sampling table was added
+        query = Puzzle.select(Puzzle.id)
+        if self.classifier:
+            query = query.where(Puzzle.id.in_(
+                PuzzleTheme.select(PuzzleTheme.puzzle).where(PuzzleTheme.theme == self.get_theme_id())
+            ))
+        min_rating, max_rating = PLAYER_RATING.get().target_window
+        puzzle_ids = [
+            puzzle_id for (puzzle_id,) in
+            query.where(Puzzle.rating.between(min_rating, max_rating))
+            .order_by(fn.Random())
+            .limit(self.num_puzzles)
+            .tuples()
         ]
+        if len(puzzle_ids) < self.num_puzzles:
+            puzzle_ids = [
+                puzzle_id for (puzzle_id,) in
+                query.order_by(fn.Random()).limit(self.num_puzzles).tuples()
+            ]
+        return puzzle_ids
 
     def save_history(self):
         pass
 
     def load_history(self):
         raise FileNotFoundError("NA")
-
@@ -0,0 +1,58 @@
+# coding: utf-8
+
+"""Lazy, paged iteration over puzzles."""
+
+import typing as t
+from collections import deque
+from logHandler import log
+from ..concurrency import THREADED_EXECUTOR
+
+
+PUZZLE_PAGE_SIZE = 10
+# The (rating, popularity, puzzle id) sort key of the last puzzle handed out
+Keyset = t.Tuple[int, int, int]
+
+
+class PuzzleCursor:
+    """
+    Iterates over puzzles a page at a time, keeping a single page in memory.
+    `fetch_page(after, page_size)` returns the next `PuzzleInfo` objects
+    after the given keyset (None for the start). As soon as a page is taken,
+    the following one is fetched on `THREADED_EXECUTOR`, so the next page
+    is usually ready by the time it is needed.
+    `keyset` is the position of the cursor, and can be saved to resume later.
+    """
+
+    def __init__(self, fetch_page, keyset: t.Optional[Keyset] = None, page_size=PUZZLE_PAGE_SIZE):
+        self.fetch_page = fetch_page
+        self.keyset = keyset
+        self.page_size = page_size
+        self._page = deque()
+        self._last_fetched_keyset = keyset
+        self._next_page_future = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._page:
+            page = self._get_next_page()
+            if not page:
+                raise StopIteration
+            self._page.extend(page)
+            self._last_fetched_keyset = page[-1].keyset
+            self._next_page_future = THREADED_EXECUTOR.submit(
+                self.fetch_page, self._last_fetched_keyset, self.page_size
+            )
+        puzzle = self._page.popleft()
+        self.keyset = puzzle.keyset
+        return puzzle
+
+    def _get_next_page(self):
+        future, self._next_page_future = self._next_page_future, None
+        if future is not None:
+            try:
+                return future.result()
+            except Exception:
+                log.exception("Failed to prefetch the next page of puzzles")
+        return self.fetch_page(self._last_fetched_keyset, self.page_size)
@@ -0,0 +1,238 @@
+# coding: utf-8
+
+"""
+Builds or refreshes the puzzle database from the Lichess puzzle CSV
+(https://database.lichess.org/#puzzles).
+The CSV is streamed, optionally straight out of a `.bz2`, `.gz`, or `.xz`
+file, so memory use does not grow with the number of puzzles.
+"""
+
+import os
+import re
+import csv
+import bz2
+import gzip
+import lzma
+import time
+import shutil
+import string
+import dataclasses
+import threading
+import typing as t
+from logHandler import log
+from .models import (
+    Puzzle,
+    Theme,
+    PuzzleTheme,
+    PuzzleSample,
+    PuzzleThemeMask,
+    PackedPuzzle,
+    APSWDatabase,
+    USER_PUZZLE_DATABASE_FILE,
+    BUNDLED_PUZZLE_DATABASE_FILE,
+    PREPARED_PUZZLE_DATABASE_FILE,
+    PUZZLE_DATABASE_WRITE_TIMEOUT,
+    chunked,
+    create_indexes,
+    create_sampling_table,
+    create_theme_mask_table,
+    create_packed_puzzle_table,
+)
+
+
+IMPORT_BATCH_SIZE = 10000
+IMPORT_TRANSACTION_SIZE = 500000
+# Durability does not matter while building a new file, which is only
+# moved in place once it is complete
+BULK_LOAD_PRAGMAS = {
+    "journal_mode": "off",
+    "synchronous": "off",
+    "locking_mode": "exclusive",
+    "temp_store": "memory",
+    "cache_size": -64000,
+}
+UPDATE_PRAGMAS = {
+    "journal_mode": "truncate",
+    "synchronous": "normal",
+    "temp_store": "memory",
+    "cache_size": -64000,
+}
+PUZZLE_ID_ALPHABET = string.digits + string.ascii_lowercase + string.ascii_uppercase
+COMPRESSED_FILE_OPENERS = {
+    ".bz2": bz2.open,
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+}
+INSERT_PUZZLE_SQL = "INSERT INTO puzzle (id, fen, moves, popularity, rating) VALUES (?, ?, ?, ?, ?)"
+UPSERT_PUZZLE_SQL = (
+    INSERT_PUZZLE_SQL
+    + " ON CONFLICT(id) DO UPDATE SET fen = excluded.fen, moves = excluded.moves,"
+    " popularity = excluded.popularity, rating = excluded.rating"
+)
+DELETE_PUZZLE_THEMES_SQL = "DELETE FROM puzzle_theme WHERE puzzle_id = ?"
+INSERT_PUZZLE_THEME_SQL = "INSERT OR IGNORE INTO puzzle_theme (puzzle_id, theme_id) VALUES (?, ?)"
+REPLACE_PACKED_PUZZLE_SQL = "INSERT OR REPLACE INTO packed_puzzle (puzzle_id, moves, board) VALUES (?, ?, ?)"
+
+
+@dataclasses.dataclass
+class ImportStats:
+    rows: int = 0
+    new_themes: int = 0
+    seconds: float = 0.0
+    is_update: bool = False
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return f"{self.rows} puzzles in {self.seconds:.1f} seconds ({self.rows_per_second:.0f} per second)"
+
+
+def puzzle_id_from_lichess_id(lichess_id: str):
+    """Lichess puzzle ids are base 62 strings, this makes them the integer primary key."""
+    puzzle_id = 0
+    for char in lichess_id:
+        puzzle_id = puzzle_id * len(PUZZLE_ID_ALPHABET) + PUZZLE_ID_ALPHABET.index(char)
+    return puzzle_id
+
+
+def theme_label_from_slug(slug: str):
+    words = re.sub(r"([A-Z]|[0-9]+)", r" \1", slug).split()
+    return " ".join(words).capitalize()
+
+
+def open_puzzle_csv(filename):
+    opener = COMPRESSED_FILE_OPENERS.get(os.path.splitext(filename)[1].lower(), open)
+    return opener(filename, "rt", encoding="utf-8", newline="")
+
+
+def iter_puzzle_rows(csv_file):
+    """Yield (puzzle id, fen, moves, popularity, rating, theme slugs) from the CSV."""
+    for row in csv.DictReader(csv_file):
+        yield (
+            puzzle_id_from_lichess_id(row["PuzzleId"]),
+            row["FEN"],
+            row["Moves"],
+            int(row["Popularity"]),
+            int(row["Rating"]),
+            row["Themes"].split(),
+        )
+
+
+def import_puzzles(
+    csv_filename,
+    database_file=USER_PUZZLE_DATABASE_FILE,
+    batch_size=IMPORT_BATCH_SIZE,
+    transaction_size=IMPORT_TRANSACTION_SIZE,
+    progress_callback=None,
+    cancel_event: t.Optional[threading.Event] = None,
+):
+    """
+    Import the puzzles in `csv_filename` into `database_file`.
+    A new database is built in a temporary file, with the indexes created after
+    the load. An existing database is updated in place: puzzles are inserted
+    or updated by puzzle id, and their themes replaced.
+    `progress_callback(rows, rows_per_second)` is called after every batch.
+    Setting `cancel_event` stops the import, keeping the batches committed so far
+    when updating an existing database, without rebuilding its indexes and
+    derived tables.
+    Returns an `ImportStats`.
+    """
+    is_update = os.path.isfile(database_file)
+    target_file = database_file if is_update else database_file + ".importing"
+    if not is_update and os.path.isfile(target_file):
+        os.remove(target_file)
+    writable_database = APSWDatabase(
+        target_file,
+        pragmas=UPDATE_PRAGMAS if is_update else BULK_LOAD_PRAGMAS,
+        timeout=PUZZLE_DATABASE_WRITE_TIMEOUT,
+    )
+    models = (Puzzle, Theme, PuzzleTheme, PackedPuzzle)
+    stats = ImportStats(is_update=is_update)
+    start = time.perf_counter()
+    with writable_database.bind_ctx(models):
+        for model in models:
+            # Indexes are created once the rows are in
+            model._schema.create_table(safe=True)
+        theme_ids = {slug: theme_id for (theme_id, slug) in Theme.select(Theme.id, Theme.slug).tuples()}
+        cursor = writable_database.cursor()
+        with open_puzzle_csv(csv_filename) as csv_file, writable_database.atomic() as transaction:
+            rows_in_transaction = 0
+            for batch in chunked(iter_puzzle_rows(csv_file), batch_size):
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                puzzle_themes = []
+                for (puzzle_id, *__, slugs) in batch:
+                    for slug in slugs:
+                        if slug not in theme_ids:
+                            theme_ids[slug] = Theme.insert(
+                                slug=slug, label=theme_label_from_slug(slug), description=""
+                            ).execute()
+                            stats.new_themes += 1
+                        puzzle_themes.append((puzzle_id, theme_ids[slug]))
+                puzzles = [puzzle_row[:-1] for puzzle_row in batch]
+                if is_update:
+                    cursor.executemany(UPSERT_PUZZLE_SQL, puzzles)
+                    cursor.executemany(DELETE_PUZZLE_THEMES_SQL, [(puzzle[0],) for puzzle in puzzles])
+                else:
+                    cursor.executemany(INSERT_PUZZLE_SQL, puzzles)
+                cursor.executemany(INSERT_PUZZLE_THEME_SQL, puzzle_themes)
+                cursor.executemany(
+                    REPLACE_PACKED_PUZZLE_SQL,
+                    [(puzzle_id, *PackedPuzzle.pack(fen, moves)) for (puzzle_id, fen, moves, *__) in puzzles],
+                )
+                stats.rows += len(batch)
+                rows_in_transaction += len(batch)
+                if rows_in_transaction >= transaction_size:
+                    # Commits and begins a new transaction
+                    transaction.commit()
+                    rows_in_transaction = 0
+                stats.seconds = time.perf_counter() - start
+                if progress_callback is not None:
+                    progress_callback(stats.rows, stats.rows_per_second)
+        cursor.close()
+    writable_database.close()
+    if cancel_event is not None and cancel_event.is_set():
+        # The indexes and the derived tables are only rebuilt by a complete import
+        if is_update:
+            Theme.get_all_by_id.cache_clear()
+        else:
+            os.remove(target_file)
+        log.info(f"Cancelled the import into {database_file} after {stats}")
+        return stats
+    create_indexes(target_file)
+    create_sampling_table(target_file)
+    create_theme_mask_table(target_file)
+    if not is_update:
+        os.replace(target_file, database_file)
+    # The theme table and the derived tables may have changed
+    Theme.get_all_by_id.cache_clear()
+    PuzzleSample.is_available.cache_clear()
+    PuzzleThemeMask.is_available.cache_clear()
+    PackedPuzzle.is_available.cache_clear()
+    stats.seconds = time.perf_counter() - start
+    log.info(f"Imported {stats} into {database_file}")
+    return stats
+
+
+def prepare_bundled_database(database_file=PREPARED_PUZZLE_DATABASE_FILE):
+    """
+    Copy the bundled database to `database_file`, and build the indexes and
+    the derived tables into the copy, which is used from the next time
+    the add-on loads. The copy is built in a temporary file, and only
+    moved in place once it is complete.
+    """
+    start = time.perf_counter()
+    target_file = database_file + ".preparing"
+    shutil.copyfile(BUNDLED_PUZZLE_DATABASE_FILE, target_file)
+    try:
+        create_indexes(target_file)
+        create_sampling_table(target_file)
+        create_theme_mask_table(target_file)
+        create_packed_puzzle_table(target_file)
+    except BaseException:
+        os.remove(target_file)
+        raise
+    os.replace(target_file, database_file)
+    log.info(f"Prepared the bundled puzzle database in {time.perf_counter() - start:.1f} seconds")
@@ -2,7 +2,11 @@
 
 
 import os
+import struct
+import functools
+import globalVars
 from ..helpers import import_bundled, LIB_DIRECTORY
+from .packing import encode_uci_move, encode_fen
 
 
 with import_bundled():
@@ -12,14 +16,67 @@ with import_bundled():
 with import_bundled(os.path.join(LIB_DIRECTORY, "sqlite")):
     import apsw
     from peewee import *
+    from peewee import NodeList
     from playhouse.apsw_ext import APSWDatabase
 
 
-PUZZLE_DATABASE_FILE = os.path.join(
+BUNDLED_PUZZLE_DATABASE_FILE = os.path.join(
     os.path.abspath(os.path.dirname(__file__)),
     "lichess.puzzles.mini.sqlite"
 )
-database = APSWDatabase(PUZZLE_DATABASE_FILE, flags=apsw.SQLITE_ACCESS_EXISTS | apsw.SQLITE_ACCESS_READ)
+# Built from the Lichess puzzle CSV by `importer.import_puzzles`, and used instead of the bundled database if present
+USER_PUZZLE_DATABASE_FILE = os.path.join(
+    globalVars.appArgs.configPath, ".chessmart.puzzles.sqlite"
+)
+# A copy of the bundled database with the indexes and the derived tables built in,
+# made by `importer.prepare_bundled_database` the first time the add-on runs,
+# as the add-on directory may not be writable
+PREPARED_PUZZLE_DATABASE_FILE = os.path.join(
+    globalVars.appArgs.configPath, ".chessmart.puzzles.bundled.sqlite"
+)
+
+
+def is_prepared_database_current():
+    """Whether the prepared copy exists, and was made after the bundled database was installed."""
+    return (
+        os.path.isfile(PREPARED_PUZZLE_DATABASE_FILE)
+        and os.path.isfile(BUNDLED_PUZZLE_DATABASE_FILE)
+        and os.path.getmtime(PREPARED_PUZZLE_DATABASE_FILE) >= os.path.getmtime(BUNDLED_PUZZLE_DATABASE_FILE)
+    )
+
+
+if os.path.isfile(USER_PUZZLE_DATABASE_FILE):
+    PUZZLE_DATABASE_FILE = USER_PUZZLE_DATABASE_FILE
+elif is_prepared_database_current():
+    PUZZLE_DATABASE_FILE = PREPARED_PUZZLE_DATABASE_FILE
+else:
+    PUZZLE_DATABASE_FILE = BUNDLED_PUZZLE_DATABASE_FILE
+# Tuned for reading, and no connection may write. The file is not memory
+# mapped: NVDA is a 32-bit process, and every connection would map its own view
+PUZZLE_DATABASE_PRAGMAS = {
+    "query_only": 1,
+    "cache_size": -16 * 1024,
+    "temp_store": "memory",
+}
+# Seconds a writable connection waits for the add-on's read connections
+# to release the puzzle database before giving up with `BusyError`
+PUZZLE_DATABASE_WRITE_TIMEOUT = 30
+# APSW keeps this many prepared statements per connection, keyed by their SQL,
+# so the hot queries (a page of puzzles and its themes) are prepared only once
+PUZZLE_STATEMENT_CACHE_SIZE = 256
+# Peewee keeps connections per thread, so the GUI thread and every worker get
+# their own read-only connection, opened on first use rather than at import
+database = APSWDatabase(
+    PUZZLE_DATABASE_FILE,
+    flags=apsw.SQLITE_OPEN_READONLY,
+    statementcachesize=PUZZLE_STATEMENT_CACHE_SIZE,
+    pragmas=PUZZLE_DATABASE_PRAGMAS,
+)
+
+
+def indexed_by(model, index_name):
+    """The table of the model as a query source, forced to use the given index."""
+    return NodeList((model, SQL(f"INDEXED BY {index_name}")))
 
 
 class BaseModel(Model):
@@ -35,11 +92,25 @@ class Puzzle(BaseModel):
 
     class Meta:
         table_name = "puzzle"
+        # Covers rating window selection, ordering by rating and id
+        indexes = ((("rating", "popularity", "id"), False),)
+
+    # The name peewee gives to the (rating, popularity, id) index
+    KEYSET_INDEX = "puzzle_rating_popularity_id"
 
     @classmethod
     def get_total_count(cls):
         return cls.select().count()
 
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def has_keyset_index(cls):
+        """Databases not built by `create_indexes` lack the keyset index."""
+        return any(
+            index.name == cls.KEYSET_INDEX
+            for index in cls._meta.database.get_indexes(cls._meta.table_name)
+        )
+
 
 class Theme(BaseModel):
     description = CharField()
@@ -49,6 +120,12 @@ class Theme(BaseModel):
     def __repr__(self):
         return f"Theme(slug='{self.slug}', description='{self.description}')"
 
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def get_all_by_id(cls):
+        """The theme table is small and read-only, so it is loaded once per process."""
+        return {theme.id: theme for theme in cls.select()}
+
     class Meta:
         table_name = "theme"
 
@@ -59,6 +136,192 @@ class PuzzleTheme(BaseModel):
 
     class Meta:
         table_name = "puzzle_theme"
-        indexes = ((("puzzle", "theme"), True),)
+        indexes = (
+            (("puzzle", "theme"), True),
+            # Covers looking up the puzzles of a theme
+            (("theme", "puzzle"), False),
+        )
         primary_key = CompositeKey("puzzle", "theme")
 
+
+class PuzzleSample(BaseModel):
+    """
+    A dense numbering of the puzzles, in (rating, popularity, id) order, built
+    once when the database is created. Theme zero numbers all the puzzles, and
+    every theme numbers its own puzzles from zero, so that the puzzles of a theme
+    and rating band have consecutive ordinals and can be drawn uniformly at random
+    with one primary key lookup each.
+    """
+
+    theme_id = IntegerField()
+    ordinal = IntegerField()
+    puzzle_id = IntegerField()
+    rating = IntegerField()
+
+    ALL_PUZZLES = 0
+
+    class Meta:
+        table_name = "puzzle_sample"
+        primary_key = CompositeKey("theme_id", "ordinal")
+        without_rowid = True
+        indexes = ((("theme_id", "rating", "ordinal"), False),)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def is_available(cls):
+        return cls.table_exists()
+
+    @classmethod
+    def get_ordinal_range(cls, theme_id=ALL_PUZZLES, min_rating=None, max_rating=None):
+        """The range of ordinals of the puzzles of the theme in the rating band."""
+        first = (
+            cls.select(cls.ordinal)
+            .where((cls.theme_id == theme_id) & (cls.rating >= (min_rating or 0)))
+            .order_by(cls.rating.asc(), cls.ordinal.asc())
+            .scalar()
+        )
+        last = cls.select(cls.ordinal).where(cls.theme_id == theme_id)
+        if max_rating is not None:
+            last = last.where(cls.rating <= max_rating)
+        last = last.order_by(cls.rating.desc(), cls.ordinal.desc()).scalar()
+        if first is None or last is None or last < first:
+            return range(0)
+        return range(first, last + 1)
+
+    @classmethod
+    def get_puzzle_ids(cls, theme_id, ordinals):
+        return [
+            cls.get_by_id((theme_id, ordinal)).puzzle_id
+            for ordinal in ordinals
+        ]
+
+
+class PuzzleThemeMask(BaseModel):
+    """
+    The themes of every puzzle as a bitset, in keyset order, so that any
+    combination of themes can be filtered in a single scan of one table.
+    Theme `n` is bit `(n - 1) % THEME_MASK_WORD_BITS` of `mask_<(n - 1) // THEME_MASK_WORD_BITS>`.
+    """
+
+    rating = IntegerField()
+    popularity = IntegerField()
+    puzzle_id = IntegerField()
+    mask_0 = IntegerField()
+    mask_1 = IntegerField()
+
+    class Meta:
+        table_name = "puzzle_theme_mask"
+        primary_key = CompositeKey("rating", "popularity", "puzzle_id")
+        without_rowid = True
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def is_available(cls):
+        return cls.table_exists()
+
+    @classmethod
+    def get_mask_fields(cls):
+        return (cls.mask_0, cls.mask_1)
+
+
+# SQLite integers are signed, so the sign bit is left unused
+THEME_MASK_WORD_BITS = 63
+THEME_MASK_WORDS = len(PuzzleThemeMask.get_mask_fields())
+
+
+def create_theme_mask_table(database_file=PUZZLE_DATABASE_FILE):
+    """(Re)build the `PuzzleThemeMask` table from the puzzle_theme table."""
+    writable_database = APSWDatabase(database_file, timeout=PUZZLE_DATABASE_WRITE_TIMEOUT)
+    theme_count = writable_database.execute_sql("SELECT MAX(id) FROM theme").fetchone()[0] or 0
+    if theme_count > THEME_MASK_WORDS * THEME_MASK_WORD_BITS:
+        raise ValueError(f"Too many themes for the theme mask: {theme_count}")
+    # Each (puzzle, theme) pair is unique, so summing the bits is the same as or-ing them
+    mask_columns = ", ".join(
+        f"COALESCE(SUM(CASE WHEN (puzzle_theme.theme_id - 1) / {THEME_MASK_WORD_BITS} = {word} "
+        f"THEN 1 << ((puzzle_theme.theme_id - 1) % {THEME_MASK_WORD_BITS}) END), 0)"
+        for word in range(THEME_MASK_WORDS)
+    )
+    with writable_database.bind_ctx((PuzzleThemeMask,)):
+        with writable_database.atomic():
+            writable_database.drop_tables([PuzzleThemeMask], safe=True)
+            writable_database.create_tables([PuzzleThemeMask])
+            writable_database.execute_sql(
+                "INSERT INTO puzzle_theme_mask (rating, popularity, puzzle_id, mask_0, mask_1) "
+                f"SELECT puzzle.rating, puzzle.popularity, puzzle.id, {mask_columns} "
+                "FROM puzzle LEFT JOIN puzzle_theme ON puzzle_theme.puzzle_id = puzzle.id "
+                "GROUP BY puzzle.id"
+            )
+    writable_database.close()
+
+
+class PackedPuzzle(BaseModel):
+    """The moves and starting board of every puzzle, in the binary encodings of `packing`."""
+
+    puzzle_id = IntegerField(primary_key=True)
+    moves = BlobField()
+    board = BlobField()
+
+    class Meta:
+        table_name = "packed_puzzle"
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def is_available(cls):
+        return cls.table_exists()
+
+    @staticmethod
+    def pack(fen, moves):
+        """Return the (moves, board) blobs of a puzzle from its text columns."""
+        raw_moves = [encode_uci_move(move) for move in moves.split()]
+        return struct.pack(f"<{len(raw_moves)}H", *raw_moves), encode_fen(fen)
+
+
+def create_packed_puzzle_table(database_file=PUZZLE_DATABASE_FILE):
+    """(Re)build the `PackedPuzzle` table from the text columns of the puzzle table."""
+    writable_database = APSWDatabase(database_file, timeout=PUZZLE_DATABASE_WRITE_TIMEOUT)
+    with writable_database.bind_ctx((Puzzle, PackedPuzzle)):
+        with writable_database.atomic():
+            writable_database.drop_tables([PackedPuzzle], safe=True)
+            writable_database.create_tables([PackedPuzzle])
+            puzzles = Puzzle.select(Puzzle.id, Puzzle.fen, Puzzle.moves).tuples().iterator()
+            for batch in chunked(puzzles, 1000):
+                PackedPuzzle.insert_many(
+                    [(puzzle_id, *PackedPuzzle.pack(fen, moves)) for (puzzle_id, fen, moves) in batch],
+                    fields=[PackedPuzzle.puzzle_id, PackedPuzzle.moves, PackedPuzzle.board],
+                ).execute()
+    writable_database.close()
+
+
+def create_sampling_table(database_file=PUZZLE_DATABASE_FILE):
+    """(Re)build the `PuzzleSample` table. Needs SQLite 3.25 or later for window functions."""
+    writable_database = APSWDatabase(database_file, timeout=PUZZLE_DATABASE_WRITE_TIMEOUT)
+    with writable_database.bind_ctx((PuzzleSample,)):
+        with writable_database.atomic():
+            writable_database.drop_tables([PuzzleSample], safe=True)
+            writable_database.create_tables([PuzzleSample])
+            writable_database.execute_sql(
+                "INSERT INTO puzzle_sample (theme_id, ordinal, puzzle_id, rating) "
+                "SELECT ?, ROW_NUMBER() OVER (ORDER BY rating, popularity, id) - 1, id, rating "
+                "FROM puzzle",
+                (PuzzleSample.ALL_PUZZLES,)
+            )
+            writable_database.execute_sql(
+                "INSERT INTO puzzle_sample (theme_id, ordinal, puzzle_id, rating) "
+                "SELECT puzzle_theme.theme_id, "
+                "ROW_NUMBER() OVER (PARTITION BY puzzle_theme.theme_id ORDER BY puzzle.rating, puzzle.popularity, puzzle.id) - 1, "
+                "puzzle.id, puzzle.rating "
+                "FROM puzzle_theme JOIN puzzle ON puzzle.id = puzzle_theme.puzzle_id"
+            )
+    writable_database.close()
+
+
+def create_indexes(database_file=PUZZLE_DATABASE_FILE):
+    """Create the indexes declared by the models, if missing.
+    The puzzle database is opened read-only, so this uses a separate writable connection.
+    """
+    writable_database = APSWDatabase(database_file, timeout=PUZZLE_DATABASE_WRITE_TIMEOUT)
+    with writable_database.bind_ctx((Puzzle, Theme, PuzzleTheme)):
+        for model in (Puzzle, Theme, PuzzleTheme):
+            model._schema.create_indexes(safe=True)
+        writable_database.execute_sql("ANALYZE")
+    writable_database.close()
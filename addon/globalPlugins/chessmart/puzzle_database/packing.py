@@ -0,0 +1,150 @@
+# coding: utf-8
+
+"""
+Compact binary encodings of puzzle moves and starting positions, decoded
+without any string parsing.
+Moves are 16-bit Polyglot style raw moves: the target square in bits 0-5,
+the origin square in bits 6-11, and the promotion piece in bits 12-14.
+Boards are a fixed size record: the occupied squares bitboard, a nibble
+per occupied square (piece type, plus 8 for black) in square order, and
+the turn, castling rights, en passant square, and move counters.
+"""
+
+import struct
+from ..helpers import import_bundled
+
+
+with import_bundled():
+    import chess
+
+
+MOVE_FORMAT = "<H"
+# Occupied squares, piece nibbles, flags, en passant square, halfmove clock, fullmove number
+BOARD_FORMAT = "<Q16sBBBH"
+BOARD_SIZE = struct.calcsize(BOARD_FORMAT)
+NO_EN_PASSANT_SQUARE = 0xFF
+BLACK_PIECE_FLAG = 8
+# The flags byte holds the turn in bit 0, and these castling rights in bits 1 to 4
+CASTLING_ROOK_SQUARES = (chess.H1, chess.A1, chess.H8, chess.A8)
+
+
+def encode_move(move: chess.Move):
+    promotion = move.promotion - 1 if move.promotion else 0
+    return move.to_square | (move.from_square << 6) | (promotion << 12)
+
+
+def decode_move(raw_move: int):
+    promotion = (raw_move >> 12) & 0x7
+    return chess.Move(
+        (raw_move >> 6) & 0x3F,
+        raw_move & 0x3F,
+        promotion + 1 if promotion else None,
+    )
+
+
+def encode_uci_move(uci: str):
+    """Like `encode_move(chess.Move.from_uci(uci))`, without building the move."""
+    from_square = (ord(uci[1]) - ord("1")) * 8 + ord(uci[0]) - ord("a")
+    to_square = (ord(uci[3]) - ord("1")) * 8 + ord(uci[2]) - ord("a")
+    promotion = chess.PIECE_SYMBOLS.index(uci[4]) - 1 if len(uci) > 4 else 0
+    return to_square | (from_square << 6) | (promotion << 12)
+
+
+def encode_moves(moves):
+    return struct.pack(f"<{len(moves)}H", *(encode_move(move) for move in moves))
+
+
+def decode_moves(packed_moves: bytes):
+    return [
+        decode_move(raw_move)
+        for raw_move in struct.unpack(f"<{len(packed_moves) // 2}H", packed_moves)
+    ]
+
+
+def encode_board(board: chess.Board):
+    occupied = board.occupied
+    nibbles = bytearray(16)
+    for (index, square) in enumerate(chess.scan_forward(occupied)):
+        piece = board.piece_at(square)
+        nibble = piece.piece_type | (0 if piece.color else BLACK_PIECE_FLAG)
+        nibbles[index >> 1] |= nibble << ((index & 1) * 4)
+    flags = int(board.turn)
+    for (bit, rook_square) in enumerate(CASTLING_ROOK_SQUARES, start=1):
+        if board.castling_rights & chess.BB_SQUARES[rook_square]:
+            flags |= 1 << bit
+    return struct.pack(
+        BOARD_FORMAT,
+        occupied,
+        bytes(nibbles),
+        flags,
+        NO_EN_PASSANT_SQUARE if board.ep_square is None else board.ep_square,
+        min(board.halfmove_clock, 0xFF),
+        board.fullmove_number,
+    )
+
+
+def encode_fen(fen: str):
+    """Like `encode_board(chess.Board(fen))`, without building and validating the board.
+    Used by the importer, where building millions of boards dominates the load time.
+    """
+    placement, turn, castling, ep_square, halfmove_clock, fullmove_number = fen.split()
+    occupied = chess.BB_EMPTY
+    nibble_list = []
+    for (rank_index, rank) in enumerate(reversed(placement.split("/"))):
+        square = rank_index * 8
+        for char in rank:
+            if char.isdigit():
+                square += int(char)
+                continue
+            occupied |= chess.BB_SQUARES[square]
+            piece_type = chess.PIECE_SYMBOLS.index(char.lower())
+            nibble_list.append(piece_type if char.isupper() else piece_type | BLACK_PIECE_FLAG)
+            square += 1
+    nibbles = bytearray(16)
+    for (index, nibble) in enumerate(nibble_list):
+        nibbles[index >> 1] |= nibble << ((index & 1) * 4)
+    flags = int(turn == "w")
+    for (bit, symbol) in enumerate("KQkq", start=1):
+        if symbol in castling:
+            flags |= 1 << bit
+    return struct.pack(
+        BOARD_FORMAT,
+        occupied,
+        bytes(nibbles),
+        flags,
+        NO_EN_PASSANT_SQUARE if ep_square == "-" else chess.SQUARE_NAMES.index(ep_square),
+        min(int(halfmove_clock), 0xFF),
+        int(fullmove_number),
+    )
+
+
+def decode_board(packed_board: bytes):
+    """Build the board by setting its bitboards directly."""
+    occupied, nibbles, flags, ep_square, halfmove_clock, fullmove_number = struct.unpack(
+        BOARD_FORMAT, packed_board
+    )
+    bitboards = [chess.BB_EMPTY] * 16
+    for (index, square) in enumerate(chess.scan_forward(occupied)):
+        nibble = (nibbles[index >> 1] >> ((index & 1) * 4)) & 0xF
+        bitboards[nibble] |= chess.BB_SQUARES[square]
+    board = chess.Board(None)
+    board.pawns = bitboards[chess.PAWN] | bitboards[chess.PAWN | BLACK_PIECE_FLAG]
+    board.knights = bitboards[chess.KNIGHT] | bitboards[chess.KNIGHT | BLACK_PIECE_FLAG]
+    board.bishops = bitboards[chess.BISHOP] | bitboards[chess.BISHOP | BLACK_PIECE_FLAG]
+    board.rooks = bitboards[chess.ROOK] | bitboards[chess.ROOK | BLACK_PIECE_FLAG]
+    board.queens = bitboards[chess.QUEEN] | bitboards[chess.QUEEN | BLACK_PIECE_FLAG]
+    board.kings = bitboards[chess.KING] | bitboards[chess.KING | BLACK_PIECE_FLAG]
+    board.occupied_co[chess.BLACK] = (
+        bitboards[9] | bitboards[10] | bitboards[11] | bitboards[12] | bitboards[13] | bitboards[14]
+    )
+    board.occupied_co[chess.WHITE] = occupied & ~board.occupied_co[chess.BLACK]
+    board.occupied = occupied
+    board.turn = bool(flags & 1)
+    board.castling_rights = chess.BB_EMPTY
+    for (bit, rook_square) in enumerate(CASTLING_ROOK_SQUARES, start=1):
+        if flags & (1 << bit):
+            board.castling_rights |= chess.BB_SQUARES[rook_square]
+    board.ep_square = None if ep_square == NO_EN_PASSANT_SQUARE else ep_square
+    board.halfmove_clock = halfmove_clock
+    board.fullmove_number = fullmove_number
+    return board
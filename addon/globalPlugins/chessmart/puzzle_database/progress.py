@@ -0,0 +1,328 @@
+# coding: utf-8
+
+"""
+The puzzle progress of the player: every attempt, the position in each
+puzzle set, the puzzle rating, and a spaced repetition review schedule.
+Kept in a SQLite database in WAL mode in NVDA's configuration directory.
+"""
+
+import os
+import time
+import json
+import threading
+import dataclasses
+import typing as t
+import globalVars
+from logHandler import log
+from ..helpers import import_bundled, LIB_DIRECTORY
+from ..concurrency import THREADED_EXECUTOR
+from ..sqlite_database import TrackedAPSWDatabase
+
+
+with import_bundled(os.path.join(LIB_DIRECTORY, "sqlite")):
+    import apsw
+    from peewee import *
+
+
+PROGRESS_DATABASE_FILE = os.path.join(
+    globalVars.appArgs.configPath, ".chessmart.puzzle.progress.sqlite"
+)
+# Written by older versions, imported on first run
+LEGACY_HISTORY_DIRECTORY = os.path.join(
+    globalVars.appArgs.configPath, ".chessmart.puzzle.history"
+)
+# Stored in `PRAGMA user_version`
+SCHEMA_VERSION = 1
+DAY = 24 * 60 * 60
+# A failed puzzle is reviewed the next day, then after intervals growing
+# by REVIEW_INTERVAL_GROWTH for every success, until it is solved after
+# an interval of MAX_REVIEW_INTERVAL days
+FIRST_REVIEW_INTERVAL = 1.0
+REVIEW_INTERVAL_GROWTH = 2.5
+MAX_REVIEW_INTERVAL = 60.0
+database = TrackedAPSWDatabase(None)
+
+
+class BaseModel(Model):
+    class Meta:
+        database = database
+
+
+class Attempt(BaseModel):
+    puzzle_id = IntegerField(index=True)
+    attempted_at = FloatField()
+    time_to_solve = FloatField(null=True)
+    solved = BooleanField()
+    hints_used = IntegerField(default=0)
+
+    class Meta:
+        table_name = "attempt"
+        # Covers looking up recent failures and recent successes
+        indexes = ((("solved", "attempted_at"), False),)
+
+
+class PuzzleProgress(BaseModel):
+    """A summary of the attempts at a puzzle, and its review schedule."""
+
+    puzzle_id = IntegerField(primary_key=True)
+    attempts = IntegerField(default=0)
+    times_solved = IntegerField(default=0)
+    last_attempted_at = FloatField()
+    review_interval = FloatField(null=True)
+    review_due = FloatField(null=True, index=True)
+
+    class Meta:
+        table_name = "puzzle_progress"
+
+
+class PuzzleProgressTheme(BaseModel):
+    theme_id = IntegerField()
+    puzzle_id = IntegerField()
+
+    class Meta:
+        table_name = "puzzle_progress_theme"
+        primary_key = CompositeKey("theme_id", "puzzle_id")
+        without_rowid = True
+
+
+class PuzzleSetPosition(BaseModel):
+    identifier = CharField(primary_key=True)
+    classifiers = TextField()
+    keyset = TextField(null=True)
+    # The rating the current pass through the set started from
+    lap_start = IntegerField(null=True)
+
+    class Meta:
+        table_name = "puzzle_set_position"
+
+
+class StoredPlayerRating(BaseModel):
+    data = TextField()
+
+    class Meta:
+        table_name = "player_rating"
+
+
+MODELS = (Attempt, PuzzleProgress, PuzzleProgressTheme, PuzzleSetPosition, StoredPlayerRating)
+
+
+@dataclasses.dataclass
+class PuzzleAttempt:
+    puzzle_id: int
+    theme_ids: t.Tuple[int]
+    solved: bool
+    time_to_solve: t.Optional[float] = None
+    hints_used: int = 0
+    attempted_at: float = dataclasses.field(default_factory=time.time)
+
+
+class PuzzleProgressStore:
+    """
+    Writes are buffered and done in a single transaction on `THREADED_EXECUTOR`,
+    so recording progress never blocks the GUI thread. Queries flush the buffer
+    first and block, so they should be done off the GUI thread too.
+    """
+
+    def __init__(self, database_file: str):
+        self.database_file = database_file
+        self._pending_attempts = []
+        self._pending_positions = {}
+        self._pending_rating = None
+        self._is_open = False
+        self._lock = threading.RLock()
+
+    def open(self):
+        with self._lock:
+            if self._is_open:
+                return
+            database.init(
+                self.database_file,
+                pragmas={"journal_mode": "wal", "synchronous": "normal"},
+                timeout=5,
+            )
+            database.create_tables(MODELS, safe=True)
+            self._is_open = True
+            if database.execute_sql("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                self._migrate_json_files()
+                database.execute_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _migrate_json_files(self):
+        from . import PuzzleSet
+
+        if os.path.isdir(LEGACY_HISTORY_DIRECTORY):
+            for filename in os.listdir(LEGACY_HISTORY_DIRECTORY):
+                try:
+                    with open(os.path.join(LEGACY_HISTORY_DIRECTORY, filename), "r") as file:
+                        parsed = json.load(file)
+                    puzzle_set = PuzzleSet(classifiers=tuple(parsed["classifiers"]))
+                    keyset = parsed.get("keyset") or puzzle_set.keyset_from_item_index(
+                        parsed.get("current_item_index")
+                    )
+                except (ValueError, KeyError):
+                    log.exception(f"Could not import puzzle history {filename}")
+                    continue
+                puzzle_set.keyset = tuple(keyset) if keyset else None
+                self.save_set_position(puzzle_set, flush=False)
+        self.flush()
+
+    def record_attempt(self, attempt: PuzzleAttempt):
+        with self._lock:
+            self._pending_attempts.append(attempt)
+        self._schedule_flush()
+
+    def save_set_position(self, puzzle_set, flush=True):
+        with self._lock:
+            self._pending_positions[puzzle_set.get_identifier()] = (
+                puzzle_set.classifiers,
+                puzzle_set.keyset,
+                puzzle_set.lap_start,
+            )
+        if flush:
+            self._schedule_flush()
+
+    def save_player_rating(self, rating_data: dict):
+        with self._lock:
+            self._pending_rating = rating_data
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # Changes buffered while a flush is running are picked up by the next one
+        THREADED_EXECUTOR.submit(self._flush_in_background)
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except apsw.Error:
+            log.exception("Failed to save puzzle progress")
+
+    def flush(self):
+        """Write all the buffered changes in one transaction."""
+        with self._lock:
+            if not (self._pending_attempts or self._pending_positions or self._pending_rating):
+                return
+            self.open()
+            with database.atomic():
+                for attempt in self._pending_attempts:
+                    self._write_attempt(attempt)
+                for (identifier, (classifiers, keyset, lap_start)) in self._pending_positions.items():
+                    PuzzleSetPosition.replace(
+                        identifier=identifier,
+                        classifiers=json.dumps(list(classifiers)),
+                        keyset=json.dumps(list(keyset)) if keyset else None,
+                        lap_start=lap_start,
+                    ).execute()
+                if self._pending_rating is not None:
+                    StoredPlayerRating.replace(
+                        id=1, data=json.dumps(self._pending_rating)
+                    ).execute()
+            self._pending_attempts.clear()
+            self._pending_positions.clear()
+            self._pending_rating = None
+
+    def _write_attempt(self, attempt):
+        Attempt.insert(
+            puzzle_id=attempt.puzzle_id,
+            attempted_at=attempt.attempted_at,
+            time_to_solve=attempt.time_to_solve,
+            solved=attempt.solved,
+            hints_used=attempt.hints_used,
+        ).execute()
+        progress = PuzzleProgress.get_or_none(PuzzleProgress.puzzle_id == attempt.puzzle_id)
+        if progress is None:
+            progress = PuzzleProgress(puzzle_id=attempt.puzzle_id)
+            PuzzleProgressTheme.insert_many(
+                [(theme_id, attempt.puzzle_id) for theme_id in attempt.theme_ids],
+                fields=[PuzzleProgressTheme.theme_id, PuzzleProgressTheme.puzzle_id],
+            ).on_conflict_ignore().execute()
+            is_new = True
+        else:
+            is_new = False
+        progress.attempts += 1
+        progress.times_solved += int(attempt.solved)
+        progress.last_attempted_at = attempt.attempted_at
+        if not attempt.solved:
+            progress.review_interval = FIRST_REVIEW_INTERVAL
+        elif progress.review_interval is not None:
+            progress.review_interval *= REVIEW_INTERVAL_GROWTH
+            if progress.review_interval > MAX_REVIEW_INTERVAL:
+                progress.review_interval = None
+        if progress.review_interval is None:
+            progress.review_due = None
+        else:
+            progress.review_due = attempt.attempted_at + progress.review_interval * DAY
+        progress.save(force_insert=is_new)
+
+    def _query(self, query):
+        with self._lock:
+            self.flush()
+            self.open()
+            return [puzzle_id for (puzzle_id,) in query.tuples()]
+
+    def get_set_position(self, identifier):
+        """Return the saved (classifiers, keyset, lap start) of a puzzle set, or None."""
+        with self._lock:
+            self.flush()
+            self.open()
+            position = PuzzleSetPosition.get_or_none(PuzzleSetPosition.identifier == identifier)
+        if position is None:
+            return
+        keyset = json.loads(position.keyset) if position.keyset else None
+        return (
+            json.loads(position.classifiers),
+            tuple(keyset) if keyset else None,
+            position.lap_start,
+        )
+
+    def load_player_rating(self):
+        with self._lock:
+            self.flush()
+            self.open()
+            stored_rating = StoredPlayerRating.get_or_none(StoredPlayerRating.id == 1)
+        return json.loads(stored_rating.data) if stored_rating else None
+
+    def get_unsolved_puzzle_ids(self, theme_id=None):
+        """Puzzles attempted but never solved, optionally only those of a theme."""
+        query = PuzzleProgress.select(PuzzleProgress.puzzle_id).where(PuzzleProgress.times_solved == 0)
+        if theme_id is not None:
+            query = (
+                PuzzleProgressTheme.select(PuzzleProgressTheme.puzzle_id)
+                .join(PuzzleProgress, on=(PuzzleProgress.puzzle_id == PuzzleProgressTheme.puzzle_id))
+                .where((PuzzleProgressTheme.theme_id == theme_id) & (PuzzleProgress.times_solved == 0))
+            )
+        return self._query(query)
+
+    def get_failed_puzzle_ids(self, since: float):
+        """Puzzles failed since the given timestamp, most recent first."""
+        return self._query(
+            Attempt.select(Attempt.puzzle_id)
+            .where((Attempt.solved == False) & (Attempt.attempted_at >= since))
+            .group_by(Attempt.puzzle_id)
+            .order_by(fn.MAX(Attempt.attempted_at).desc())
+        )
+
+    def get_recently_failed_puzzle_ids(self, days=7):
+        return self.get_failed_puzzle_ids(time.time() - days * DAY)
+
+    def get_review_queue(self, limit=None, now=None):
+        """Puzzles due for review, the longest overdue first."""
+        query = (
+            PuzzleProgress.select(PuzzleProgress.puzzle_id)
+            .where(PuzzleProgress.review_due <= (now or time.time()))
+            .order_by(PuzzleProgress.review_due.asc())
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        return self._query(query)
+
+    def close(self):
+        with self._lock:
+            try:
+                self.flush()
+            except apsw.Error:
+                log.exception("Failed to save puzzle progress")
+            if self._is_open:
+                database.close_all()
+                self._is_open = False
+
+
+PUZZLE_PROGRESS = PuzzleProgressStore(PROGRESS_DATABASE_FILE)
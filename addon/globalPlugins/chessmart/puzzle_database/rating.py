@@ -0,0 +1,127 @@
+# coding: utf-8
+
+"""The player's puzzle rating, updated with Glicko-2 after every rated puzzle."""
+
+import math
+import dataclasses
+import threading
+from logHandler import log
+from .progress import PUZZLE_PROGRESS
+
+
+GLICKO2_SCALE = 173.7178
+# Constrains the change in volatility over time
+GLICKO2_TAU = 0.5
+GLICKO2_CONVERGENCE_TOLERANCE = 0.000001
+DEFAULT_RATING = 1500.0
+DEFAULT_DEVIATION = 350.0
+DEFAULT_VOLATILITY = 0.06
+MIN_DEVIATION = 45.0
+# The puzzle database has no rating deviation for puzzles
+PUZZLE_RATING_DEVIATION = 80.0
+# Half the width of the rating window puzzles are selected from
+TARGET_RATING_WINDOW = 100
+
+
+def _g(phi):
+    return 1 / math.sqrt(1 + 3 * phi ** 2 / math.pi ** 2)
+
+
+@dataclasses.dataclass
+class PlayerRating:
+    rating: float = DEFAULT_RATING
+    deviation: float = DEFAULT_DEVIATION
+    volatility: float = DEFAULT_VOLATILITY
+    solved: int = 0
+    failed: int = 0
+
+    @property
+    def target_window(self):
+        """The (lowest, highest) puzzle rating to select puzzles from."""
+        target = round(self.rating)
+        return target - TARGET_RATING_WINDOW, target + TARGET_RATING_WINDOW
+
+    def update(self, puzzle_rating, solved: bool):
+        """Apply a Glicko-2 rating period made of a single game against the puzzle."""
+        score = 1.0 if solved else 0.0
+        mu = (self.rating - DEFAULT_RATING) / GLICKO2_SCALE
+        phi = self.deviation / GLICKO2_SCALE
+        mu_j = (puzzle_rating - DEFAULT_RATING) / GLICKO2_SCALE
+        g_j = _g(PUZZLE_RATING_DEVIATION / GLICKO2_SCALE)
+        expected = 1 / (1 + math.exp(-g_j * (mu - mu_j)))
+        variance = 1 / (g_j ** 2 * expected * (1 - expected))
+        delta = variance * g_j * (score - expected)
+        sigma = self._new_volatility(phi, variance, delta)
+        phi_star = math.sqrt(phi ** 2 + sigma ** 2)
+        new_phi = 1 / math.sqrt(1 / phi_star ** 2 + 1 / variance)
+        new_mu = mu + new_phi ** 2 * g_j * (score - expected)
+        self.rating = new_mu * GLICKO2_SCALE + DEFAULT_RATING
+        self.deviation = max(MIN_DEVIATION, new_phi * GLICKO2_SCALE)
+        self.volatility = sigma
+        if solved:
+            self.solved += 1
+        else:
+            self.failed += 1
+
+    def _new_volatility(self, phi, variance, delta):
+        # The Illinois algorithm, step 5 of Glickman's description of Glicko-2
+        a = math.log(self.volatility ** 2)
+
+        def f(x):
+            exp_x = math.exp(x)
+            return (
+                exp_x * (delta ** 2 - phi ** 2 - variance - exp_x)
+                / (2 * (phi ** 2 + variance + exp_x) ** 2)
+            ) - (x - a) / GLICKO2_TAU ** 2
+
+        big_a = a
+        if delta ** 2 > phi ** 2 + variance:
+            big_b = math.log(delta ** 2 - phi ** 2 - variance)
+        else:
+            k = 1
+            while f(a - k * GLICKO2_TAU) < 0:
+                k += 1
+            big_b = a - k * GLICKO2_TAU
+        f_a, f_b = f(big_a), f(big_b)
+        while abs(big_b - big_a) > GLICKO2_CONVERGENCE_TOLERANCE:
+            big_c = big_a + (big_a - big_b) * f_a / (f_b - f_a)
+            f_c = f(big_c)
+            if f_c * f_b <= 0:
+                big_a, f_a = big_b, f_b
+            else:
+                f_a /= 2
+            big_b, f_b = big_c, f_c
+        return math.exp(big_a / 2)
+
+
+class PlayerRatingStore:
+    """Loads the player rating once per process, and saves it to the progress store after every update."""
+
+    def __init__(self, progress_store=PUZZLE_PROGRESS):
+        self.progress_store = progress_store
+        self._rating = None
+        self._lock = threading.Lock()
+
+    def get(self) -> PlayerRating:
+        with self._lock:
+            if self._rating is None:
+                self._rating = self._load()
+            return self._rating
+
+    def record_result(self, puzzle_rating, solved: bool):
+        player_rating = self.get()
+        with self._lock:
+            player_rating.update(puzzle_rating, solved)
+            self.progress_store.save_player_rating(dataclasses.asdict(player_rating))
+        return player_rating
+
+    def _load(self):
+        try:
+            rating_data = self.progress_store.load_player_rating()
+            return PlayerRating(**rating_data) if rating_data else PlayerRating()
+        except Exception:
+            log.exception("Could not read the puzzle rating, starting from the default rating")
+            return PlayerRating()
+
+
+PLAYER_RATING = PlayerRatingStore()
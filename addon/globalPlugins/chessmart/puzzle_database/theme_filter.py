@@ -0,0 +1,114 @@
+# coding: utf-8
+
+"""
+Boolean filters over puzzle themes, evaluated against the theme bitsets
+of `PuzzleThemeMask`.
+Filters are combined with `&`, `|` and `~`, for example:
+`any_theme("fork", "pin") & ~has_theme("long")`.
+"""
+
+import operator
+import functools
+from .models import (
+    Theme,
+    PuzzleThemeMask,
+    THEME_MASK_WORD_BITS,
+    THEME_MASK_WORDS,
+    Value,
+)
+
+
+def get_theme_bits(slugs):
+    """Return a list with the bitset of each mask word for the given theme slugs."""
+    theme_ids_by_slug = {theme.slug: theme_id for (theme_id, theme) in Theme.get_all_by_id().items()}
+    words = [0] * THEME_MASK_WORDS
+    for slug in slugs:
+        try:
+            bit_number = theme_ids_by_slug[slug] - 1
+        except KeyError:
+            raise ValueError(f"Unknown puzzle theme: {slug}")
+        words[bit_number // THEME_MASK_WORD_BITS] |= 1 << (bit_number % THEME_MASK_WORD_BITS)
+    return words
+
+
+class ThemeFilter:
+    """Wraps a peewee expression over the mask columns, along with a readable description."""
+
+    def __init__(self, expression_factory, description):
+        # Theme ids are looked up when the filter is evaluated, not when it is built
+        self.expression_factory = expression_factory
+        self.description = description
+
+    def to_expression(self):
+        return self.expression_factory()
+
+    def __and__(self, other):
+        return ThemeFilter(
+            lambda: self.to_expression() & other.to_expression(),
+            f"({self.description} and {other.description})",
+        )
+
+    def __or__(self, other):
+        return ThemeFilter(
+            lambda: self.to_expression() | other.to_expression(),
+            f"({self.description} or {other.description})",
+        )
+
+    def __invert__(self):
+        return ThemeFilter(
+            lambda: ~self.to_expression(),
+            f"not {self.description}",
+        )
+
+    def __str__(self):
+        return self.description
+
+
+def _combine(expressions, combinator, default):
+    expressions = list(expressions)
+    if not expressions:
+        return Value(default)
+    return functools.reduce(combinator, expressions)
+
+
+def _describe(slugs, separator):
+    description = separator.join(slugs)
+    return f"({description})" if len(slugs) > 1 else description
+
+
+def any_theme(*slugs):
+    """Puzzles having at least one of the themes."""
+
+    def expression_factory():
+        return _combine(
+            (
+                (mask_field.bin_and(bits) != 0)
+                for (mask_field, bits) in zip(PuzzleThemeMask.get_mask_fields(), get_theme_bits(slugs))
+                if bits
+            ),
+            operator.or_,
+            False,
+        )
+
+    return ThemeFilter(expression_factory, _describe(slugs, " or "))
+
+
+def all_themes(*slugs):
+    """Puzzles having every one of the themes."""
+
+    def expression_factory():
+        return _combine(
+            (
+                (mask_field.bin_and(bits) == bits)
+                for (mask_field, bits) in zip(PuzzleThemeMask.get_mask_fields(), get_theme_bits(slugs))
+                if bits
+            ),
+            operator.and_,
+            True,
+        )
+
+    return ThemeFilter(expression_factory, _describe(slugs, " and "))
+
+
+def has_theme(slug):
+    return all_themes(slug)
@@ -0,0 +1,32 @@
+# coding: utf-8
+
+"""Chessmart settings, stored in NVDA's configuration."""
+
+import config
+
+
+CONFIG_SECTION = "chessmart"
+CONFIG_SPEC = {
+    "board_renderer": 'string(default="nanosvg")',
+    "engine_pool_size": "integer(default=1, min=0, max=4)",
+    "engine_idle_timeout": "integer(default=300, min=0)",
+    "engine_ponder": "boolean(default=True)",
+    "engine_move_overhead": "integer(default=50, min=0, max=5000)",
+    "opening_book_path": 'string(default="")',
+    "opening_book_max_depth": "integer(default=16, min=0)",
+    "opening_book_variety": "integer(default=3, min=1)",
+    "syzygy_path": 'string(default="")',
+    "gaviota_path": 'string(default="")',
+    "tablebase_max_pieces": "integer(default=5, min=3, max=7)",
+    "tablebase_cache_size": "integer(default=65536, min=0)",
+    "analysis_cache_max_entries": "integer(default=200000, min=0)",
+    "analysis_cache_min_depth": "integer(default=18, min=1)",
+    "game_analysis_workers": "integer(default=0, min=0, max=16)",
+    "game_analysis_depth": "integer(default=16, min=1)",
+    "puzzle_first_move_delay": "integer(default=2000, min=0, max=10000)",
+}
+config.conf.spec[CONFIG_SECTION] = CONFIG_SPEC
+
+
+def get_setting(key):
+    return config.conf[CONFIG_SECTION][key]
@@ -0,0 +1,56 @@
+# coding: utf-8
+
+"""
+Peewee keeps a connection per thread, and `Database.close` only closes the
+connection of the calling thread. The databases of the add-on are used from
+the GUI thread and from the workers of `THREADED_EXECUTOR`, so they keep
+track of every connection to close all of them when NVDA exits.
+"""
+
+import os
+import threading
+from logHandler import log
+from .helpers import import_bundled, LIB_DIRECTORY
+
+
+with import_bundled(os.path.join(LIB_DIRECTORY, "sqlite")):
+    import apsw
+    from playhouse.apsw_ext import APSWDatabase
+
+
+class TrackedAPSWDatabase(APSWDatabase):
+    """An `APSWDatabase` that can close the connections opened by every thread."""
+
+    def __init__(self, *args, **kwargs):
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _connect(self):
+        conn = super()._connect()
+        with self._connections_lock:
+            self._connections.add(conn)
+        return conn
+
+    def _close(self, conn):
+        with self._connections_lock:
+            self._connections.discard(conn)
+        super()._close(conn)
+
+    def close_all(self):
+        """Close the connections of all the threads.
+        Threads using the database afterwards open new connections.
+        """
+        with self._lock:
+            if not self.is_closed():
+                self.close()
+            with self._connections_lock:
+                connections = list(self._connections)
+                self._connections.clear()
+            for conn in connections:
+                try:
+                    conn.close()
+                except apsw.Error:
+                    log.exception("Failed to close a database connection")
+            # Forget the closed connections of the other threads
+            self._state = type(self._state)()
@@ -0,0 +1,415 @@
+# coding: utf-8
+
+"""
+A persistent index of the games in PGN files, so that large collections
+are only scanned once.
+For every file, keyed by its path, size and modification time, the index
+stores the byte offset and the main headers of each game. Files that were
+appended to since they were indexed are only scanned from the last game on.
+Kept in a SQLite database in NVDA's configuration directory.
+"""
+
+import os
+import re
+import time
+import threading
+import typing as t
+from collections import OrderedDict
+import globalVars
+from logHandler import log
+from ..helpers import import_bundled, LIB_DIRECTORY
+from ..sqlite_database import TrackedAPSWDatabase
+
+
+with import_bundled(os.path.join(LIB_DIRECTORY, "sqlite")):
+    from peewee import *
+
+
+PGN_INDEX_DATABASE_FILE = os.path.join(
+    globalVars.appArgs.configPath, ".chessmart.pgn.index.sqlite"
+)
+# The bytes before the end of the indexed part of a file are kept, to tell
+# whether a file that grew was appended to or rewritten
+FINGERPRINT_SIZE = 256
+INDEX_BATCH_SIZE = 5000
+# Bumped when the scanner changes how files are split into games
+INDEX_VERSION = 1
+GAME_PAGE_SIZE = 100
+MAX_CACHED_GAME_PAGES = 16
+INDEXED_HEADERS = ("White", "Black", "Date", "Event", "Site", "Result", "Termination")
+# The same as the tag pair pattern of `chess.pgn`, which does not unescape values
+HEADER_PATTERN = re.compile(rb'^\[([A-Za-z0-9_]+)\s+"([^\r]*)"\]\s*$')
+UTF8_BOM = b"\xef\xbb\xbf"
+COMMENT_DELIMITER_PATTERN = re.compile(rb"[{};]")
+# States of the PGN scanner
+BETWEEN_GAMES, IN_HEADERS, IN_MOVETEXT = range(3)
+INSERT_GAME_SQL = (
+    "INSERT INTO indexed_game (file_id, game_number, offset, white, black, date, event, site, result, termination)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+# Written from `THREADED_EXECUTOR` and read from the GUI thread
+database = TrackedAPSWDatabase(None)
+
+
+class BaseModel(Model):
+    class Meta:
+        database = database
+
+
+class IndexedFile(BaseModel):
+    path = TextField(unique=True)
+    size = IntegerField()
+    mtime = FloatField()
+    fingerprint = BlobField()
+
+    class Meta:
+        table_name = "indexed_file"
+
+
+class IndexedGame(BaseModel):
+    file_id = IntegerField()
+    game_number = IntegerField()
+    offset = IntegerField()
+    white = TextField(null=True)
+    black = TextField(null=True)
+    date = TextField(null=True)
+    event = TextField(null=True)
+    site = TextField(null=True)
+    result = TextField(null=True)
+    termination = TextField(null=True)
+
+    class Meta:
+        table_name = "indexed_game"
+        primary_key = CompositeKey("file_id", "game_number")
+        without_rowid = True
+
+
+MODELS = (IndexedFile, IndexedGame)
+
+
+def _is_in_comment_after(line: bytes, in_comment: bool):
+    """Whether a brace comment is still open at the end of a movetext line."""
+    for match in COMMENT_DELIMITER_PATTERN.finditer(line):
+        delimiter = match.group(0)
+        if in_comment:
+            in_comment = delimiter != b"}"
+        elif delimiter == b"{":
+            in_comment = True
+        elif delimiter == b";":
+            # The rest of the line is a comment
+            break
+    return in_comment
+
+
+def scan_pgn_headers(file: t.BinaryIO, start_offset=0):
+    """
+    Yield (byte offset, headers) for every game in a PGN file opened in binary mode,
+    starting at `start_offset`, which should be the start of a game.
+    Games are split as `chess.pgn.read_game` splits them: a game starts at its first
+    line that is neither blank nor a comment, with or without tag pairs, and its
+    movetext ends at the first blank line outside a brace comment.
+    Only the tag pairs are parsed; games without any have empty headers.
+    """
+    file.seek(start_offset)
+    offset = start_offset
+    state = BETWEEN_GAMES
+    game_offset = None
+    headers = None
+    blank_line_in_headers = False
+    in_comment = False
+    for line in file:
+        line_length = len(line)
+        if offset == 0 and line.startswith(UTF8_BOM):
+            line = line[len(UTF8_BOM):]
+        is_blank = line.isspace() or not line
+        is_line_comment = line.startswith((b"%", b";"))
+        if state == BETWEEN_GAMES and not (is_blank or is_line_comment):
+            if headers is not None:
+                yield game_offset, headers
+            game_offset = offset
+            headers = {}
+            state = IN_HEADERS
+            blank_line_in_headers = False
+        if state == IN_HEADERS and not is_line_comment:
+            if is_blank:
+                # A single blank line may separate the tag pairs
+                if blank_line_in_headers:
+                    state = BETWEEN_GAMES
+                blank_line_in_headers = True
+            else:
+                blank_line_in_headers = False
+                match = HEADER_PATTERN.match(line) if line.startswith(b"[") else None
+                if match is None:
+                    state = IN_MOVETEXT
+                    in_comment = False
+                else:
+                    name = match.group(1).decode("ascii")
+                    if name in INDEXED_HEADERS:
+                        headers[name] = match.group(2).decode("utf-8", "replace")
+        if state == IN_MOVETEXT:
+            if in_comment:
+                in_comment = _is_in_comment_after(line, True)
+            elif is_blank:
+                state = BETWEEN_GAMES
+            elif not is_line_comment:
+                in_comment = _is_in_comment_after(line, False)
+        offset += line_length
+    if headers is not None:
+        yield game_offset, headers
+
+
+class PGNIndex:
+    """
+    `get_game_source` blocks while a file is being indexed, so it should be called
+    off the GUI thread.
+    """
+
+    def __init__(self, database_file: str, batch_size=INDEX_BATCH_SIZE):
+        self.database_file = database_file
+        self.batch_size = batch_size
+        self._is_open = False
+        self._lock = threading.RLock()
+
+    def open(self):
+        with self._lock:
+            if self._is_open:
+                return
+            database.init(
+                self.database_file,
+                pragmas={"journal_mode": "wal", "synchronous": "normal"},
+                timeout=5,
+            )
+            database.create_tables(MODELS, safe=True)
+            self._is_open = True
+            if database.execute_sql("PRAGMA user_version").fetchone()[0] < INDEX_VERSION:
+                # Indexed by an older scanner, which split some games wrongly
+                with database.atomic():
+                    IndexedGame.delete().execute()
+                    IndexedFile.delete().execute()
+                database.execute_sql(f"PRAGMA user_version = {INDEX_VERSION}")
+
+    @staticmethod
+    def get_file_key(filename):
+        return os.path.normcase(os.path.abspath(filename))
+
+    @staticmethod
+    def read_fingerprint(file: t.BinaryIO, size: int):
+        start = max(0, size - FINGERPRINT_SIZE)
+        file.seek(start)
+        return file.read(size - start)
+
+    def index_file(self, filename, progress_callback=None):
+        """
+        Bring the index of the file up to date, and return its id in the index.
+        `progress_callback(games_indexed)` is called while indexing.
+        """
+        path = self.get_file_key(filename)
+        stat = os.stat(path)
+        with self._lock:
+            self.open()
+            indexed_file = IndexedFile.get_or_none(IndexedFile.path == path)
+            if (
+                indexed_file is None
+                or indexed_file.size != stat.st_size
+                or indexed_file.mtime != stat.st_mtime
+            ):
+                self._update_index(path, stat, indexed_file, progress_callback)
+                indexed_file = IndexedFile.get(IndexedFile.path == path)
+            return indexed_file.id
+
+    def get_game_source(self, filename, progress_callback=None):
+        """The games of the file, read from the index as they are needed."""
+        return PGNGameSource(self, self.index_file(filename, progress_callback))
+
+    def fetch_games(self, where, limit=None, skip=None):
+        """Return (game number, byte offset, headers) for the matching games, in game order."""
+        self.open()
+        query = (
+            IndexedGame.select(
+                IndexedGame.game_number,
+                IndexedGame.offset,
+                *(getattr(IndexedGame, header.lower()) for header in INDEXED_HEADERS),
+            )
+            .where(where)
+            .order_by(IndexedGame.game_number)
+        )
+        if limit is not None:
+            query = query.limit(limit).offset(skip)
+        return [
+            (
+                game_number,
+                offset,
+                {
+                    header: value
+                    for (header, value) in zip(INDEXED_HEADERS, values)
+                    if value is not None
+                },
+            )
+            for (game_number, offset, *values) in query.tuples()
+        ]
+
+    def count_games(self, where):
+        self.open()
+        return IndexedGame.select().where(where).count()
+
+    def _update_index(self, path, stat, indexed_file, progress_callback):
+        start = time.perf_counter()
+        with open(path, "rb") as file, database.atomic():
+            start_offset = 0
+            game_number = 0
+            if indexed_file is not None:
+                if stat.st_size > indexed_file.size and (
+                    self.read_fingerprint(file, indexed_file.size) == indexed_file.fingerprint
+                ):
+                    # Appended to: the last game may have been extended, so rescan it
+                    last_game = (
+                        IndexedGame.select()
+                        .where(IndexedGame.file_id == indexed_file.id)
+                        .order_by(IndexedGame.game_number.desc())
+                        .first()
+                    )
+                    if last_game is not None:
+                        start_offset = last_game.offset
+                        game_number = last_game.game_number
+                    IndexedGame.delete().where(
+                        (IndexedGame.file_id == indexed_file.id)
+                        & (IndexedGame.game_number >= game_number)
+                    ).execute()
+                else:
+                    IndexedGame.delete().where(IndexedGame.file_id == indexed_file.id).execute()
+                file_id = indexed_file.id
+            else:
+                file_id = IndexedFile.insert(
+                    path=path, size=0, mtime=0.0, fingerprint=b""
+                ).execute()
+            rows = []
+            for (game_number, (offset, headers)) in enumerate(
+                scan_pgn_headers(file, start_offset), start=game_number
+            ):
+                rows.append(
+                    (
+                        file_id,
+                        game_number,
+                        offset,
+                        *(headers.get(header) for header in INDEXED_HEADERS),
+                    )
+                )
+                if len(rows) >= self.batch_size:
+                    self._insert_games(rows)
+                    rows.clear()
+                    if progress_callback is not None:
+                        progress_callback(game_number + 1)
+            self._insert_games(rows)
+            IndexedFile.update(
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                fingerprint=self.read_fingerprint(file, stat.st_size),
+            ).where(IndexedFile.id == file_id).execute()
+        log.info(
+            f"Indexed {path} from offset {start_offset} in {time.perf_counter() - start:.2f} seconds"
+        )
+
+    @staticmethod
+    def _insert_games(rows):
+        cursor = database.cursor()
+        try:
+            cursor.executemany(INSERT_GAME_SQL, rows)
+        finally:
+            cursor.close()
+
+    def close(self):
+        with self._lock:
+            if self._is_open:
+                database.close_all()
+                self._is_open = False
+
+
+class PGNGameSource:
+    """
+    The games of an indexed file, optionally filtered, read from the index a page
+    at a time as they are asked for, keeping at most `max_cached_pages` pages.
+    Meant to back virtual list controls, which ask for the rows as they are shown.
+    """
+
+    def __init__(
+        self,
+        index: PGNIndex,
+        file_id: int,
+        page_size=GAME_PAGE_SIZE,
+        max_cached_pages=MAX_CACHED_GAME_PAGES,
+    ):
+        self.index = index
+        self.file_id = file_id
+        self.page_size = page_size
+        self.max_cached_pages = max_cached_pages
+        self.filter_text = ""
+        self._pages = OrderedDict()
+        with self.index._lock:
+            self._count = self.index.count_games(self._get_where())
+
+    def __len__(self):
+        return self._count
+
+    def _get_where(self):
+        where = IndexedGame.file_id == self.file_id
+        # Every word should be found in one of the filtered headers
+        for word in self.filter_text.split():
+            where &= (
+                IndexedGame.white.contains(word)
+                | IndexedGame.black.contains(word)
+                | IndexedGame.event.contains(word)
+                | IndexedGame.date.contains(word)
+                | IndexedGame.result.contains(word)
+            )
+        return where
+
+    def set_filter(self, filter_text: str):
+        """Only keep the games whose players, event, date or result contain every word of the text."""
+        filter_text = filter_text.strip()
+        if filter_text == self.filter_text:
+            return
+        with self.index._lock:
+            self.filter_text = filter_text
+            self._pages.clear()
+            self._count = self.index.count_games(self._get_where())
+
+    def get_game(self, row: int):
+        """Return the (byte offset, headers) of the game at the given row."""
+        page_number, row_in_page = divmod(row, self.page_size)
+        __, offset, headers = self._get_page(page_number)[row_in_page]
+        return offset, headers
+
+    def _get_page(self, page_number):
+        with self.index._lock:
+            page = self._pages.get(page_number)
+            if page is not None:
+                self._pages.move_to_end(page_number)
+                return page
+            where = self._get_where()
+            if not self.filter_text:
+                # Game numbers are contiguous
+                first_game_number = page_number * self.page_size
+                page = self.index.fetch_games(
+                    where
+                    & (IndexedGame.game_number >= first_game_number)
+                    & (IndexedGame.game_number < first_game_number + self.page_size)
+                )
+            elif page_number - 1 in self._pages:
+                # Continue from the previous page, instead of skipping the rows before it
+                last_game_number = self._pages[page_number - 1][-1][0]
+                page = self.index.fetch_games(
+                    where & (IndexedGame.game_number > last_game_number),
+                    limit=self.page_size,
+                    skip=0,
+                )
+            else:
+                page = self.index.fetch_games(
+                    where, limit=self.page_size, skip=page_number * self.page_size
+                )
+            self._pages[page_number] = page
+            if len(self._pages) > self.max_cached_pages:
+                self._pages.popitem(last=False)
+            return page
+
+
+PGN_INDEX = PGNIndex(PGN_INDEX_DATABASE_FILE)
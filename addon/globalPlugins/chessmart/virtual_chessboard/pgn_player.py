@@ -31,26 +31,18 @@ class PGNGameInfo:
     @classmethod
     def args_from_headers(cls, headers):
         return dict(
-            result=cls.parse_pgn_result_string(headers.get("Result", "")),
+            result=cls.parse_pgn_result_string(headers.get("Result", "*")),
             white=headers.get("White", "?"),
             black=headers.get("Black", "?"),
             date=headers.get("Date", "????.??.??"),
-            event=headers.get("Date", "?"),
-            site=headers.get("Date", "?"),
+            event=headers.get("Event", "?"),
+            site=headers.get("Site", "?"),
             termination=headers.get("Termination"),
         )
 
     @classmethod
-    def game_info_from_pgn_filename(cls, filename):
-        with open(filename, "r", encoding="utf-8") as file:
-            while True:
-                offset = file.tell()
-                headers = chess.pgn.read_headers(file)
-                if headers is None:
-                    break
-                yield cls(
-                    filename=filename, offset=offset, **cls.args_from_headers(headers)
-                )
+    def from_headers(cls, filename, offset, headers):
+        return cls(filename=filename, offset=offset, **cls.args_from_headers(headers))
 
     @property
     def description(self):
@@ -85,6 +77,7 @@ class PGNGame:
     @classmethod
     def from_game_info(cls, info):
         with open(info.filename, "r", encoding="utf-8") as file:
+            # Offsets are byte offsets, which text files accept at line starts
             file.seek(info.offset)
             game = chess.pgn.read_game(file)
             return cls(
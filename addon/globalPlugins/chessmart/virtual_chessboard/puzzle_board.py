@@ -2,16 +2,21 @@
 
 import tones
 import wx
+import time
 import dataclasses
 import typing as t
 import functools
 import queueHandler
 import ui
 import speech
+from logHandler import log
 from scriptHandler import script, getLastScriptRepeatCount
 from ..signals import game_started_signal
 from ..helpers import import_bundled, GameSound, speak_next, intersperse
-from ..puzzle_database import PuzzleSet
+from ..concurrency import THREADED_EXECUTOR
+from ..settings import get_setting
+from ..board_rendering import RenderedTiles
+from ..puzzle_database import PuzzleSet, PuzzleInfo, PuzzleAttempt, PLAYER_RATING, PUZZLE_PROGRESS
 from .user_driven import UserDrivenChessboard, UserDrivenCell
 
 with import_bundled():
@@ -19,22 +24,30 @@ with import_bundled():
 
 
 
+@dataclasses.dataclass
+class PreparedPuzzle:
+    """A puzzle with everything needed to show it, built off the GUI thread."""
+
+    puzzle: PuzzleInfo
+    board: chess.Board
+    prospective: chess.Color
+    info_speech: t.List
+    to_move_message: str
+    # The board tiles shown after the first move, to hand to the compositor on the GUI thread
+    tiles: t.Optional[RenderedTiles] = None
+
+
 class PuzzleCell(UserDrivenCell):
     @script(gesture="kb:control+f1")
     def script_puzzle_info(self, gesture):
-        puzzle = self.parent.puzzle
-        spoken_msgs = [
-            _("{category}: {description}").format(category=label, description=description)
-            for (label, description) in puzzle.get_theme_info()
-        ] + [
-            _("Rating: {rating}").format(rating=puzzle.rating),
-            speech.commands.BreakCommand(100),
-            _("Puzzle ID: {puzzle_id}").format(puzzle_id=puzzle.puzzle_id),
-        ]
-        speak_next(intersperse(spoken_msgs, speech.commands.BreakCommand(100)))
+        if self.parent.prepared_puzzle is None:
+            return
+        speak_next(self.parent.prepared_puzzle.info_speech)
 
     @script(gesture="kb:control+enter")
     def script_solve_puzzle(self, gesture):
+        if self.parent.puzzle is None:
+            return
         solution_move = self.parent.puzzle.solution_moves[0]
         if self.parent.board.move_stack[-1] == solution_move:
             speak_next([
@@ -43,6 +56,7 @@ class PuzzleCell(UserDrivenCell):
             ])
             return
         if getLastScriptRepeatCount() > 0:
+            self.parent.hints_used += 1
             self.parent.move_piece_and_check_game_status(solution_move, auto_solved=True)
         else:
             speak_next(["Press twice to execute the solution move"])
@@ -59,14 +73,46 @@ class PuzzleChessboard(UserDrivenChessboard):
             self.puzzles = puzzles.load_history()
         except FileNotFoundError:
             self.puzzles = puzzles
+        # Saved back when the board is closed before the first puzzle is shown
+        self._start_keyset = self.puzzles.keyset
         self.puzzle = None
+        self.prepared_puzzle = None
+        self._next_puzzle_future = None
+        self.puzzle_rated = False
+        self.puzzle_solved = None
+        self.puzzle_started_at = None
+        self.hints_used = 0
         self.next_puzzle()
 
     def hide_board_gui(self):
-        self.puzzles.save_history()
+        self.record_attempt()
+        # A puzzle that is still being prepared is not shown once the board is closed
+        future, self._next_puzzle_future = self._next_puzzle_future, None
+        if future is None or future.cancel():
+            self.save_puzzle_set_position()
+        else:
+            # The puzzle being prepared moves the set past the current one,
+            # so save once it is done, without blocking the GUI thread
+            future.add_done_callback(
+                lambda f: wx.CallAfter(self.save_puzzle_set_position)
+            )
         super().hide_board_gui()
 
+    def save_puzzle_set_position(self):
+        # Resume after the current puzzle, not after the prepared one
+        if self.puzzle is not None:
+            self.puzzles.keyset = self.puzzle.keyset
+        else:
+            self.puzzles.keyset = self._start_keyset
+        self.puzzles.save_history()
+
     def next_puzzle(self):
+        """
+        Show the puzzle prepared while the current one was being solved. The first
+        puzzle, and any puzzle not prepared yet, is shown once it is ready,
+        without blocking the GUI thread.
+        """
+        self.record_attempt()
         if self.puzzle is None:
             pre_speech = [
                 "Loading puzzle",
@@ -75,9 +121,24 @@ class PuzzleChessboard(UserDrivenChessboard):
             pre_speech = [
                 "Loading next puzzle",
             ]
+        future = self._next_puzzle_future
+        if future is None:
+            future = self._next_puzzle_future = THREADED_EXECUTOR.submit(self.prepare_puzzle)
+        future.add_done_callback(
+            lambda f: wx.CallAfter(self._show_prepared_puzzle, f, pre_speech)
+        )
+
+    def _show_prepared_puzzle(self, future, pre_speech):
+        if future is not self._next_puzzle_future:
+            # The board was closed in the meantime
+            return
+        self._next_puzzle_future = None
         try:
-            self.puzzle = next(self.puzzles)
-        except StopIteration:
+            prepared_puzzle = future.result()
+        except Exception:
+            log.exception("Failed to prepare the next puzzle")
+            prepared_puzzle = None
+        if prepared_puzzle is None:
             speak_next([
                 "All Done",
                 speech.commands.WaveFileCommand(GameSound.drawn.filename),
@@ -86,21 +147,70 @@ class PuzzleChessboard(UserDrivenChessboard):
         else:
             if self.is_game_over:
                 self.is_game_over = False
-            self.board.reset()
-            self.board.set_fen(self.puzzle.fen)
-            self.prospective = not self.board.turn
+            self.prepared_puzzle = prepared_puzzle
+            if prepared_puzzle.tiles:
+                self.dialog.board_compositor.add_tiles(prepared_puzzle.tiles)
+            self.puzzle = prepared_puzzle.puzzle
+            self.puzzle_rated = False
+            self.puzzle_solved = None
+            self.puzzle_started_at = None
+            self.hints_used = 0
+            self.board = prepared_puzzle.board
+            self.prospective = prepared_puzzle.prospective
             self.score_sheet_menu.clear()
             queueHandler.queueFunction(queueHandler.eventQueue, speak_next, pre_speech)
-            wx.CallLater(2000, self._perform_puzzle_first_move)
+            wx.CallLater(get_setting("puzzle_first_move_delay"), self._perform_puzzle_first_move)
+            self._next_puzzle_future = THREADED_EXECUTOR.submit(self.prepare_puzzle)
+
+    def prepare_puzzle(self):
+        """
+        Load the next puzzle, set up its board, build its speech, and rasterize
+        the board tiles it needs. Runs on `THREADED_EXECUTOR` while the current
+        puzzle is being solved. Returns a `PreparedPuzzle`, or None when the set is done.
+        """
+        try:
+            puzzle = next(self.puzzles)
+        except StopIteration:
+            return
+        board = puzzle.get_board()
+        prospective = not board.turn
+        info_speech = [
+            _("{category}: {description}").format(category=label, description=description)
+            for (label, description) in puzzle.get_theme_info()
+        ] + [
+            _("Rating: {rating}").format(rating=puzzle.rating),
+            speech.commands.BreakCommand(100),
+            _("Puzzle ID: {puzzle_id}").format(puzzle_id=puzzle.puzzle_id),
+        ]
+        tiles = None
+        try:
+            board_after_first_move = board.copy(stack=False)
+            board_after_first_move.push(puzzle.auto_performed_move)
+            tiles = self.dialog.board_compositor.render_tiles(
+                board_after_first_move,
+                lastmove=puzzle.auto_performed_move,
+                flipped=prospective == chess.BLACK,
+            )
+        except Exception:
+            log.exception("Failed to prepare the board tiles of the next puzzle")
+        return PreparedPuzzle(
+            puzzle=puzzle,
+            board=board,
+            prospective=prospective,
+            info_speech=list(intersperse(info_speech, speech.commands.BreakCommand(100))),
+            to_move_message=_("{color} to move").format(
+                color=self.game_announcer.color_name(prospective)
+            ),
+            tiles=tiles,
+        )
 
     def _perform_puzzle_first_move(self):
         king_square = self.board.king(self.prospective)
         king_square_focus_callback = functools.partial(self.set_focus_to_cell, king_square)
-        color_name = self.game_announcer.color_name(self.prospective)
         post_speech = [
             "",
             speech.commands.BreakCommand(500),
-            _("{color} to move").format(color=color_name),
+            self.prepared_puzzle.to_move_message,
             speech.commands.BreakCommand(100),
             speech.commands.CallbackCommand(king_square_focus_callback),
         ]
@@ -109,10 +219,42 @@ class PuzzleChessboard(UserDrivenChessboard):
             pre_speech=(),
             post_speech=post_speech
         )
+        self.puzzle_started_at = time.monotonic()
+
+    def rate_puzzle(self, solved):
+        """Update the player's rating with the first outcome of the current puzzle."""
+        if self.puzzle_rated:
+            return
+        self.puzzle_rated = True
+        self.puzzle_solved = solved
+        player_rating = PLAYER_RATING.record_result(self.puzzle.rating, solved)
+        log.debug(f"Puzzle rating: {player_rating.rating:.0f} (deviation {player_rating.deviation:.0f})")
+
+    def record_attempt(self, time_to_solve=None):
+        """Save the outcome of the current puzzle to the progress store, once it has one."""
+        if self.puzzle_solved is None:
+            return
+        PUZZLE_PROGRESS.record_attempt(PuzzleAttempt(
+            puzzle_id=self.puzzle.puzzle_id,
+            theme_ids=tuple(theme.id for theme in self.puzzle.themes),
+            solved=self.puzzle_solved,
+            time_to_solve=time_to_solve,
+            hints_used=self.hints_used,
+        ))
+        self.puzzle_solved = None
 
     def move_piece_and_check_game_status(self, move, pre_speech=(), post_speech=(), auto_solved=False):
+        if self.puzzle is None:
+            speak_next(["Loading puzzle"])
+            return
         if self.board.turn == self.prospective:
             if move in self.puzzle.solution_moves:
+                # Asking for the solution counts as a failure
+                self.rate_puzzle(solved=not auto_solved)
+                time_to_solve = None
+                if self.puzzle_started_at is not None:
+                    time_to_solve = time.monotonic() - self.puzzle_started_at
+                self.record_attempt(time_to_solve)
                 puzzle_messages = [
                     speech.commands.BreakCommand(500),
                     speech.commands.WaveFileCommand(GameSound.puzzle_solved.filename),
@@ -126,6 +268,7 @@ class PuzzleChessboard(UserDrivenChessboard):
                     puzzle_messages.insert(1,  speech.commands.BreakCommand(250))
                 post_speech = list(post_speech) + puzzle_messages
             else:
+                self.rate_puzzle(solved=False)
                 speak_next([
                     speech.commands.WaveFileCommand(GameSound.invalid.filename),
                     f"{move} is not the expected move"
@@ -3,7 +3,6 @@
 import os
 import time
 import threading
-import subprocess
 import functools
 import dataclasses
 import wx
@@ -14,7 +13,17 @@ import eventHandler
 from logHandler import log
 from ..helpers import import_bundled, GameSound, BIN_DIRECTORY
 from ..signals import move_completed_signal, chessboard_opened_signal, game_started_signal, game_over_signal
-from ..concurrency import call_threaded
+from ..concurrency import THREADED_EXECUTOR, asyncio_coroutine_to_concurrent_future
+from ..chess_engine import (
+    ENGINE_POOL,
+    OPENING_BOOK,
+    ENDGAME_TABLEBASE,
+    ANALYSIS_CACHE,
+    ENGINE_COMMAND_TIMEOUT,
+    EngineTimeManager,
+    MIN_MOVE_TIME,
+)
+from ..settings import get_setting
 from .user_driven import UserDrivenChessboard
 
 
@@ -27,17 +36,62 @@ FAIRY_STOCKFISH_EXECUTABLE_PATH = os.path.join(
 
 
 with import_bundled():
+    import asyncio
     import chess
     import chess.engine
 
 
+@dataclasses.dataclass
+class PonderStats:
+    """Per game statistics of engine pondering."""
+
+    replies: int = 0
+    ponderhits: int = 0
+    ponderhit_latency: float = 0.0
+    ponder_miss_latency: float = 0.0
+
+    def add_reply(self, latency, is_ponderhit):
+        self.replies += 1
+        if is_ponderhit:
+            self.ponderhits += 1
+            self.ponderhit_latency += latency
+        else:
+            self.ponder_miss_latency += latency
+
+    @property
+    def ponderhit_rate(self):
+        return self.ponderhits / self.replies if self.replies else 0.0
+
+    @property
+    def latency_saved(self):
+        """Estimated from the mean latency of replies that were searched from scratch."""
+        misses = self.replies - self.ponderhits
+        if not (misses and self.ponderhits):
+            return 0.0
+        mean_miss_latency = self.ponder_miss_latency / misses
+        return max(0.0, mean_miss_latency * self.ponderhits - self.ponderhit_latency)
+
+    def __str__(self):
+        return (
+            f"{self.ponderhits}/{self.replies} ponderhits ({self.ponderhit_rate:.0%}), "
+            f"about {self.latency_saved:.1f}s of reply latency saved"
+        )
+
+
 class UserEngineChessboard(UserDrivenChessboard):
     def __init__(self, *args, uci_options, uci_time_limit, **kwargs):
         super().__init__(*args, **kwargs)
         self.uci_options = uci_options or {}
         self.uci_time_limit = uci_time_limit or 2.0
+        self.use_pondering = get_setting("engine_ponder")
+        self.expected_reply = None
+        self.ponder_stats = PonderStats()
+        self.time_manager = EngineTimeManager(
+            default_move_time=self.uci_time_limit,
+            move_overhead=get_setting("engine_move_overhead") / 1000,
+        )
         self.prospective = self.prospective if self.prospective is not None else True
-        self.uci_engine = self.get_uci_engine(self._get_uci_engine_path())
+        self._uci_engine_future = self.acquire_uci_engine()
         # Events
         move_completed_signal.connect(self.on_move_completed, sender=self)
         game_started_signal.connect(self.on_game_started, sender=self)
@@ -50,36 +104,75 @@ class UserEngineChessboard(UserDrivenChessboard):
         else:
             return  FAIRY_STOCKFISH_EXECUTABLE_PATH
 
-    def get_uci_engine(self, executable):
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        uci_engine = chess.engine.SimpleEngine.popen_uci(
-            executable,
-            creationflags=subprocess.CREATE_NO_WINDOW
-            | subprocess.CREATE_NEW_PROCESS_GROUP,
-            startupinfo=startupinfo,
-            close_fds=True,
-        )
-        uci_engine.configure(self.uci_options)
-        return uci_engine
+    @asyncio_coroutine_to_concurrent_future
+    async def acquire_uci_engine(self):
+        return await ENGINE_POOL.acquire(self._get_uci_engine_path(), self.uci_options)
+
+    async def get_uci_engine(self):
+        if self._uci_engine_future is None:
+            raise chess.engine.EngineTerminatedError("The engine has been released")
+        return await asyncio.wrap_future(self._uci_engine_future)
+
+    async def stop_pondering(self):
+        """Stop the ponder search, if any, when replying without the engine.
+        Any new command cancels the pending `go ponder` with `stop`.
+        """
+        if not self.use_pondering or self._uci_engine_future is None:
+            return
+        uci_engine = await self.get_uci_engine()
+        await asyncio.wait_for(uci_engine.ping(), ENGINE_COMMAND_TIMEOUT)
+
+    @asyncio_coroutine_to_concurrent_future
+    async def release_uci_engine(self, uci_engine_future):
+        try:
+            uci_engine = await asyncio.wrap_future(uci_engine_future)
+        except Exception:
+            return
+        await ENGINE_POOL.release(uci_engine)
 
     def on_game_over(self, sender, board_outcome):
-        self.uci_engine.quit()
+        uci_engine_future, self._uci_engine_future = self._uci_engine_future, None
+        if uci_engine_future is not None:
+            self.release_uci_engine(uci_engine_future)
+        if self.use_pondering:
+            log.debug(f"Engine pondering: {self.ponder_stats}")
+        log.debug(f"Opening book: {OPENING_BOOK}")
+        log.debug(f"Endgame tablebase: {ENDGAME_TABLEBASE}")
+        log.debug(f"Analysis cache: {ANALYSIS_CACHE}")
+        THREADED_EXECUTOR.submit(ANALYSIS_CACHE.flush_in_background)
 
     def on_move_completed(self, sender, move, move_maker):
         if self.is_game_over:
             return
         if self.board.turn is not self.prospective:
-            self.get_next_move_from_engine().add_done_callback(
-                lambda future: wx.CallAfter(self.engine_play, future)
+            is_ponderhit = self.expected_reply is not None and move == self.expected_reply
+            self.request_engine_move(is_ponderhit)
+
+    def request_engine_move(self, is_ponderhit=False):
+        request_time = time.perf_counter()
+        self.get_next_move_from_engine().add_done_callback(
+            lambda future: wx.CallAfter(
+                self.engine_play, future, request_time, is_ponderhit
             )
+        )
 
-    def engine_play(self, future):
+    def engine_play(self, future, request_time=None, is_ponderhit=False):
         try:
             play_result = future.result()
-        except chess.engine.EngineError:
+        except asyncio.CancelledError:
+            # The search was cancelled by a newer engine command, such as
+            # the engine being handed back to the pool when the game ended
+            log.debug("The engine move request was cancelled")
+            return
+        except (chess.engine.EngineError, asyncio.TimeoutError, OSError):
+            log.exception("Failed to get the engine move")
             wx.CallAfter(self.game_error)
             return
+        if request_time is not None:
+            self.ponder_stats.add_reply(
+                time.perf_counter() - request_time, is_ponderhit
+            )
+        self.expected_reply = play_result.ponder if self.use_pondering else None
         if play_result.resigned:
             wx.CallAfter(self.game_resigned)
         else:
@@ -87,22 +180,82 @@ class UserEngineChessboard(UserDrivenChessboard):
                 self.draw_offered = True
             wx.CallAfter(self.move_piece_and_check_game_status, play_result.move)
 
-    @call_threaded
-    def get_next_move_from_engine(self):
+    @asyncio_coroutine_to_concurrent_future
+    async def get_next_move_from_engine(self):
+        loop = asyncio.get_event_loop()
+        board = self.board.copy()
+        book_move = OPENING_BOOK.probe(board)
+        if book_move is not None:
+            await self.stop_pondering()
+            return chess.engine.PlayResult(book_move, None)
+        if ENDGAME_TABLEBASE.is_candidate(board):
+            tablebase_move = await loop.run_in_executor(
+                THREADED_EXECUTOR, ENDGAME_TABLEBASE.probe_move, board.copy()
+            )
+            if tablebase_move is not None:
+                await self.stop_pondering()
+                return chess.engine.PlayResult(tablebase_move, None)
+        uci_engine = await self.get_uci_engine()
+        engine_key = ANALYSIS_CACHE.make_engine_key(
+            uci_engine.id.get("name"), self.uci_options, board.uci_variant
+        )
+        cached_analysis = await loop.run_in_executor(
+            THREADED_EXECUTOR,
+            functools.partial(
+                ANALYSIS_CACHE.get,
+                board,
+                engine_key,
+                min_depth=get_setting("analysis_cache_min_depth"),
+            ),
+        )
+        if cached_analysis is not None:
+            await self.stop_pondering()
+            # No ponder search is started, so there is no expected reply
+            return chess.engine.PlayResult(cached_analysis.pv[0], None)
         white_clock, black_clock = [
             self.time_control.chess_clocks[color] for color in chess.COLORS
         ]
+        time_budget = self.time_manager.allocate(board, self.time_control)
         limit = chess.engine.Limit(
-            time=self.uci_time_limit,
+            time=time_budget.soft,
             white_clock=white_clock.remaining,
             black_clock=black_clock.remaining,
             white_inc=white_clock.increment,
             black_inc=black_clock.increment,
         )
-        return self.uci_engine.play(
-            self.board,
-            limit,
+        # When pondering, the engine keeps searching the expected reply
+        # after returning its move. If the user plays that reply, the next
+        # call sends `ponderhit` instead of starting a new search, otherwise
+        # the ponder search is stopped first.
+        search_start = time.perf_counter()
+        play = functools.partial(
+            uci_engine.play,
+            board,
+            game=self,
+            ponder=self.use_pondering,
+            info=chess.engine.INFO_BASIC | chess.engine.INFO_SCORE | chess.engine.INFO_PV,
         )
+        play_task = asyncio.ensure_future(play(limit))
+        done, __ = await asyncio.wait((play_task,), timeout=time_budget.hard)
+        if done:
+            play_result = play_task.result()
+            if "time" in play_result.info:
+                self.time_manager.record_ipc_latency(
+                    time.perf_counter() - search_start, play_result.info["time"]
+                )
+        else:
+            # Past the hard deadline, cancelling the search makes python-chess
+            # send `stop` under its own command state. The move found so far is
+            # then asked for with the shortest search, served by the hash table.
+            log.debug(f"Engine search exceeded the hard deadline of {time_budget.hard:.2f}s")
+            play_task.cancel()
+            play_result = await asyncio.wait_for(
+                play(chess.engine.Limit(time=MIN_MOVE_TIME)), ENGINE_COMMAND_TIMEOUT
+            )
+        loop.run_in_executor(
+            THREADED_EXECUTOR, ANALYSIS_CACHE.put_in_background, board, engine_key, play_result.info
+        )
+        return play_result
 
     def on_user_response_to_engine_draw_offer(self, engine_next_move, user_answer):
         if isinstance(self._current_focused_object, DrawChoiceMenu):
@@ -116,12 +269,7 @@ class UserEngineChessboard(UserDrivenChessboard):
         if self.prospective is not chess.BLACK:
             return
 
-        def first_move_task():
-            self.get_next_move_from_engine().add_done_callback(
-                lambda future: wx.CallAfter(self.engine_play, future)
-            )
-
-        t = threading.Timer(interval=2, function=first_move_task)
+        t = threading.Timer(interval=2, function=self.request_engine_move)
         t.deamon = True
         t.start()
 
@@ -3,6 +3,8 @@
 # Build customizations
 # Change this file instead of sconstruct or manifest files, whenever possible.
 
+import os
+
 
 # Since some strings in `addon_info` are translatable,
 # we need to include them in the .po files.
@@ -57,7 +59,10 @@ i18nSources = pythonSources + ["buildVars.py"]
 
 # Files that will be ignored when building the nvda-addon file
 # Paths are relative to the addon directory, not to the root directory of your addon sources.
-excludedFiles = []
+excludedFiles = [
+	# Benchmarks and consistency checks, for development only
+	os.path.join("globalPlugins", "chessmart", "diagnostics.py"),
+]
 
 # Base language for the NVDA add-on
 # If your add-on is written in a language other than english, modify this variable.